@@ -1,41 +1,77 @@
+import asyncio
+import bisect
+import copy
 import itertools
-import json
 import os
+import statistics
+import struct
 import sys
+import tempfile
+import time
 import traceback
+from asyncio import Future
+from asyncio.subprocess import PIPE, DEVNULL, Process
+from base64 import b64encode
+from contextlib import nullcontext
 from datetime import datetime
-from glob import glob
 from shutil import copyfile, get_terminal_size
 from shlex import quote
-from urllib.request import urlopen
-from threading import Event
-from subprocess import Popen, PIPE, DEVNULL, CalledProcessError
-from concurrent.futures import ThreadPoolExecutor, Future
+from subprocess import CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
 from html import escape
 
 import constants as C
-from book import Book, Chapter
+from book import Book, Segment
+from concurrency import ConcurrencyController
+from cover import CoverCache
+from loudness import Loudness
+from library import InvalidBook, check_companions, companion_names, list_directory
+from manifest import Manifest
+from metadata import LibraryExport, MetadataCache, MetadataChain, MetadataUnavailable
+from metrics import Metrics
+from ogg import OggError, join_segments, set_opus_tags, set_output_gain
+from planner import Plan, free_space, history
+from scheduling import QueuePolicy
+from staging import Stager
 from util import ffm_escape, ms_to_fftime
+from verify import VerifyError, check, probe
+from watch import Watcher
+from webm import WebMError, WebMMuxer, rewrite_tags
+from workqueue import WorkQueue
 
 class OperationCancelled(Exception):
     pass
 
-#FIXME: support chapter splitting again
-def construct_decode_command(book:Book, quality:C.Quality, chapter:Chapter=None):
+def construct_decode_command(book:Book, quality:C.Quality, segment:Segment=None, measure=False):
+    '''Decrypt and decode to wav, if measure also measuring the loudness into the summary at the end of the log. A
+    segment is resampled to 48kHz and trimmed to its samples.'''
     quality_args = ('-ac', '1') if quality == C.Quality.MONO_VOICE else ()
-    return (*C.FF_CMD, '-audible_key', book.key,
+    filters = (*(segment_filters(segment) if segment else ()), *(loudness_filters(quality) if measure else ()))
+    filter_args = ('-af', ','.join(filters)) if filters else ()
+    if segment:
+        # seek on the input side so that late segments don't decode everything before them
+        seek_args = ('-ss', ms_to_fftime(segment.seek),
+                     '-i', book.input_file)
+    else:
+        seek_args = ('-i', book.input_file,
+                     '-ss', ms_to_fftime(book.input_start_offset),
+                     '-t', ms_to_fftime(book.output_duration))
+    return (*(C.FF_LOG_CMD if measure else C.FF_CMD), '-audible_key', book.key,
                        '-audible_iv', book.iv,
-                       '-i', book.aaxc_path,
-                       '-ss', ms_to_fftime(book.input_start_offset),
-                       '-t', ms_to_fftime(book.output_duration),
+                       *seek_args,
                        '-map_metadata', '-1',
+                       *filter_args,
                        *quality_args,
                        '-f', 'wav',
                        '-')
 
-def construct_encode_command(book:Book, quality:C.Quality, container:C.Container, chapter:Chapter=None):
+def construct_encode_command(book:Book, quality:C.Quality, container:C.Container, segment:Segment=None, stream=False,
+                             downmix=False, placeholder=False):
+    '''Encode wav to ogg opus with opusenc, downmixing to mono if downmix. If placeholder an ogg output is tagged
+    with the LOUDNESS_PLACEHOLDER as well.'''
     meta_args = []
-    if container == C.Container.OGG:
+    # segments are joined and tagged afterwards
+    if container == C.Container.OGG and not segment:
         for key, value in book.metadata.items():
             if key in ('title', 'artist', 'genre', 'date'):
                 meta_args += (f'--{key}', f'{value}')
@@ -45,127 +81,644 @@ def construct_encode_command(book:Book, quality:C.Quality, container:C.Container
         if book.cover_file:
             meta_args += ('--picture', book.cover_file)
 
-        for c in book.chapters:
-            for arg in c.get_metadata(C.Container.OGG):
-                meta_args += ('--comment', f'{arg}')
+        for arg in book.chapters.render(C.ChapterFormat.VORBIS):
+            meta_args += ('--comment', arg)
 
-    mode = ('--speech', )
-    match quality:
-        case C.Quality.MONO_VOICE:
-            br = '32'
-        case C.Quality.STEREO_VOICE:
-            br = '48'
-        case C.Quality.STEREO:
-            br = '64'
-            mode = ()
-    
+        if placeholder:
+            meta_args += ('--comment', '='.join(C.LOUDNESS_PLACEHOLDER))
+
+    br, speech = opus_settings(quality)
+    mode = ('--speech', ) if speech else ()
+    downmix_args = ('--downmix-mono', ) if downmix else ()
     args = ('opusenc', '--quiet',
                        '--bitrate', f'{br}k',
                        *mode,
+                       *downmix_args,
                        *meta_args,
                        '-',
-                       f'{book.output_filename}.opus')
+                       '-' if stream and not segment else transcoded_filename(book, container, segment))
 
     return args
 
+def construct_ffmpeg_encode_command(book:Book, quality:C.Quality, container:C.Container, segment:Segment=None,
+                                    stream=False, metadata_file:str=None, downmix=False):
+    '''Resample and encode wav to ogg opus with libopus, the metadata_file is written as tags. Downmixes to mono if
+    downmix.'''
+    meta_args = (('-i', metadata_file, '-map_metadata', '1', '-map_chapters', '1') if metadata_file
+                 else ('-map_metadata', '-1', '-map_chapters', '-1'))
+    quality_args = ('-ac', '1') if downmix else ()
+    return (*C.FF_CMD, '-f', 'wav',
+                       '-i', '-',
+                       *meta_args,
+                       '-map', '0:a',
+                       *quality_args,
+                       '-af', C.FF_OPUS_RESAMPLER,
+                       *libopus_args(quality),
+                       '-f', 'ogg',
+                       '-' if stream and not segment else transcoded_filename(book, container, segment))
+
+def construct_transcode_command(book:Book, quality:C.Quality, container:C.Container, segment:Segment=None, stream=False,
+                                metadata_file:str=None, measure=False):
+    '''Decrypt, decode, resample and encode to ogg opus in a single ffmpeg, the metadata_file is written as tags. If
+    measure the loudness is measured into the summary at the end of the log.'''
+    if segment:
+        input_seek_args = ('-ss', ms_to_fftime(segment.seek))
+        output_seek_args = ()
+    else:
+        input_seek_args = ()
+        output_seek_args = ('-ss', ms_to_fftime(book.input_start_offset),
+                            '-t', ms_to_fftime(book.output_duration))
+    # demuxer options apply to the next input, the aaxc has to be the first one. ffmpeg moves chapters back by the
+    # output seek, offsetting the metadata input by as much keeps them where the metadata file puts them. ffmpeg
+    # would otherwise copy the raw chapters of the aaxc.
+    meta_offset_args = () if segment else ('-itsoffset', ms_to_fftime(book.input_start_offset))
+    meta_args = ((*meta_offset_args, '-i', metadata_file, '-map_metadata', '1', '-map_chapters', '1') if metadata_file
+                 else ('-map_metadata', '-1', '-map_chapters', '-1'))
+    quality_args = ('-ac', '1') if quality == C.Quality.MONO_VOICE else ()
+    if segment:
+        filters = (*segment_filters(segment), *(loudness_filters(quality) if measure else ()))
+    else:
+        filters = (*(loudness_filters(quality) if measure else ()), C.FF_OPUS_RESAMPLER)
+    return (*(C.FF_LOG_CMD if measure else C.FF_CMD), *input_seek_args,
+                       '-audible_key', book.key,
+                       '-audible_iv', book.iv,
+                       '-i', book.input_file,
+                       *meta_args,
+                       *output_seek_args,
+                       '-map', '0:a',
+                       *quality_args,
+                       '-af', ','.join(filters),
+                       *libopus_args(quality),
+                       '-f', 'ogg',
+                       '-' if stream and not segment else transcoded_filename(book, container, segment))
+
+def opus_settings(quality:C.Quality):
+    '''(bitrate in kbps, tuned for speech) of quality'''
+    match quality:
+        case C.Quality.MONO_VOICE:
+            return '32', True
+        case C.Quality.STEREO_VOICE:
+            return '48', True
+        case C.Quality.STEREO:
+            return '64', False
+
+def libopus_args(quality:C.Quality):
+    '''ffmpeg libopus encoder arguments for quality'''
+    br, speech = opus_settings(quality)
+    return ('-c:a', 'libopus',
+            '-b:a', f'{br}k',
+            '-application', 'voip' if speech else 'audio')
+
+def loudness_filters(quality:C.Quality):
+    '''Filters measuring the loudness of the audio as it will be encoded, i.e. after any downmix'''
+    downmix = ('aformat=channel_layouts=mono', ) if quality == C.Quality.MONO_VOICE else ()
+    return (*downmix, C.FF_LOUDNESS_FILTER)
+
+def segment_filters(segment:Segment):
+    '''Filters resampling to 48kHz, at which Opus packets are counted, and trimming to the samples of segment'''
+    return (C.FF_OPUS_RESAMPLER,
+            f'atrim=start_sample={segment.start}:end_sample={segment.start + segment.length}')
+
+def construct_join_command(book:Book, container:C.Container, metadata_file:str=None, stream=False):
+    '''Write the joined segments read from stdin as the transcoded file of book in container, or to stdout if
+    stream, with the tags of metadata_file'''
+    meta_args = (('-i', metadata_file, '-map_metadata', '1', '-map_chapters', '1') if metadata_file
+                 else ('-map_chapters', '-1'))
+    return (*C.FF_CMD, '-f', 'ogg',
+                       '-i', '-',
+                       *meta_args,
+                       '-codec', 'copy',
+                       '-f', 'ogg',
+                       '-' if stream else transcoded_filename(book, container))
+
+def mp4_cover_args(book:Book, input_index:int):
+    '''ffmpeg arguments mapping the audio of input 0 and, if book has a cover, adding it as input input_index and
+    mapping it as the attached picture'''
+    if not book.cover_file:
+        return ('-map', '0:a')
+    return ('-i', book.cover_file, '-map', '0:a', '-map', f'{input_index}:v', '-disposition:v', 'attached_pic')
+
+def mkv_cover_args(book:Book, option:str):
+    '''mkvmerge or mkvpropedit arguments attaching the cover of book, if any, with the given attach option'''
+    if not book.cover_file:
+        return ()
+    return ('--attachment-name', 'cover.jpg', '--attachment-mime-type', 'image/jpeg', option, book.cover_file)
+
+def transcoded_filename(book:Book, container:C.Container, segment:Segment=None):
+    '''Ogg opus file the encoder writes for the output of book in container, or for a segment of it, which is the
+    output itself for ogg. The others are named after the container, which no two profiles of a run share.'''
+    if segment:
+        return f'{book.output_filename}.{container}.{segment.index:04d}.opus'
+    if container == C.Container.OGG:
+        return f'{book.output_filename}.opus'
+    return f'{book.output_filename}.{container}.opus'
+
+def drain(output, sink):
+    '''Call sink with the binary file output and close it'''
+    with output:
+        try:
+            sink(output)
+        except:
+            # keep reading so the failure is reported here and not as EPIPE further up the chain
+            while output.read(C.TRANSCODE_CHUNK_SIZE):
+                pass
+            raise
+
+def feed(input, source):
+    '''Call source with the binary file input and close it'''
+    with input:
+        source(input)
+
+def picture_block(cover_file:str):
+    '''Base64 encoded FLAC picture block for the METADATA_BLOCK_PICTURE vorbis comment, as written by opusenc'''
+    with open(cover_file, 'rb') as f:
+        data = f.read()
+    mime = b'image/jpeg'
+    # front cover, mime type, empty description, unknown dimensions/depth/palette
+    block = struct.pack(f'>II{len(mime)}sIIIIII', 3, len(mime), mime, 0, 0, 0, 0, 0, len(data)) + data
+    return b64encode(block).decode('ascii')
+
 class App:
     def __init__(self, args, use_nested_chapter_names=False):
         self.quiet = args.quiet
+        self._last_print_was_progress = False
+        self._running = False
 
         if not os.path.isdir(args.output):
             self.print(f'Error: output is not a directory: {args.output}')
             sys.exit(1)
 
-        if os.path.isdir(args.inputs[0]):
-            input_files = glob(f'{args.inputs[0]}/*.aaxc')
-            if input_files:
-                if len(args.inputs) > 1:
-                    self.print('Warning: ignoring additional inputs in directory input mode')
-                args.inputs = input_files
-            else:
-                self.print(f'Error: input directory contains no aaxc files: {args.inputs[0]}')
+        # directories are scanned for aaxc files once the run starts
+        for path in args.inputs:
+            if not os.path.exists(path):
+                self.print(f'Error: input not found: {path}')
                 sys.exit(1)
-        else:
-            for file in args.inputs:
-                if not os.path.isfile(file):
-                    print(f'Error: input file not found: {file}')
-                    sys.exit(1)
 
         self._progress_iterator = itertools.cycle(('—', '|'))
-        self._executor = ThreadPoolExecutor()
-        self._running = False
+        self._metadata_executor = ThreadPoolExecutor(max_workers=C.METADATA_THREAD_LIMIT)
+        self._metadata_futures = {}
+        self._discovery_executor = ThreadPoolExecutor(max_workers=C.DISCOVERY_THREAD_LIMIT)
+        self._discovery = None
+        self._wakeup = None
+        self._n_found = 0
+        self._n_skipped = 0
+        self._n_unchanged = 0
+        self._n_verified = 0
+        self._listed = {}
+        self._seen = {}
+        self._pending = {}
+        self._watching = False
+        self._loop = None
         self._books = []
-        self._active_jobs = 0
+        self._keys = {}
+        self._jobs = set()
+        self._book_jobs = {}
+        '''book -> its job, while it runs'''
+        self._deferred = []
+        self._leases = {}
         self._failed_jobs = 0
         self._n_jobs = 0
-        self._cancel_event = Event()
-        self._last_print_was_progress = False
+        self._cancelled = False
+        self._cancel_event = None
 
-        self.input_files = args.inputs
+        self.inputs = args.inputs
+        self.recursive = args.recursive
+        self.watch = args.watch
         self.output_dir = args.output
-        self.container = args.container
-        self.quality = args.quality
-        self.max_threads = args.threads
+        # every profile's output shares the book's file name, only the extension tells them apart
+        self.profiles = list(dict.fromkeys(args.profile)) if args.profile else [C.Profile(args.container, args.quality)]
+        if len({p.container for p in self.profiles}) < len(self.profiles):
+            self.print('Error: each --profile needs a different container')
+            sys.exit(1)
+        if args.threads is not None and args.max_threads is not None:
+            self.print(f'Error: --max-threads only limits --threads auto, not a fixed --threads {args.threads}')
+            sys.exit(1)
+        self.concurrency = ConcurrencyController(args.max_threads) if args.threads is None else None
+        self.max_threads = self.concurrency.limit if self.concurrency else args.threads
+        self.segments = args.segments
+        self.transfer = args.transfer
+        self.encoder = args.encoder
+        if self.encoder == C.Encoder.FFMPEG and self.transfer == C.Transfer.RELAY and len(self.profiles) == 1:
+            self.print(f'Warning: --transfer {self.transfer} has no effect with --encoder {self.encoder}, there is no pcm to transfer')
+        self.mkvmerge = args.mkvmerge
+        self.intermediate = args.intermediate
+        if self.mkvmerge and not self.intermediate and any(p.container == C.Container.WEBM for p in self.profiles):
+            self.print('Warning: mkvmerge can\'t read from a pipe, falling back to an intermediate file')
+        self.manifest = None if args.force else Manifest(args.manifest or f'{args.output}/{C.MANIFEST_FILENAME}')
+        self.queue = WorkQueue(args.queue, self.profiles) if args.queue else None
+        # listing books to prioritize implies the priority order
+        order = args.order or (C.Order.PRIORITY if args.priority else C.Order.LONGEST)
+        if args.priority and order != C.Order.PRIORITY:
+            self.print(f'Warning: --priority has no effect with --order {order}')
+        self.policy = QueuePolicy(order, args.priority or ())
+        self.predict = args.predict
+        self.retag = args.retag
+        self.verify = args.verify
+        if self.retag and self.verify:
+            self.print('Error: --retag and --verify are mutually exclusive')
+            sys.exit(1)
+        self.plan = args.plan
+        if self.plan and (self.retag or self.verify or self.watch):
+            self.print('Error: --plan only predicts conversions, it can\'t be combined with --retag, --verify or --watch')
+            sys.exit(1)
+        self.loudness = args.loudness
+        containers = {p.container for p in self.profiles}
+        if self.loudness and C.Container.MP4 in containers:
+            self.print(f'Warning: {C.Container.MP4} outputs can\'t carry loudness tags, the loudness is only recorded in the metrics and manifest')
+        if self.loudness == C.LoudnessMode.NORMALIZE and C.Container.WEBM in containers:
+            self.print(f'Warning: --loudness {self.loudness} only sets the output gain of {C.Container.OGG} outputs, {C.Container.WEBM} outputs are only tagged')
+        self.metadata = MetadataCache(args.cache_dir, args.audnexus_url, args.cache_ttl, args.offline)
+        if args.library_export:
+            # audnexus only fills in what the export lacks
+            try:
+                export = LibraryExport(args.library_export)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.print(f'Error: can\'t read library export: {e}')
+                sys.exit(1)
+            self.metadata = MetadataChain([export, self.metadata])
+        self.covers = CoverCache(f'{args.cache_dir}/{C.COVER_CACHE_DIRNAME}')
+        self.stager = None
+        if args.stage_dir and (self.retag or self.verify or self.plan):
+            self.print('Warning: --stage-dir has no effect with --retag, --verify or --plan, which don\'t decode')
+        elif args.stage_dir:
+            try:
+                self.stager = Stager(args.stage_dir, args.stage_budget * 10**6, args.stage_depth)
+            except OSError as e:
+                self.print(f'Error: can\'t create staging directory: {e}')
+                sys.exit(1)
+        self._staging = None
+        '''(aaxc path, future) of the input copy in progress or last finished'''
+        self.metrics_file = args.metrics
+        # several profiles are recorded as comma separated containers and qualities
+        self.settings = dict(threads=args.threads or 'auto',
+                             segments=self.segments,
+                             container=','.join(str(p.container) for p in self.profiles),
+                             quality=','.join(str(p.quality) for p in self.profiles),
+                             transfer=str(self.transfer),
+                             encoder=str(self.encoder),
+                             loudness=str(self.loudness) if self.loudness else None,
+                             stream=all(self._streams(p.container) for p in self.profiles))
+        self.metrics = Metrics(args.metrics, args.prometheus, **self.settings) if args.metrics or args.prometheus else None
         self.use_nested_chapter_names = use_nested_chapter_names
 
-    def _transcode_book(self, book: Book) -> str:
-        #ensure output dir
-        res = os.stat(book.output_base_directory)
-        os.makedirs(book.output_directory, mode=res.st_mode, exist_ok=True)
-
-        decode_command = construct_decode_command(book, self.quality)
-        encode_command = construct_encode_command(book, self.quality, self.container)
-
-        with Popen(args=encode_command, bufsize=C.TRANSCODE_BUF_SIZE, stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL) as encoder:
-            with Popen(args=decode_command, bufsize=C.TRANSCODE_BUF_SIZE, stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL) as decoder:
-                while decoder.poll() == None:
-                    if self.cancelled:
-                        raise OperationCancelled()
-                    encoder.stdin.write(decoder.stdout.read(C.TRANSCODE_CHUNK_SIZE))
-                    encoder.stdin.flush()
-                if decoder.returncode != 0:
-                    raise CalledProcessError(decoder.returncode, decode_command)
-
-            encoder.stdin.close()
-            while encoder.poll() == None:
-                if self.cancellable_sleep():
-                    raise OperationCancelled()
-            if encoder.returncode != 0:
-                raise CalledProcessError(encoder.returncode, encode_command)
+    def _streams(self, container: C.Container) -> bool:
+        '''Whether the muxer of container reads the encoder output from a pipe rather than an intermediate file'''
+        return (not self.intermediate and container in C.STREAM_CONTAINERS
+                and not (container == C.Container.WEBM and self.mkvmerge))
 
-        return f'{book.output_filename}.opus'
+    async def _convert_book(self, book: Book, profiles: list[C.Profile]) -> dict[C.Profile, str]:
+        '''Transcode book once for all profiles and mux each profile's ogg opus into its container, streaming it into
+        the muxers that read from a pipe and remuxing an intermediate file for the rest. Returns the output file of
+        each profile.'''
+        transcoded = {p: transcoded_filename(book, p.container) for p in profiles}
+        plans = {p: self._remux_plan(book, p.container, 'pipe:0' if self._streams(p.container) else transcoded[p])
+                 for p in profiles}
+        streamed = [p for p in profiles if plans[p] and self._streams(p.container)]
+        remuxes = {p: plans[p][1] if p in streamed else None for p in profiles}
 
-    def _remux_book(self, book: Book, transcoded_file: str):
-        if self.cancelled:
+        if len(streamed) == len(profiles):
+            with self._stage(book, C.Stage.STREAM):
+                await self._mux(book, [plans[p] for p in streamed], lambda: self._transcode_book(book, remuxes))
+        else:
+            with self._stage(book, C.Stage.TRANSCODE):
+                await self._mux(book, [plans[p] for p in streamed], lambda: self._transcode_book(book, remuxes))
+            with self._stage(book, C.Stage.REMUX):
+                await self._gather(*(self._remux_book(book, plans[p], transcoded[p])
+                                     for p in profiles if plans[p] and p not in streamed))
+
+        return {p: plans[p][0] if plans[p] else transcoded[p] for p in profiles}
+
+    async def _transcode_book(self, book: Book, remuxes: dict[C.Profile, tuple | WebMMuxer | None]):
+        '''Transcode book to ogg opus for each profile in remuxes, streaming it straight into the profile's remux
+        command or native muxer if it has one and writing its transcoded file otherwise'''
+        segments = book.segments(self.segments)
+        if len(segments) > 1:
+            return await self._transcode_segmented(book, segments, remuxes)
+
+        # ogg output is not remuxed later, so the tags opusenc would have written go in with the encode
+        metadata_file = None
+        if self.encoder == C.Encoder.FFMPEG and any(p.container == C.Container.OGG for p in remuxes):
+            metadata_file = self._write_ffmetadata(book, placeholder=bool(self.loudness))
+        try:
+            log = await self._transcode_span(book, remuxes, metadata_file=metadata_file)
+            if self.loudness:
+                self._measured(book, [log], [book.output_duration])
+        finally:
+            if metadata_file and os.path.exists(metadata_file):
+                os.remove(metadata_file)
+
+    async def _transcode_span(self, book: Book, remuxes: dict[C.Profile, tuple | WebMMuxer | None],
+                              segment: Segment = None, metadata_file: str = None) -> str | None:
+        '''Transcode book, or a segment of it, for each profile in remuxes. A single profile runs as one
+        pipeline, several share one decoder whose wav is teed into an encoder per profile. Returns the log of the
+        decoder if it measures the loudness.'''
+        def sink(remux):
+            return remux.mux if isinstance(remux, WebMMuxer) else None
+
+        if len(remuxes) == 1:
+            (profile, remux), = remuxes.items()
+            return await self._pipeline(*self._transcode_commands(book, profile, segment, bool(remux), metadata_file),
+                                        *self._remux_tail(remux),
+                                        relay=self.transfer == C.Transfer.RELAY,
+                                        sink=sink(remux),
+                                        log=bool(self.loudness))
+
+        # the decoder only downmixes when every profile is mono, otherwise the mono encoders downmix their own copy
+        quality = next((p.quality for p in remuxes if p.quality != C.Quality.MONO_VOICE), C.Quality.MONO_VOICE)
+        branches = [(self._encode_command(book, p, segment, bool(remux),
+                                          metadata_file if p.container == C.Container.OGG else None,
+                                          downmix=p.quality != quality),
+                     *self._remux_tail(remux))
+                    for p, remux in remuxes.items()]
+        return await self._fanout(construct_decode_command(book, quality, segment, bool(self.loudness)), branches,
+                                  [sink(remux) for remux in remuxes.values()], log=bool(self.loudness))
+
+    def _transcode_commands(self, book: Book, profile: C.Profile, segment: Segment = None, stream=False,
+                            metadata_file: str = None) -> tuple:
+        '''Commands transcoding book, or a segment of it, to ogg opus for profile with the selected encoder.
+        The first one measures the loudness if enabled.'''
+        measure = bool(self.loudness)
+        if self.encoder == C.Encoder.FFMPEG:
+            return (construct_transcode_command(book, profile.quality, profile.container, segment, stream, metadata_file,
+                                                measure), )
+        return (construct_decode_command(book, profile.quality, segment, measure),
+                construct_encode_command(book, profile.quality, profile.container, segment, stream,
+                                         placeholder=measure))
+
+    def _encode_command(self, book: Book, profile: C.Profile, segment: Segment = None, stream=False,
+                        metadata_file: str = None, downmix=False) -> tuple:
+        '''Command encoding the wav of a shared decoder to ogg opus for profile with the selected encoder'''
+        if self.encoder == C.Encoder.FFMPEG:
+            return construct_ffmpeg_encode_command(book, profile.quality, profile.container, segment, stream,
+                                                   metadata_file, downmix)
+        return construct_encode_command(book, profile.quality, profile.container, segment, stream, downmix,
+                                        bool(self.loudness))
+
+    def _ffmetadata(self, book: Book, cover=True, placeholder=False) -> str:
+        '''ffmetadata of the tags and chapters of book, and of its cover as a vorbis comment if cover. If placeholder
+        the tags include the LOUDNESS_PLACEHOLDER.'''
+        tags = [f'{k}={ffm_escape(v)}' for k,v in book.metadata.items()]
+        if cover and book.cover_file:
+            tags.append(f'METADATA_BLOCK_PICTURE={ffm_escape(picture_block(book.cover_file))}')
+        if placeholder:
+            tags.append('='.join(C.LOUDNESS_PLACEHOLDER))
+        return C.FFMETADATA_FMT.format(tags='\n'.join(tags), chapters=book.chapters.render(C.ChapterFormat.FFMPEG))
+
+    def _write_ffmetadata(self, book: Book, directory: str = None, cover=True, placeholder=False) -> str:
+        '''Write _ffmetadata() to a file in directory, the book's output directory by default, and return its path'''
+        metadata_file = f'{directory or book.output_directory}/ffmetadata'
+        with open(metadata_file, 'w') as f:
+            f.write(self._ffmetadata(book, cover, placeholder))
+        return metadata_file
+
+    def _remux_tail(self, remux: tuple | WebMMuxer | None) -> tuple:
+        '''Commands to append to a pipeline to stream its output into remux, native muxers run as a sink instead'''
+        return (remux, ) if isinstance(remux, tuple) else ()
+
+    async def _transcode_segmented(self, book: Book, segments: tuple[Segment, ...],
+                                   remuxes: dict[C.Profile, tuple | WebMMuxer | None]):
+        segment_files = {p: [transcoded_filename(book, p.container, s) for s in segments] for p in remuxes}
+
+        try:
+            results = await self._gather(*(self._transcode_span(book, dict.fromkeys(remuxes), s) for s in segments))
+            if self.loudness:
+                self._measured(book, results, [s.duration for s in segments])
+
+            if self.cancelled:
+                raise OperationCancelled()
+
+            await self._gather(*(self._join(book, p, list(zip(segment_files[p], segments)), remux)
+                                 for p, remux in remuxes.items()))
+        finally:
+            for file in itertools.chain.from_iterable(segment_files.values()):
+                if os.path.exists(file):
+                    os.remove(file)
+
+    async def _join(self, book: Book, profile: C.Profile, segment_files: list[tuple[str, Segment]],
+                    remux: tuple | WebMMuxer = None):
+        '''Join the (file, segment) of profile into its transcoded file, or stream them into its remux command or
+        native muxer'''
+        parts = [(file, segment.skip, segment.keep) for file, segment in segment_files]
+        metadata_file = None
+
+        try:
+            # ogg output is not remuxed later, so the metadata opusenc would have written goes in here
+            if profile.container == C.Container.OGG:
+                metadata_file = self._write_ffmetadata(book, placeholder=bool(self.loudness))
+
+            await self._pipeline(construct_join_command(book, profile.container, metadata_file, stream=bool(remux)),
+                                 *self._remux_tail(remux),
+                                 source=lambda output: join_segments(parts, output),
+                                 sink=remux.mux if isinstance(remux, WebMMuxer) else None)
+        finally:
+            if metadata_file and os.path.exists(metadata_file):
+                os.remove(metadata_file)
+
+    async def _gather(self, *aws) -> list:
+        '''Results of aws run concurrently. The first exception is raised once all of them finished, so that none is
+        left running on files the caller cleans up.'''
+        results = await asyncio.gather(*aws, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def _pipeline(self, *commands: tuple, relay=False, source=None, sink=None, log=False) -> str | None:
+        '''Run commands with each one's stdout feeding the next one's stdin and supervise them. The first link is
+        relayed through python if relay, every other link is an OS pipe between the processes. If given, source is
+        called in a thread with the first command's stdin as a binary file and sink with the last command's stdout.
+        If log, the first command's stderr is returned.'''
+        # a lone command has no link to relay
+        relay = relay and len(commands) > 1
+        processes = []
+        fds = []
+        input = None
+        output = None
+        try:
+            stdin = DEVNULL
+            if source:
+                stdin, write = os.pipe()
+                input = open(write, 'wb')
+                fds.append(stdin)
+            for i, command in enumerate(commands):
+                read = None
+                if i == len(commands) - 1 and not sink:
+                    stdout = DEVNULL
+                elif relay and i == 0:
+                    stdout = read = PIPE
+                elif i == len(commands) - 1:
+                    read, stdout = os.pipe()
+                    output = open(read, 'rb')
+                    fds.append(stdout)
+                else:
+                    read, stdout = os.pipe()
+                    fds += (read, stdout)
+                stderr = PIPE if log and i == 0 else DEVNULL
+                process = await asyncio.create_subprocess_exec(*command, stdin=stdin, stdout=stdout, stderr=stderr)
+                processes.append((process, command))
+                stdin = read
+        except:
+            for file in (input, output):
+                if file:
+                    file.close()
+            raise
+        finally:
+            # the children hold their own pipe ends now, so EOF and EPIPE propagate along the chain
+            for fd in fds:
+                os.close(fd)
+
+        async def relay_chunks(source: Process, destination: Process):
+            try:
+                while chunk := await source.stdout.read(C.TRANSCODE_CHUNK_SIZE):
+                    destination.stdin.write(chunk)
+                    await destination.stdin.drain()
+            finally:
+                destination.stdin.close()
+
+        logs = []
+        async def read_log(source: Process):
+            logs.append(await source.stderr.read())
+
+        aws = []
+        if relay:
+            aws.append(relay_chunks(processes[0][0], processes[1][0]))
+        if source:
+            aws.append(asyncio.to_thread(feed, input, source))
+        if sink:
+            aws.append(asyncio.to_thread(drain, output, sink))
+        if log:
+            aws.append(read_log(processes[0][0]))
+        await self._supervise(*processes, aws=aws)
+        return logs[0].decode(errors='replace') if log else None
+
+    async def _fanout(self, source: tuple, branches: list[tuple[tuple, ...]], sinks: list, log=False) -> str | None:
+        '''Run the source command with its stdout teed through python into the first command of every branch, each a
+        chain of commands linked by OS pipes as in _pipeline, and supervise them all. If given, a branch's sink is
+        called in a thread with its last command's stdout as a binary file. A chunk is written to every branch before
+        the next one is read, so the slowest branch throttles the source and each branch buffers no more than a
+        chunk and its pipes. If log, the source's stderr is returned.'''
+        processes = []
+        heads = []
+        outputs = []
+        fds = []
+        try:
+            process = await asyncio.create_subprocess_exec(*source, stdin=DEVNULL, stdout=PIPE,
+                                                           stderr=PIPE if log else DEVNULL)
+            processes.append((process, source))
+            for commands, sink in zip(branches, sinks):
+                stdin = PIPE
+                for i, command in enumerate(commands):
+                    read = None
+                    if i == len(commands) - 1 and not sink:
+                        stdout = DEVNULL
+                    elif i == len(commands) - 1:
+                        read, stdout = os.pipe()
+                        outputs.append((open(read, 'rb'), sink))
+                        fds.append(stdout)
+                    else:
+                        read, stdout = os.pipe()
+                        fds += (read, stdout)
+                    process = await asyncio.create_subprocess_exec(*command, stdin=stdin, stdout=stdout, stderr=DEVNULL)
+                    processes.append((process, command))
+                    if i == 0:
+                        heads.append(process)
+                    stdin = read
+        except:
+            for output, _ in outputs:
+                output.close()
+            raise
+        finally:
+            # the children hold their own pipe ends now, so EOF and EPIPE propagate along the chains
+            for fd in fds:
+                os.close(fd)
+
+        source_process = processes[0][0]
+        async def tee():
+            try:
+                while chunk := await source_process.stdout.read(C.TRANSCODE_CHUNK_SIZE):
+                    for head in heads:
+                        head.stdin.write(chunk)
+                    await self._gather(*(head.stdin.drain() for head in heads))
+            except:
+                # keep reading so that the source isn't left blocked on a full pipe
+                while await source_process.stdout.read(C.TRANSCODE_CHUNK_SIZE):
+                    pass
+                raise
+            finally:
+                for head in heads:
+                    head.stdin.close()
+
+        logs = []
+        async def read_log():
+            logs.append(await source_process.stderr.read())
+
+        aws = [tee(), *(asyncio.to_thread(drain, output, sink) for output, sink in outputs)]
+        if log:
+            aws.append(read_log())
+        await self._supervise(*processes, aws=aws)
+        return logs[0].decode(errors='replace') if log else None
+
+    async def _supervise(self, *processes: tuple[Process, tuple], aws=()):
+        '''Wait for (process, command) pairs and any other awaitables in aws to finish and check their exit codes and
+        exceptions. All of the processes are terminated if the run is cancelled.'''
+        waiter = asyncio.gather(*(p.wait() for p, _ in processes), *aws, return_exceptions=True)
+        cancel = asyncio.ensure_future(self._cancel_event.wait())
+        try:
+            done, _ = await asyncio.wait((waiter, cancel), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            # only this book's job is cancelled, e.g. after its work queue lease was lost
+            cancel.cancel()
+            for p, _ in processes:
+                if p.returncode == None:
+                    p.terminate()
+            await waiter
+            raise
+        if cancel in done:
+            for p, _ in processes:
+                if p.returncode == None:
+                    p.terminate()
+            await waiter
             raise OperationCancelled()
+        cancel.cancel()
+
+        # a failing process makes everything upstream of it exit with EPIPE, so the last failure is the cause
+        for p, command in reversed(processes):
+            if p.returncode != 0:
+                raise CalledProcessError(p.returncode, command)
+        # a relay or sink error without a failed process, e.g. the encoder closing stdin early and exiting 0
+        for result in waiter.result():
+            if isinstance(result, BaseException):
+                raise result
 
+    def _remux_plan(self, book: Book, container: C.Container, transcoded_file: str) -> tuple[str, tuple, list] | None:
+        '''(output file, remux command or native muxer, [(temp file, content), ...]) for an output in container, None
+        if the ogg opus is the output. transcoded_file may be "pipe:0" for containers in STREAM_CONTAINERS.'''
         temp_files = []
         output_file = f'{book.output_filename}'
-        cover_file  = f'{book.output_directory}/cover.jpg'
 
-        match self.container:
+        match container:
             case C.Container.MP4:
                 output_file += '.m4b'
-                ffmetadata_file = f'{book.output_directory}/ffmetadata'
-                tags = (f'{k}={ffm_escape(v)}' for k,v in book.metadata.items())
-                chapters = (c.get_metadata(C.ChapterFormat.FFMPEG) for c in book.chapters)
-                ffmetadata = C.FFMETADATA_FMT.format(tags='\n'.join(tags),
-                                                     chapters='\n'.join(chapters))
-                temp_files.append((ffmetadata_file, ffmetadata))
-                remux_cmd = (*C.FF_CMD, '-i', transcoded_file,
+                # named apart from the ffmetadata an ogg output of the same run may be transcoded with
+                ffmetadata_file = f'{book.output_directory}/ffmetadata.{container}'
+                temp_files.append((ffmetadata_file, self._ffmetadata(book, cover=False)))
+                remux_cmd = (*C.FF_CMD, '-f', 'ogg',
+                                        '-i', transcoded_file,
                                         '-i', ffmetadata_file,
+                                        *mp4_cover_args(book, 2),
                                         '-map_metadata', '1',
+                                        '-map_chapters', '1',
                                         '-codec', 'copy',
                                         '-f', 'mp4',
                                         output_file)
+            case C.Container.WEBM if not self.mkvmerge:
+                output_file += '.webm'
+                remux_cmd = WebMMuxer(output_file, book.metadata, book.chapters, book.cover_file)
             case C.Container.WEBM:
-                output_file += 'webm'
+                output_file += '.webm'
                 tags_file    = f'{book.output_directory}/tags'
                 chapter_file = f'{book.output_directory}/chapters'
-                tags = (C.MATROSKA_TAG_SIMPLE_FMT.format(key=k, value=escape(v)) for k,v in book.metadata.items())
-                tags_xml = C.MATROSKA_TAG_XML_FMT.format(tags='\n'.join(tags))
-                chapters = (c.get_metadata(C.ChapterFormat.MATROSKA) for c in book.chapters)
-                chapters_xml = C.MATROSKA_CHAPTERS_XML_FMT.format(atoms='\n'.join(chapters))
+                tags_xml, chapters_xml = self._matroska_xml(book)
                 temp_files.append((tags_file, tags_xml))
                 temp_files.append((chapter_file, chapters_xml))
                 remux_cmd = ("mkvmerge", "-o", output_file,
@@ -173,56 +726,578 @@ class App:
                                           "--quiet",
                                           "--global-tags", tags_file,
                                           "--chapters", chapter_file,
+                                          *mkv_cover_args(book, "--attach-file"),
                                           transcoded_file)
             case other:
-                return transcoded_file
+                return None
 
-        for file, content in temp_files:
-            if self.cancelled:
-                raise OperationCancelled()
-            with open(file, 'w') as f:
-                f.writelines(content)
+        return output_file, remux_cmd, temp_files
+
+    def _matroska_xml(self, book: Book) -> tuple[str, str]:
+        '''(tags, chapters) xml of book for mkvmerge and mkvpropedit'''
+        tags = (C.MATROSKA_TAG_SIMPLE_FMT.format(key=k, value=escape(v)) for k,v in book.metadata.items())
+        return (C.MATROSKA_TAG_XML_FMT.format(tags='\n'.join(tags)),
+                C.MATROSKA_CHAPTERS_XML_FMT.format(atoms=book.chapters.render(C.ChapterFormat.MATROSKA)))
 
-        self.cancellable_exec(remux_cmd)
+    async def _mux(self, book: Book, plans: list[tuple[str, tuple, list]], run):
+        '''Write the temp files of the plans, await run() which runs their remux commands, then clean up'''
+        temp_files = [file for _, _, files in plans for file in files]
+
+        try:
+            for file, content in temp_files:
+                if self.cancelled:
+                    raise OperationCancelled()
+                with open(file, 'w') as f:
+                    f.writelines(content)
 
-        for file, _ in temp_files:
-            os.remove(file)
+            await run()
+        finally:
+            for file, _ in temp_files:
+                if os.path.exists(file):
+                    os.remove(file)
 
+    async def _remux_book(self, book: Book, plan: tuple[str, tuple, list], transcoded_file: str):
+        '''Remux the transcoded file of an output of book as the plan says, then remove it'''
+        if self.cancelled:
+            raise OperationCancelled()
+
+        remux = plan[1]
+        if isinstance(remux, WebMMuxer):
+            await self._mux(book, [plan], lambda: asyncio.to_thread(self._mux_file, remux, transcoded_file))
+        else:
+            await self._mux(book, [plan], lambda: self.cancellable_exec(*remux))
         os.remove(transcoded_file)
-        copyfile(book.cover_file, cover_file)
 
-        return output_file
+    async def _retag_book(self, book: Book, profile: C.Profile, tags_digest: str) -> tuple[str, Book] | None:
+        '''Rewrite the tags, chapters and cover of the existing output of book in profile without transcoding, returns
+        (output file, book as written to it) or None if there is no output or its tags are already current'''
+        if self.cancelled:
+            raise OperationCancelled()
 
-    def _process_book(self, book: Book):
-        with urlopen(f'https://api.audnex.us/books/{book.asin}') as data:
-            meta = json.load(data)
+        output_file, recorded = self._existing_output(book, profile)
+        if not os.path.exists(output_file):
+            self.print(f'Warning: no {profile.container} output to retag for {book.aaxc_path}')
+            return None
+        if recorded and recorded[1] == tags_digest:
+            self._n_unchanged += 1
+            return None
+        # there's no decode to measure it again
+        if recorded and recorded[2]:
+            book = self._output_book(book, profile.container, recorded[2])
 
+        await self._rewrite_tags(book, profile.container, output_file)
+        return output_file, book
+
+    def _existing_output(self, book: Book, profile: C.Profile) -> tuple[str, tuple | None]:
+        '''(output file, manifest record) of the existing output of book in profile, the recorded output file if there
+        is one and otherwise where it would be written'''
+        recorded = self.manifest.output(book.aaxc_path, *profile) if self.manifest else None
+        # outputs stay where they are, even if the new metadata would name them differently
+        return recorded[0] if recorded else f'{book.output_filename}.{C.OUTPUT_EXTENSIONS[profile.container]}', recorded
+
+    async def _verify_book(self, book: Book, profiles: list[C.Profile]):
+        '''Check the duration, chapters and tags of the existing outputs of book in profiles from their container
+        structures, raise VerifyError if any doesn't match the book'''
         if self.cancelled:
             raise OperationCancelled()
 
-        book.import_metadata(meta)
+        failures = []
+        for profile in profiles:
+            output_file, _ = self._existing_output(book, profile)
+            if not os.path.exists(output_file):
+                failures.append(f'no {profile.container} output for {book.aaxc_path}')
+                continue
+            info = await asyncio.to_thread(probe, output_file, profile.container)
+            if problems := check(book, info, profile.container):
+                failures.append(f'{output_file}: {"; ".join(problems)}')
+            else:
+                self._n_verified += 1
+        if failures:
+            raise VerifyError('\n'.join(failures))
+
+    async def _rewrite_tags(self, book: Book, container: C.Container, output_file: str):
+        '''Replace the tags, chapters and cover of output_file in container with those of book, in place where the
+        container allows it and otherwise by stream copying into a new file'''
+        output_directory = os.path.dirname(output_file)
+        match container:
+            case C.Container.WEBM if not self.mkvmerge:
+                try:
+                    await asyncio.to_thread(rewrite_tags, output_file, book.metadata, book.chapters, book.cover_file)
+                except WebMError as e:
+                    raise WebMError(f'{output_file}: {e}') from e
+            case C.Container.WEBM:
+                tags_file, chapter_file = f'{output_directory}/tags', f'{output_directory}/chapters'
+                try:
+                    for file, content in zip((tags_file, chapter_file), self._matroska_xml(book)):
+                        with open(file, 'w') as f:
+                            f.write(content)
+                    # edits the header in place, exiting 1 with a warning if there was no cover to replace
+                    try:
+                        await self.cancellable_exec('mkvpropedit', '--quiet', output_file,
+                                                    '--tags', f'global:{tags_file}',
+                                                    '--chapters', chapter_file,
+                                                    *(('--delete-attachment', 'mime-type:image/jpeg') if book.cover_file else ()),
+                                                    *mkv_cover_args(book, '--add-attachment'))
+                    except CalledProcessError as e:
+                        if e.returncode != 1:
+                            raise
+                finally:
+                    for file in (tags_file, chapter_file):
+                        if os.path.exists(file):
+                            os.remove(file)
+            case _:
+                # stream copy into a new file, the cover goes in ogg as a vorbis comment and in mp4 as an attached
+                # picture, as when transcoding
+                temp_file = f'{output_file}.retag'
+                is_mp4 = container == C.Container.MP4
+                metadata_file = self._write_ffmetadata(book, output_directory, cover=not is_mp4)
+                try:
+                    await self.cancellable_exec(*C.FF_CMD, '-i', output_file,
+                                                           '-i', metadata_file,
+                                                           *(mp4_cover_args(book, 2) if is_mp4 else ('-map', '0:a')),
+                                                           '-map_metadata', '1',
+                                                           '-map_metadata:s:a', '-1',
+                                                           '-map_chapters', '1',
+                                                           '-codec', 'copy',
+                                                           '-f', 'mp4' if is_mp4 else 'ogg',
+                                                           temp_file)
+                    os.replace(temp_file, output_file)
+                finally:
+                    for file in (metadata_file, temp_file):
+                        if os.path.exists(file):
+                            os.remove(file)
+
+    def _measured(self, book: Book, logs: list[str], durations: list[int]):
+        '''Take the loudness of book from the logs of the transcodes of its parts of durations milliseconds'''
+        try:
+            book.loudness = Loudness.combine([Loudness.parse(log) for log in logs], durations)
+        except ValueError:
+            self.print(f'Warning: no loudness measurement for {book.aaxc_path}')
+
+    def _output_book(self, book: Book, container: C.Container, loudness: Loudness = None) -> Book:
+        '''book as written to its output in container. With a loudness that's a shallow copy carrying the loudness and
+        its tags for container, by default the measured loudness with the output gain normalizing sets for ogg.'''
+        if not loudness:
+            if not book.loudness:
+                return book
+            loudness = copy.copy(book.loudness)
+            if self.loudness == C.LoudnessMode.NORMALIZE and container == C.Container.OGG:
+                loudness.output_gain = loudness.gain_to(C.LOUDNESS_TARGET)
+        output = copy.copy(book)
+        output.loudness = loudness
+        output.metadata = {**book.metadata, **loudness.tags(container)}
+        return output
+
+    async def _tag_loudness(self, book: Book, container: C.Container, output_file: str):
+        '''Add the loudness of book, if it was measured, to output_file in container, whose tags were written before
+        the decode finished measuring it. Ogg outputs have their LOUDNESS_PLACEHOLDER replaced in place.'''
+        if self.cancelled:
+            raise OperationCancelled()
+        match container:
+            case C.Container.OGG:
+                tags = book.loudness.tags(container) if book.loudness else {}
+                try:
+                    await asyncio.to_thread(set_opus_tags, output_file, tags, (C.LOUDNESS_PLACEHOLDER[0], ))
+                except OggError:
+                    await self._rewrite_tags(book, container, output_file)
+            case C.Container.WEBM if book.loudness:
+                await self._rewrite_tags(book, container, output_file)
+        if book.loudness and book.loudness.output_gain:
+            await asyncio.to_thread(set_output_gain, output_file, book.loudness.output_gain)
 
-        return self._remux_book(book, self._transcode_book(book))
+    def _mux_file(self, muxer: WebMMuxer, transcoded_file: str):
+        with open(transcoded_file, 'rb') as f:
+            muxer.mux(f)
 
-    def _future_done_cb(self, future: Future):
-        self._active_jobs -= 1
+    def _fetch_metadata(self, book: Book) -> Book:
         if self.cancelled:
+            raise OperationCancelled()
+
+        with self._stage(book, C.Stage.METADATA):
+            book.import_metadata(self.metadata.get(book.asin))
+
+        return book
+
+    async def _discover(self):
+        '''Scan the inputs, then in watch mode keep enqueueing books as they appear until the run is cancelled'''
+        directories = {}
+        for path in self.inputs:
+            if os.path.isdir(path):
+                directories[path] = None
+            else:
+                directory, name = os.path.split(path)
+                directory = directory or '.'
+                if directories.get(directory, set()) is not None:
+                    directories.setdefault(directory, set()).add(name)
+
+        await self._scan(directories)
+
+        if self._n_skipped:
+            self.print(f'Skipped {self._n_skipped} unchanged book{"s" if self._n_skipped > 1 else ""}')
+        if not self._n_found and not self.watch:
+            self.print('Error: no aaxc files found in the inputs')
+        elif not self.n_jobs:
+            self.print('Nothing to do')
+        elif self.plan:
+            self.print(f'Planning {self.n_jobs} jobs')
+        else:
+            self.print(f'Enqueued {self.n_jobs} jobs at: {datetime.now()}')
+            if self.predict:
+                self._print_prediction()
+
+        if self.watch:
+            await self._watch()
+
+    async def _scan(self, directories: dict[str, set[str] | None], changed: dict[str, set[str]] = None):
+        '''List directories, mapped to the aaxc names to take from them or None for all, and parse every aaxc found
+        on the discovery pool. Directory listings and parses run concurrently and each book is enqueued as soon as
+        it's parsed, so work starts before the scan finishes. In watch mode a book is only parsed once its files
+        have settled, and only again if they changed since. Directories in changed only look at the books of the
+        file names they're mapped to.'''
+        def submit(function, *args):
+            return self._loop.run_in_executor(self._discovery_executor, function, *args)
+
+        self._listed.update(directories)
+        # future -> (directory, aaxc names to take from it or None for all) or (aaxc path, directory listing)
+        listings = {submit(list_directory, d): (d, only) for d, only in directories.items()}
+        checks = {}
+        parses = {}
+        try:
+            while listings or checks or parses:
+                done, _ = await asyncio.wait((*listings, *checks, *parses), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future in listings:
+                        directory, only = listings.pop(future)
+                        try:
+                            names, subdirectories = future.result()
+                        except OSError as e:
+                            self.print(f'Warning: can\'t list input directory: {e}')
+                            continue
+                        names = frozenset(names)
+                        touched = changed.get(directory) if changed else None
+                        for name in names:
+                            if not name.endswith('.aaxc') or (only is not None and name not in only):
+                                continue
+                            if touched is not None and touched.isdisjoint((name, *companion_names(name))):
+                                continue
+                            path = os.path.join(directory, name)
+                            if path not in self._seen:
+                                self._n_found += 1
+                            try:
+                                check_companions(name, names)
+                            except InvalidBook as e:
+                                # while watching, the rest of a download is still to come
+                                if not self._watching:
+                                    self.print(f'Warning: skipping {path}: {e}')
+                                continue
+                            if self.watch:
+                                checks[submit(self._book_state, path)] = (path, names)
+                            else:
+                                parses[submit(self._load_book, path, names)] = path
+                        if self.recursive and only is None:
+                            for subdirectory in subdirectories:
+                                if subdirectory not in self._listed:
+                                    self._listed[subdirectory] = None
+                                    listings[submit(list_directory, subdirectory)] = (subdirectory, None)
+                    elif future in checks:
+                        path, names = checks.pop(future)
+                        try:
+                            signature, settled = future.result()
+                        except OSError:
+                            # deleted or renamed while being looked at
+                            self._pending.pop(path, None)
+                            continue
+                        if self._seen.get(path) == signature:
+                            continue
+                        if settled > time.time():
+                            self._pending[path] = settled
+                            continue
+                        self._pending.pop(path, None)
+                        self._seen[path] = signature
+                        parses[submit(self._load_book, path, names)] = path
+                    else:
+                        path = parses.pop(future)
+                        try:
+                            book = future.result()
+                        except InvalidBook as e:
+                            self.print(f'Warning: skipping {path}: {e}')
+                            continue
+                        if not book:
+                            self._n_skipped += 1
+                            continue
+                        self._enqueue(book)
+                        if self._watching:
+                            self.print(f'Enqueued {path}')
+        finally:
+            for future in (*listings, *checks, *parses):
+                future.cancel()
+
+    async def _watch(self):
+        '''Check the books whose files changed in the input directories, and those whose files are still settling
+        once they should have'''
+        watcher = Watcher()
+        self._watching = True
+        self.print(f'Watching {len(self._listed)} input director{"y" if len(self._listed) == 1 else "ies"} for new '
+                   f'books, {watcher.method}')
+        try:
+            while True:
+                for directory in self._listed:
+                    watcher.add(directory)
+                timeout = max(0, min(self._pending.values()) - time.time()) if self._pending else None
+                changed = await watcher.wait(timeout)
+                # due books are checked again as if their files changed, or dropped if they're gone
+                now = time.time()
+                for path in [p for p, settled in self._pending.items() if settled <= now]:
+                    del self._pending[path]
+                    directory, name = os.path.split(path)
+                    if changed.get(directory, set()) is not None:
+                        changed.setdefault(directory, set()).add(name)
+                if changed:
+                    await self._scan({d: self._listed.get(d) for d in changed},
+                                     {d: names for d, names in changed.items() if names is not None})
+        finally:
+            watcher.close()
+
+    def _book_state(self, aaxc: str) -> tuple[tuple, float]:
+        '''(signature, time at which it settles) of the files of a book, the signature changes when any of them is
+        rewritten and they have settled once none was modified for WATCH_SETTLE seconds'''
+        if self.cancelled:
+            raise OperationCancelled()
+        directory, name = os.path.split(aaxc)
+        results = [os.stat(p) for p in (aaxc, *(os.path.join(directory, n) for n in companion_names(name)))]
+        signature = tuple((r.st_size, r.st_mtime_ns) for r in results)
+        return signature, max(r.st_mtime for r in results) + C.WATCH_SETTLE
+
+    def _print_prediction(self):
+        '''Print the policy's predicted completion order of the books still waiting'''
+        prediction = self.policy.predict(self._books, self.max_threads, self._keys)
+        makespan = prediction[-1][1] if prediction else 0
+        # nothing waiting, or only books without audio
+        if not makespan:
+            self.print(f'Predicted completion order ({self.policy.order}): nothing to do')
+            return
+        lines = [f'Predicted completion order ({self.policy.order}):']
+        for i, (book, finish) in enumerate(prediction):
+            lines.append(f'{i + 1:5d}. {os.path.basename(book.aaxc_path)} ({finish * 100 / makespan:.0f}%)')
+        self.print('\n'.join(lines))
+
+    def _load_book(self, aaxc: str, listing: frozenset[str]) -> Book | None:
+        '''Parse a discovered book, None if the manifest says it's already converted'''
+        if self.cancelled:
+            raise OperationCancelled()
+        if not self._pending_profiles(aaxc):
+            return None
+        try:
+            return Book(aaxc, self.output_dir, listing)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise InvalidBook(f'unreadable companion file, {type(e).__name__}: {e}') from e
+
+    def _pending_profiles(self, aaxc: str, content_format: str = None) -> list[C.Profile]:
+        '''Profiles to convert aaxc to, those the manifest doesn't record as current for its content_format if known.
+        Retagging and verifying take every profile.'''
+        if not self.manifest or self.retag or self.verify:
+            return self.profiles
+        return [p for p in self.profiles if not self.manifest.is_current(aaxc, *p, content_format)]
+
+    def _enqueue(self, book: Book):
+        '''Hand a parsed book to the scheduler and start fetching its metadata'''
+        # kept in ascending priority, the scheduler pops from the end
+        self._keys[book] = self.policy.key(book, time.monotonic())
+        bisect.insort(self._books, book, key=self._keys.__getitem__)
+        # planning only needs what the companion files say
+        if not self.plan:
+            self._metadata_futures[book] = self._loop.run_in_executor(self._metadata_executor, self._fetch_metadata,
+                                                                      book)
+        self.n_jobs += 1
+        self._wakeup.set()
+
+    def _stage(self, book: Book, stage: C.Stage):
+        return self.metrics.stage(book, stage) if self.metrics else nullcontext()
+
+    async def _process_book(self, book: Book):
+        if self.cancelled:
+            raise OperationCancelled()
+
+        #ensure output dir
+        if not self.retag and not self.verify:
+            res = os.stat(book.output_base_directory)
+            os.makedirs(book.output_directory, mode=res.st_mode, exist_ok=True)
+
+        done = False
+        # profile -> (output file, book as written to it)
+        outputs = {}
+        # of the original cover, which the cover stage replaces with a resized one
+        tags_digest = book.tags_digest()
+        profiles = self._pending_profiles(book.aaxc_path, book.content_format)
+        try:
+            if not self.verify:
+                with self._stage(book, C.Stage.COVER):
+                    await self._prepare_cover(book)
+            if self.verify:
+                with self._stage(book, C.Stage.VERIFY):
+                    await self._verify_book(book, profiles)
+            elif self.retag:
+                with self._stage(book, C.Stage.RETAG):
+                    for profile in profiles:
+                        if retagged := await self._retag_book(book, profile, tags_digest):
+                            outputs[profile] = retagged
+            else:
+                if self.stager:
+                    await self._stage_input(book)
+                output_files = await self._convert_book(book, profiles)
+                outputs = {p: (f, self._output_book(book, p.container)) for p, f in output_files.items()}
+                if self.loudness:
+                    with self._stage(book, C.Stage.LOUDNESS):
+                        for profile, (output_file, output_book) in outputs.items():
+                            await self._tag_loudness(output_book, profile.container, output_file)
+            if book.full_cover_file:
+                for directory in {os.path.dirname(f) for f, _ in outputs.values()}:
+                    copyfile(book.full_cover_file, f'{directory}/cover.jpg')
+            if self.manifest:
+                for profile, (output_file, output_book) in outputs.items():
+                    # a retag doesn't make the output current with a changed input
+                    if self.retag:
+                        self.manifest.update_tags(output_book, *profile, tags_digest)
+                    else:
+                        self.manifest.record(output_book, *profile, output_file, tags_digest)
+            done = True
+        finally:
+            if self.stager:
+                self.stager.evict(book.aaxc_path)
+            if book in self._leases:
+                self.queue.release(book, self._leases.pop(book), done)
+            self._book_jobs.pop(book, None)
+            if self.metrics:
+                self.metrics.finish(book, self._status(done), [f for f, _ in outputs.values()])
+
+        return '\n'.join(f for f, _ in outputs.values()) or None
+
+    async def _prepare_cover(self, book: Book):
+        '''Point book at the resized variants of its cover, resizing it unless the cover cache already has them. A
+        cover ffmpeg can't decode isn't embedded, players most likely couldn't decode it either.'''
+        if not book.cover_file:
+            return
+        variants = await asyncio.to_thread(self.covers.variants, book.cover_file)
+        if not self.covers.cached(variants):
+            # write and rename so concurrent jobs sharing a cover never see a partial variant
+            temps = tuple(f'{v}.{os.getpid()}.{id(book)}' for v in variants)
+            try:
+                await self.cancellable_exec(*self.covers.resize_command(book.cover_file, temps))
+                for temp, variant in zip(temps, variants):
+                    os.replace(temp, variant)
+            except (CalledProcessError, OSError):
+                self.print(f'Warning: can\'t resize cover {book.cover_file}, only copying it')
+                book.cover_file = None
+                return
+            finally:
+                for temp in temps:
+                    if os.path.exists(temp):
+                        os.remove(temp)
+        book.cover_file, book.full_cover_file = variants
+
+    def _next_ready_book(self) -> Book | None:
+        '''Pop the highest priority book whose metadata has arrived, dropping any whose lookup failed. With a work
+        queue, books another worker holds are deferred and books another worker finished are dropped.'''
+        for i in range(len(self._books) - 1, -1, -1):
+            future = self._metadata_futures[self._books[i]]
+            if not future.done():
+                continue
+            book = self._books.pop(i)
+            del self._metadata_futures[book]
+            key = self._keys.pop(book)
+            if future.cancelled() or future.exception():
+                self._report(future)
+                if self.metrics:
+                    self.metrics.finish(book, self._status(False))
+                if self.stager:
+                    self.stager.evict(book.aaxc_path)
+                continue
+            if not self.queue:
+                return book
+            lease = self.queue.claim(book)
+            if lease:
+                self._leases[book] = lease
+                return book
+            # another worker converts it, a deferred book is staged again if it comes back
+            if self.stager:
+                self.stager.evict(book.aaxc_path)
+            if not self.queue.is_done(book):
+                self._keys[book] = key
+                self._deferred.append(book)
+        return None
+
+    def _prefetch(self):
+        '''Start copying the input of the next book to start into the staging directory, unless a copy is in
+        progress. Copies run one at a time so that the storage the inputs are on reads them sequentially.'''
+        if self._staging and not self._staging[1].done():
+            return
+        aaxc = self.stager.next([b.aaxc_path for b in reversed(self._books)])
+        if not aaxc:
+            return
+        def staged(future: Future):
+            if not future.cancelled() and isinstance(future.exception(), OSError):
+                self.print(f'Warning: can\'t stage {aaxc}, decoding it where it is: {future.exception()}')
+            # the next copy may start
+            self._wakeup.set()
+        self._staging = (aaxc, asyncio.ensure_future(asyncio.to_thread(self.stager.stage, aaxc)))
+        self._staging[1].add_done_callback(staged)
+
+    async def _stage_input(self, book: Book):
+        '''Point book at the staged copy of its input if there is one, waiting for it if it's being copied'''
+        if self._staging and self._staging[0] == book.aaxc_path:
+            # waiting doesn't cancel the copy if the job is cancelled, and a failed copy leaves the original
+            await asyncio.wait((self._staging[1], ))
+        book.input_file = self.stager.path(book.aaxc_path) or book.aaxc_path
+
+    def _status(self, done: bool) -> str:
+        return 'done' if done else 'cancelled' if self.cancelled else 'failed'
+
+    def _retry_deferred(self):
+        '''Requeue deferred books, their leases may have expired in the meantime'''
+        for book in self._deferred:
+            self._metadata_futures[book] = self._loop.create_future()
+            self._metadata_futures[book].set_result(book)
+            # deferred books keep their place in the order
+            bisect.insort(self._books, book, key=self._keys.__getitem__)
+        self._deferred = []
+
+    async def _heartbeat(self):
+        '''Refresh the leases of the running books, cancelling the job of a book whose lease was lost so that two
+        workers never write the same output'''
+        while True:
+            await asyncio.sleep(C.LEASE_HEARTBEAT)
+            for book, lease in tuple(self._leases.items()):
+                if not lease.refresh() and (job := self._book_jobs.get(book)) and not job.done():
+                    self.print(f'Warning: lost work queue lease for {book.aaxc_path}, cancelling its conversion')
+                    job.cancel()
+
+    def _report(self, future: Future):
+        if future.cancelled():
             return
         
         exc = future.exception()
+        if self.cancelled:
+            return
+
         msg = ''
         if exc:
             #can't avoid broken pipe error upon interruption during stdio
-            if isinstance(exc, (OperationCancelled, BrokenPipeError)):
+            if isinstance(exc, (OperationCancelled, BrokenPipeError, ConnectionResetError)):
                 pass
             else:
                 self._failed_jobs += 1
                 if isinstance(exc, CalledProcessError):
                     cmd = ' '.join(quote(arg) for arg in exc.cmd)
                     msg = f'Exec failed with code {exc.returncode}: "{cmd}"'
+                elif isinstance(exc, MetadataUnavailable):
+                    msg = f'Metadata unavailable: {exc}'
+                elif isinstance(exc, WebMError):
+                    msg = f'Retag failed, {exc}'
+                elif isinstance(exc, VerifyError):
+                    msg = f'Verify failed, {exc}'
                 else:
                     msg = f'Task failed successfully:\n{traceback.format_exception(exc)}'
-        elif future.result():
+        elif isinstance(future.result(), str):
             msg = future.result()
         
         if msg:
@@ -230,33 +1305,28 @@ class App:
 
     @property
     def cancelled(self):
-        return self._cancel_event.is_set()
+        return self._cancelled
 
     @property
     def running(self):
         return self._running
 
     def cancel(self):
+        '''Cancel the run, safe to call from a signal handler or another thread'''
         if self.cancelled or not self.running:
             return
         self.print('\nCancelling, please wait…\n')
-        self._cancel_event.set()
-        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._cancelled = True
+        self._loop.call_soon_threadsafe(self._cancel_event.set)
+        if self.stager:
+            self.stager.cancel()
+        self._metadata_executor.shutdown(wait=False, cancel_futures=True)
+        self._discovery_executor.shutdown(wait=False, cancel_futures=True)
 
-    def cancellable_exec(self, *args):
+    async def cancellable_exec(self, *args):
         if self.cancelled:
             raise OperationCancelled()
-        with Popen(args=args, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL) as process:
-            while process.poll() == None:
-                if self.cancellable_sleep():
-                    raise OperationCancelled()
-            if process.returncode:
-                raise CalledProcessError(process.returncode, process.args)
-
-    def cancellable_sleep(self, duration=C.POLLING_INTERVAL) -> bool:
-        if duration == 0:
-            return self.cancelled
-        return self._cancel_event.wait(duration)
+        await self._pipeline(args)
 
     def print(self, *args, **kwargs):
         self._print(*args, progress=False, **kwargs)
@@ -269,8 +1339,8 @@ class App:
         if progress:
             bar_width = term_width / 4
             bar_width = round(bar_width)
-            n_done  = self.n_jobs - self._active_jobs - len(self._books)
-            percent = n_done * 100 / self.n_jobs
+            n_done  = self.n_jobs - len(self._jobs) - len(self._books) - len(self._deferred)
+            percent = n_done * 100 / self.n_jobs if self.n_jobs else 100
             bar = '|' * int(percent / 100 * bar_width - 1) + next(self._progress_iterator)
             args = (f'{f"Progress: {n_done}/{self.n_jobs} [{bar:—<{bar_width}s}] {percent:.2f}%":{term_width}s}', )
             kwargs = {'end': '\r'}
@@ -279,7 +1349,8 @@ class App:
             if self._last_print_was_progress:
                 print(f'{" ":{term_width}s}', end='\r')
             self._last_print_was_progress = False
-            reprint_progress = self.running and not self.cancelled
+            # a plan has no progress to show
+            reprint_progress = self.running and not self.cancelled and not self.plan
         print(*args, **kwargs)
         if reprint_progress:
             self._print(progress=True)
@@ -287,37 +1358,185 @@ class App:
     def run(self):
         if self.running:
             return
-        start_time = datetime.now()
-        self._running = True
-        for aaxc in self.input_files:
-            b = Book(aaxc, self.output_dir)
-            self._books.append(b)
-        self._books.sort(key=lambda b: b.input_duration)
+        status = asyncio.run(self._run())
+        if self.cancelled:
+            sys.exit(1)
+        return status
+
+    async def _plan(self) -> int:
+        '''Print the predicted wall time and disk usage of converting the books found, without converting them. The
+        realtime factor and output size come from the metrics of earlier runs with the same settings, or else from a
+        calibration encode and the nominal bitrate.'''
+        try:
+            await self._discovery
+        except OperationCancelled:
+            return 1
+        if not self._books:
+            return 0 if self._n_found else 1
+        # the predictions are proportional to the audio duration
+        if not any(b.output_duration > 0 for b in self._books):
+            self.print('Nothing to do, the books found have no audio')
+            return 0
+
+        slots = self.concurrency.ceiling if self.concurrency else self.max_threads
+        records = []
+        if self.metrics_file:
+            settings = {k: v for k, v in self.settings.items() if k != 'threads'}
+            records = [r for r in history(self.metrics_file, **settings) if r['realtime_factor'] and r['audio_seconds']]
+        if len(records) >= C.PLAN_MIN_HISTORY:
+            self.print(f'Predicting from {len(records)} earlier conversions in {self.metrics_file}')
+            realtime_factor = statistics.median(r['realtime_factor'] for r in records)
+            byte_rate = statistics.median(r['bytes_out'] / r['audio_seconds'] for r in records)
+        else:
+            try:
+                realtime_factor = await self._calibrate(slots)
+            except OperationCancelled:
+                return 1
+            except CalledProcessError as e:
+                self.print(f'Error: calibration encode failed, {e}')
+                return 1
+            byte_rate = sum(self._nominal_byte_rate(p) for p in self.profiles)
+
+        # outputs that aren't streamed into their container are first written as an intermediate ogg
+        intermediate = sum(self._nominal_byte_rate(p) for p in self.profiles
+                           if p.container != C.Container.OGG and not self._streams(p.container))
+        plan = Plan(self._books, self.policy, slots, realtime_factor, byte_rate, self.segments,
+                    intermediate / sum(self._nominal_byte_rate(p) for p in self.profiles))
+        free = free_space(self.output_dir)
+        self.print('\n'.join(plan.lines(free)))
+        if plan.peak_bytes > free:
+            self.print(f'Warning: the run would need more disk space than is free in {self.output_dir}')
+            return 1
+        return 0
 
-        progress_loops = C.PROGRESS_INTERVAL / C.POLLING_INTERVAL
-        self.n_jobs = len(self._books)
+    def _nominal_byte_rate(self, profile: C.Profile) -> float:
+        '''Output bytes per audio second of profile at its nominal bitrate'''
+        return int(opus_settings(profile.quality)[0]) * 125 * (1 + C.PLAN_CONTAINER_OVERHEAD)
 
-        self.print(f'Enqueued {self.n_jobs} jobs at: {start_time}')
+    async def _calibrate(self, slots: int) -> float:
+        '''Median realtime factor of transcoding the first PLAN_CALIBRATION_DURATION of up to slots of the longest
+        books at once, with the run's profiles, encoder, transfer and loudness measurement'''
+        books = sorted((b for b in self._books if b.output_duration > 0), key=lambda b: b.output_duration,
+                       reverse=True)[:slots]
+        self.print(f'Calibrating with {len(books)} parallel encode{"s" if len(books) > 1 else ""} of '
+                   f'{C.PLAN_CALIBRATION_DURATION / 1000:g}s')
+
+        with tempfile.TemporaryDirectory(prefix='aaxc2opus-plan-') as directory:
+            async def encode(i: int, book: Book) -> float:
+                segment, = book.segments(1, C.PLAN_CALIBRATION_DURATION)
+                # books have no output location before their metadata is fetched
+                book = copy.copy(book)
+                book.output_directory = directory
+                book.output_filename = f'{directory}/{i}'
+                start = time.perf_counter()
+                await self._transcode_span(book, dict.fromkeys(self.profiles), segment)
+                return segment.duration / 1000 / (time.perf_counter() - start)
+
+            factors = await asyncio.gather(*(encode(i, b) for i, b in enumerate(books)))
+        return statistics.median(factors)
+
+    async def _adjust_concurrency(self):
+        '''Resize max_threads to the system load, waking the scheduler when slots were added'''
+        while True:
+            await asyncio.sleep(C.CONCURRENCY_INTERVAL)
+            # only grow while every slot is busy and more books are waiting or may still be found
+            saturated = len(self._jobs) >= self.max_threads and bool(self._books or not self._discovery.done())
+            previous = self.max_threads
+            if reason := self.concurrency.update(saturated):
+                self.max_threads = self.concurrency.limit
+                self.print(f'Concurrency: {previous} -> {self.max_threads} jobs, {reason}')
+                self._wakeup.set()
+
+    async def _progress(self):
+        while True:
+            self._print(progress=True)
+            await asyncio.sleep(C.PROGRESS_INTERVAL)
 
-        i = progress_loops
-        while not self.cancellable_sleep():
-            if i >= progress_loops:
-                i = 0
-                self._print(progress=True)
-            i += 1
+    async def _schedule(self):
+        '''Start jobs as slots free up and metadata arrives, until every book is done or the run is cancelled'''
+        cancel = asyncio.ensure_future(self._cancel_event.wait())
+        retry = None
+        while not self.cancelled:
+            if retry and retry.done():
+                retry = None
+                self._retry_deferred()
 
-            if not self.cancelled:
-                if self._active_jobs < self.max_threads and len(self._books):
-                    self._active_jobs += 1
-                    self._executor.submit(self._process_book, self._books.pop()) \
-                                  .add_done_callback(self._future_done_cb)
+            self._wakeup.clear()
+            while len(self._jobs) < self.max_threads and (book := self._next_ready_book()):
+                self._book_jobs[book] = asyncio.ensure_future(self._process_book(book))
+                self._jobs.add(self._book_jobs[book])
+            if self.stager:
+                self._prefetch()
 
-                if not self._active_jobs:
-                    self._running = False
-                    break
+            if not self._jobs and not self._books and not self._deferred and self._discovery.done():
+                break
+
+            # newly enqueued books or added slots
+            wakeup = asyncio.ensure_future(self._wakeup.wait())
+            waiting = {cancel, wakeup, *self._jobs}
+            if len(self._jobs) < self.max_threads:
+                waiting.update(self._metadata_futures[b] for b in self._books)
+                # books held by other workers come back once their leases could have expired
+                if self._deferred:
+                    retry = retry or asyncio.ensure_future(asyncio.sleep(C.LEASE_HEARTBEAT))
+                    waiting.add(retry)
+                if not self._discovery.done():
+                    waiting.add(self._discovery)
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            wakeup.cancel()
+
+            for job in done & self._jobs:
+                self._jobs.remove(job)
+                self._report(job)
+
+        if not self._discovery.done():
+            self._discovery.cancel()
+            await asyncio.wait((self._discovery, ))
+        elif not self._discovery.cancelled() and self._discovery.exception():
+            self._report(self._discovery)
+
+        # let cancelled jobs terminate their processes and clean up
+        if self._jobs:
+            await asyncio.wait(self._jobs)
+        for job in self._jobs:
+            self._report(job)
+        if self.stager:
+            self.stager.cancel()
+            if self._staging:
+                await asyncio.wait((self._staging[1], ))
+            self.stager.close()
+        cancel.cancel()
+        if retry:
+            retry.cancel()
+
+    async def _run(self):
+        start_time = datetime.now()
+        self._loop = asyncio.get_running_loop()
+        self._cancel_event = asyncio.Event()
+        self._running = True
+        self._wakeup = asyncio.Event()
+        self.n_jobs = 0
+        self._discovery = asyncio.ensure_future(self._discover())
+        if self.plan:
+            status = await self._plan()
+            self._running = False
+            return status
+
+        progress = asyncio.ensure_future(self._progress())
+        heartbeat = asyncio.ensure_future(self._heartbeat()) if self.queue else None
+        adjust = asyncio.ensure_future(self._adjust_concurrency()) if self.concurrency else None
+        await self._schedule()
+        progress.cancel()
+        if adjust:
+            adjust.cancel()
+        if heartbeat:
+            heartbeat.cancel()
+        self._running = False
 
         if self.cancelled:
-            sys.exit(1)
+            return 1
+        if not self.n_jobs:
+            return 0 if self._n_found else 1
 
         end_time = datetime.now()
         duration = (end_time - start_time).total_seconds()
@@ -328,5 +1547,11 @@ class App:
             status = 'successfully'
 
         self.print(f'Finished at {end_time} {status}, elapsed: {duration:.3f}s')
+        if self._n_unchanged:
+            self.print(f'{self._n_unchanged} of {self.n_jobs * len(self.profiles)} outputs already had current tags')
+        if self.verify:
+            self.print(f'{self._n_verified} of {self.n_jobs * len(self.profiles)} outputs verified')
+        if self.metrics:
+            self.print('\n'.join(self.metrics.summary()))
 
         return 1 if self._failed_jobs else 0
\ No newline at end of file
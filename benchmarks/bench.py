@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+'''Offline aaxc2opus benchmarks on synthetic books, with the stub ffmpeg and opusenc in stubs/ on the PATH.
+
+    benchmarks/bench.py [-k substring] [-r repeat] [-o results.json] [--compare baseline.json]
+
+Results are written as JSON, a previous results file given to --compare is printed alongside for comparison.'''
+import asyncio
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import constants as C
+import synthetic
+from app import App
+from book import Book
+from webm import WebMMuxer, chapter_atoms
+
+BENCHMARKS = {}
+'''name -> (setup function, repeat)'''
+
+def benchmark(name: str, repeat: int = 5):
+    '''Register a setup function taking a scratch directory and returning (run function, amount, amount unit). Only
+    run is timed, the rate is amount per second.'''
+    def register(setup):
+        BENCHMARKS[name] = (setup, repeat)
+        return setup
+    return register
+
+def app_args(workdir: str, **overrides) -> Namespace:
+    '''aaxc2opus command line defaults for an offline run in workdir'''
+    args = dict(threads=C.DEFAULT_THREAD_LIMIT,
+                max_threads=None,
+                container=C.Container.OGG,
+                quality=C.Quality.MONO_VOICE,
+                segments=1,
+                transfer=C.Transfer.PIPE,
+                encoder=C.Encoder.OPUSENC,
+                intermediate=False,
+                mkvmerge=False,
+                loudness=None,
+                retag=False,
+                verify=False,
+                manifest=None,
+                force=True,
+                queue=None,
+                recursive=False,
+                watch=False,
+                order=None,
+                priority=None,
+                predict=False,
+                plan=False,
+                profile=None,
+                stage_dir=None,
+                stage_budget=C.STAGE_BUDGET,
+                stage_depth=C.STAGE_DEPTH,
+                cache_dir=f'{workdir}/cache',
+                cache_ttl=C.METADATA_CACHE_TTL,
+                offline=True,
+                audnexus_url=C.AUDNEXUS_URL,
+                library_export=None,
+                metrics=None,
+                prometheus=None,
+                quiet=True,
+                output=f'{workdir}/out',
+                inputs=[f'{workdir}/in'])
+    args.update(overrides)
+    return Namespace(**args)
+
+def make_books(workdir: str, n: int, **kwargs) -> list[str]:
+    '''n synthetic books in workdir/in with cached metadata in workdir/cache'''
+    os.makedirs(f'{workdir}/in', exist_ok=True)
+    os.makedirs(f'{workdir}/out', exist_ok=True)
+    paths = [synthetic.make_book(f'{workdir}/in', i, **kwargs) for i in range(n)]
+    synthetic.make_metadata_cache(f'{workdir}/cache', [f'B{i:09d}' for i in range(n)])
+    return paths
+
+def imported_book(path: str, workdir: str) -> Book:
+    book = Book(path, f'{workdir}/out')
+    book.import_metadata(dict(synthetic.METADATA, asin=book.asin, title=f'Synthetic Book {book.asin}'))
+    os.makedirs(book.output_directory, exist_ok=True)
+    return book
+
+for label, kwargs in (('flat-30', dict(n_chapters=30)),
+                      ('flat-300', dict(n_chapters=300)),
+                      ('nested-300', dict(n_chapters=300, nested=10))):
+    @benchmark(f'book_parse[{label}]')
+    def book_parse(workdir, kwargs=kwargs):
+        paths = make_books(workdir, 50, **kwargs)
+        return lambda: [Book(p, workdir) for p in paths], len(paths), 'books'
+
+for chapter_format in C.ChapterFormat:
+    @benchmark(f'render_chapters[{chapter_format.name.lower()}]')
+    def render_chapters(workdir, chapter_format=chapter_format):
+        books = [imported_book(p, workdir) for p in make_books(workdir, 20, n_chapters=300, nested=10)]
+        # rendering is cached per book, so each run renders fresh copies of the tables
+        tables = [b.chapters for b in books]
+        def run():
+            for t in tables:
+                t._rendered.clear()
+                t.render(chapter_format)
+        return run, len(books), 'books'
+
+@benchmark('render_chapters[webm-atoms]')
+def render_webm_atoms(workdir):
+    books = [imported_book(p, workdir) for p in make_books(workdir, 20, n_chapters=300, nested=10)]
+    return lambda: [chapter_atoms(b.chapters) for b in books], len(books), 'books'
+
+for transfer in C.Transfer:
+    @benchmark(f'transcode_throughput[{transfer}]', repeat=3)
+    def transcode_throughput(workdir, transfer=transfer):
+        # one hour of mono 22050Hz pcm through the stub decoder and encoder
+        book = imported_book(make_books(workdir, 1, n_chapters=60)[0], workdir)
+        app = App(app_args(workdir, transfer=transfer))
+        pcm_mb = book.output_duration / 1000 * synthetic.PCM_RATE * 2 / 1e6
+        return lambda: run_in_app(app, app._transcode_book(book, {app.profiles[0]: None})), pcm_mb, 'pcm MB'
+
+@benchmark('transcode_throughput[ffmpeg-libopus]', repeat=3)
+def transcode_throughput_ffmpeg(workdir):
+    book = imported_book(make_books(workdir, 1, n_chapters=60)[0], workdir)
+    app = App(app_args(workdir, encoder=C.Encoder.FFMPEG))
+    pcm_mb = book.output_duration / 1000 * synthetic.PCM_RATE * 2 / 1e6
+    return lambda: run_in_app(app, app._transcode_book(book, {app.profiles[0]: None})), pcm_mb, 'pcm MB'
+
+@benchmark('webm_mux', repeat=3)
+def webm_mux(workdir):
+    # ten hours of 20ms packets, about 36MB of ogg
+    book = imported_book(make_books(workdir, 1, n_chapters=100, chapter_ms=360_000)[0], workdir)
+    ogg = io.BytesIO()
+    synthetic.write_ogg_opus(ogg, book.output_duration / 1000)
+    muxer = WebMMuxer(f'{book.output_filename}.webm', book.metadata, book.chapters, book.cover_file)
+    def run():
+        ogg.seek(0)
+        muxer.mux(ogg)
+    return run, ogg.getbuffer().nbytes / 1e6, 'ogg MB'
+
+@benchmark('schedule[300-books]')
+def schedule(workdir):
+    # no-op codecs, so that only scheduling, metadata lookup and process startup are measured
+    make_books(workdir, 300)
+    def run():
+        path = os.environ['PATH']
+        os.environ['PATH'] = f'{BENCH_DIR}/stubs/null{os.pathsep}{path}'
+        try:
+            if App(app_args(workdir, threads=8)).run():
+                raise RuntimeError('scheduling benchmark run failed')
+        finally:
+            os.environ['PATH'] = path
+    return run, 300, 'books'
+
+@benchmark('queue[4-workers]', repeat=1)
+def queue(workdir):
+    # separate aaxc2opus processes sharing a work queue directory, with no-op codecs so that they mostly contend for
+    # leases. Each book has to be converted by exactly one of them. Workers retry the books others held only after a
+    # heartbeat interval, which the time includes.
+    n_books, n_workers = 60, 4
+    make_books(workdir, n_books)
+    def run():
+        shutil.rmtree(f'{workdir}/queue', ignore_errors=True)
+        metrics = [f'{workdir}/metrics-{i}.jsonl' for i in range(n_workers)]
+        for file in metrics:
+            if os.path.exists(file):
+                os.remove(file)
+        env = dict(os.environ, PATH=f'{BENCH_DIR}/stubs/null{os.pathsep}{os.environ["PATH"]}')
+        workers = [subprocess.Popen((sys.executable, f'{REPO_DIR}/aaxc2opus', '--quiet', '--force', '--offline',
+                                     '--cache-dir', f'{workdir}/cache', '--queue', f'{workdir}/queue',
+                                     '--container', 'ogg', '--threads', '2', '--metrics', file,
+                                     f'{workdir}/out', f'{workdir}/in'),
+                                    env=env)
+                   for file in metrics]
+        if any([w.wait() for w in workers]):
+            raise RuntimeError('work queue worker failed')
+        converted = []
+        for file in metrics:
+            with open(file) as f:
+                converted += [r['asin'] for r in map(json.loads, f) if r['status'] == 'done']
+        if sorted(converted) != sorted(set(converted)) or len(converted) != n_books:
+            raise RuntimeError(f'work queue converted {len(converted)} books, {len(set(converted))} distinct, '
+                               f'of {n_books}')
+    return run, n_books, 'books'
+
+def run_in_app(app: App, coro):
+    '''Run an App coroutine outside of App.run'''
+    async def main():
+        app._loop = asyncio.get_running_loop()
+        app._cancel_event = asyncio.Event()
+        return await coro
+    return asyncio.run(main())
+
+def measure(setup, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory(prefix='aaxc2opus-bench-') as workdir:
+        run, amount, unit = setup(workdir)
+        run() # warm up caches and imports
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+    return {'median': median,
+            'min': min(times),
+            'times': times,
+            'amount': amount,
+            'unit': unit,
+            'rate': amount / median}
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(('git', 'rev-parse', '--short', 'HEAD'), cwd=REPO_DIR, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+def main() -> int:
+    parser = ArgumentParser(description='Run the offline aaxc2opus benchmarks.')
+    parser.add_argument('-k', '--filter',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('-r', '--repeat',
+                        type=int,
+                        help='timed runs per benchmark, overrides the per benchmark default')
+    parser.add_argument('-o', '--output',
+                        help='write the results as JSON to this file')
+    parser.add_argument('--compare',
+                        help='previous JSON results to compare against')
+    args = parser.parse_args()
+
+    os.environ['PATH'] = f'{BENCH_DIR}/stubs{os.pathsep}{os.environ["PATH"]}'
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    print(f'{"benchmark":36s}{"median":>10s}{"rate":>20s}{"baseline":>10s}{"change":>9s}')
+    for name, (setup, repeat) in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        result = results[name] = measure(setup, args.repeat or repeat)
+        line = f'{name:36s}{result["median"]:9.4f}s{result["rate"]:10.1f} {result["unit"] + "/s":>9s}'
+        if name in baseline:
+            change = result['median'] / baseline[name]['median'] - 1
+            line += f'{baseline[name]["median"]:9.4f}s{change:+8.1%}'
+        print(line, flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+'''Synthetic aaxc2opus inputs: audible-cli style book files, cached audnexus metadata and pcm/ogg opus payloads'''
+import json
+import os
+import struct
+import time
+
+CONTENT_FORMAT = 'AAX_22_64'
+'''content format of every synthetic book, 22050Hz 64kbps'''
+PCM_RATE = 22050
+'''decoded sample rate of the synthetic books'''
+PART_MS = 5000
+'''length of the heading chapter of each part of a nested book'''
+OPUS_FRAME = bytes([0xf8]) + bytes(79)
+'''20ms fullband celt packet, 80 bytes is about what 32kbps voice produces'''
+OPUS_FRAME_SAMPLES = 960
+'''48kHz samples per OPUS_FRAME'''
+
+METADATA = {
+    'authors': [{'name': 'Synthetic Author'}],
+    'narrators': [{'name': 'Synthetic Narrator'}],
+    'genres': [{'name': 'Benchmarks', 'type': 'genre'}, {'name': 'Synthetic', 'type': 'tag'}],
+    'language': 'english',
+    'releaseDate': '2020-01-01T00:00:00.000Z',
+    'summary': 'A synthetic book.',
+    'publisherName': 'Synthetic Publisher'
+}
+'''audnexus book json, title and asin are filled in per book'''
+
+def make_book(directory: str, index: int, n_chapters: int = 30, chapter_ms: int = 60_000, nested: int = 0,
+              intro_ms: int = 2000, outro_ms: int = 3000) -> str:
+    '''Write the voucher, chapters json, cover and a placeholder aaxc of one book and return the aaxc path. With
+    nested > 0 the chapters are grouped into parts of that many chapters.'''
+    asin = f'B{index:09d}'
+    base = f'{directory}/Synthetic_Book_{index:05d}'
+
+    with open(f'{base}-{CONTENT_FORMAT}.voucher', 'w') as f:
+        json.dump({'content_license': {'asin': asin,
+                                       'content_metadata': {'content_reference': {'content_format': CONTENT_FORMAT}},
+                                       'license_response': {'key': '00' * 16, 'iv': '11' * 16}}}, f)
+    with open(f'{base}-{CONTENT_FORMAT}.aaxc', 'wb') as f:
+        f.write(bytes(4096))
+    with open(f'{base}_(500).jpg', 'wb') as f:
+        f.write(make_jpeg())
+
+    chapters = []
+    offset = 0
+    for i in range(n_chapters):
+        if nested and i % nested == 0:
+            # audible parts are a short heading chapter followed by the nested ones
+            chapters.append({'title': f'Part {i // nested + 1}', 'start_offset_ms': offset, 'length_ms': PART_MS,
+                             'chapters': []})
+            offset += PART_MS
+        chapter = {'title': f'Chapter {i + 1}', 'start_offset_ms': offset, 'length_ms': chapter_ms}
+        (chapters[-1]['chapters'] if nested else chapters).append(chapter)
+        offset += chapter_ms
+    with open(f'{base}-chapters.json', 'w') as f:
+        json.dump({'content_metadata': {'chapter_info': {'brandIntroDurationMs': intro_ms,
+                                                         'brandOutroDurationMs': outro_ms,
+                                                         'runtime_length_ms': offset,
+                                                         'chapters': chapters}}}, f)
+
+    return f'{base}-{CONTENT_FORMAT}.aaxc'
+
+def make_metadata_cache(directory: str, asins: list[str]) -> None:
+    '''Write fresh MetadataCache entries so a run can use offline mode'''
+    os.makedirs(directory, exist_ok=True)
+    for asin in asins:
+        with open(f'{directory}/{asin}.json', 'w') as f:
+            json.dump({'data': dict(METADATA, asin=asin, title=f'Synthetic Book {asin}'),
+                       'etag': None,
+                       'last_modified': None,
+                       'fetched': time.time()}, f)
+
+def make_jpeg() -> bytes:
+    '''Smallest well formed jpeg framing, the contents are never decoded'''
+    return b'\xff\xd8\xff\xe0' + struct.pack('>H', 16) + b'JFIF\0\x01\x01\0\0\x01\0\x01\0\0' + b'\xff\xd9'
+
+def wav_header(rate: int = PCM_RATE, channels: int = 1) -> bytes:
+    '''Streaming s16le wav header with unknown sizes, as ffmpeg writes to a pipe'''
+    return (b'RIFF' + struct.pack('<I', 0xffffffff) + b'WAVE' +
+            b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, rate, rate * channels * 2, channels * 2, 16) +
+            b'data' + struct.pack('<I', 0xffffffff))
+
+def parse_wav_header(header: bytes) -> tuple[int, int]:
+    '''(sample rate, channels) of a wav_header()'''
+    _, channels, rate = struct.unpack_from('<HHI', header, 20)
+    return rate, channels
+
+def _crc_table() -> list[int]:
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7 if crc & 0x80000000 else crc << 1) & 0xffffffff
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _crc_table()
+
+def ogg_crc(data: bytes) -> int:
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xffffffff) ^ _CRC_TABLE[(crc >> 24) ^ b]
+    return crc
+
+class OggOpusWriter:
+    '''Minimal Ogg Opus stream writer, one page per 50 packets. Page checksums are slow in python and are left zero
+    unless checksum, the stubs and the native muxer don't verify them.'''
+    def __init__(self, stream, channels: int = 1, pre_skip: int = 312, serial: int = 0x5eed, checksum=False) -> None:
+        self._stream = stream
+        self._checksum = checksum
+        self._serial = serial
+        self._sequence = 0
+        self._granule = 0
+        self._packets = []
+        head = b'OpusHead' + struct.pack('<BBHIhB', 1, channels, pre_skip, 48000, 0, 0)
+        tags = b'OpusTags' + struct.pack('<I', 9) + b'synthetic' + struct.pack('<I', 0)
+        self._page((head, ), 0, 0x02)
+        self._page((tags, ), 0, 0)
+
+    def write(self, packet: bytes, samples: int) -> None:
+        self._packets.append(packet)
+        self._granule += samples
+        if len(self._packets) == 50:
+            self._page(self._packets, self._granule, 0)
+            self._packets = []
+
+    def close(self) -> None:
+        self._page(self._packets, self._granule, 0x04)
+        self._stream.flush()
+
+    def _page(self, packets, granule: int, header_type: int) -> None:
+        lacing = bytearray()
+        for packet in packets:
+            lacing += b'\xff' * (len(packet) // 255) + bytes((len(packet) % 255, ))
+        body = b''.join(packets)
+        header = struct.pack('<4sBBqIIIB', b'OggS', 0, header_type, granule, self._serial, self._sequence, 0,
+                             len(lacing)) + lacing
+        crc = ogg_crc(header + body) if self._checksum else 0
+        self._stream.write(header[:22] + struct.pack('<I', crc) + header[26:] + body)
+        self._sequence += 1
+
+def write_ogg_opus(stream, seconds: float, channels: int = 1, checksum=False) -> None:
+    '''Write a synthetic ogg opus stream of silent 20ms packets lasting seconds'''
+    writer = OggOpusWriter(stream, channels, checksum=checksum)
+    for _ in range(round(seconds * 50)):
+        writer.write(OPUS_FRAME, OPUS_FRAME_SAMPLES)
+    writer.close()
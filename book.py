@@ -1,13 +1,17 @@
+import hashlib
 import html
+import itertools
 import json
 import os
+from array import array
 from dataclasses import dataclass
-from glob import glob
 
 import constants as C
-from util import clean_filename, clean_text, ffm_escape, ms_to_fftime
+from library import find_cover
+from ogg import OPUS_SAMPLE_RATE
+from util import clean_filename, clean_text, ffm_escape, file_sha256, ms_to_fftime
 
-@dataclass
+@dataclass(slots=True)
 class Chapter:
     '''Represents a single chapter within a Book()'''
     index: int
@@ -20,28 +24,116 @@ class Chapter:
     '''start offset relative to Book() input file'''
     output_offset: int
     '''start offset relative to Book() output file'''
+    parent: int = None
+    '''index of the enclosing chapter, if this chapter is nested'''
 
+@dataclass(slots=True)
+class Segment:
+    '''A part of a Book() transcoded on its own and joined with the others afterwards. The decoder trims it to exact
+    48 kHz sample counts, ending on an Opus packet boundary of the whole book, plus packets of audio around it which
+    the encoder needs to converge and the join drops again.'''
+    index: int
+    '''segment index'''
+    duration: int
+    '''duration in milliseconds of the part of the output it makes up'''
+    seek: int
+    '''millisecond input offset the decoder seeks to, on a grid both input sample rates divide exactly'''
+    start: int
+    '''48 kHz samples after the seek the segment's audio starts'''
+    length: int
+    '''48 kHz samples of audio encoded'''
+    skip: int
+    '''48 kHz samples at the start of the encoded segment the join drops'''
+    keep: int | None
+    '''48 kHz samples after skip the join keeps, None to keep the rest'''
+
+class ChapterTable:
+    '''Chapters of a Book() in flattened pre-order, a nested chapter follows its parent and its earlier siblings'
+    subtrees. The fields are kept in arrays and Chapter() rows are built on access. Rendered chapter metadata is
+    cached per ChapterFormat.'''
+    __slots__ = ('_titles', '_durations', '_input_offsets', '_output_offsets', '_parents', '_ends', '_rendered')
+
+    def __init__(self, titles: list[str], durations: list[int], input_offsets: list[int], output_offsets: list[int],
+                 parents: list[int | None]) -> None:
+        self._titles = tuple(titles)
+        self._durations = array('q', durations)
+        self._input_offsets = array('q', input_offsets)
+        self._output_offsets = array('q', output_offsets)
+        self._parents = array('q', (-1 if p is None else p for p in parents))
+        self._rendered = {}
+
+        # end of each chapter including its nested chapters, in one pass since children come after their parent
+        self._ends = array('q', (o + d for o, d in zip(self._output_offsets, self._durations)))
+        for i in range(len(self._titles) - 1, -1, -1):
+            parent = self._parents[i]
+            if parent >= 0 and self._ends[i] > self._ends[parent]:
+                self._ends[parent] = self._ends[i]
+
+    def __len__(self) -> int:
+        return len(self._titles)
+
+    def __getitem__(self, index: int) -> Chapter:
+        if index < 0:
+            index += len(self._titles)
+        parent = self._parents[index]
+        return Chapter(index,
+                       self._titles[index],
+                       self._durations[index],
+                       self._input_offsets[index],
+                       self._output_offsets[index],
+                       None if parent < 0 else parent)
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self._titles)))
+
+    def end(self, index: int) -> int:
+        '''output end offset of chapter index, including its nested chapters'''
+        return self._ends[index]
 
-    def get_metadata(self, container=C.Container.OGG) -> any:
-        match container:
-            case C.Container.MP4:
-                return C.FFMPEG_CHAPTER_FMT.format(start=self.output_offset,
-                                                   end=self.output_offset + self.duration,
-                                                   title=ffm_escape(self.title))
-
-            case C.Container.WEBM:
-                return C.MATROSKA_CHAPTER_ATOM_FMT.format(uid=self.index+1,
-                                                          start=ms_to_fftime(self.output_offset),
-                                                          end=ms_to_fftime(self.output_offset + self.duration),
-                                                          title=html.escape(self.title))
-            case C.Container.OGG:
-                return (f'CHAPTER{self.index:03d}={ms_to_fftime(self.output_offset)}',
-                        f'CHAPTER{self.index:03d}NAME={self.title}')
+    def nested(self, render) -> list:
+        '''Render the chapter tree bottom up in linear time. render(chapter, end, rendered nested chapters) is called
+        once per chapter, the rendered top level chapters are returned in order.'''
+        pending = {}
+        top = []
+        for i in range(len(self._titles) - 1, -1, -1):
+            rendered = render(self[i], self._ends[i], pending.pop(i, [])[::-1])
+            parent = self._parents[i]
+            (pending.setdefault(parent, []) if parent >= 0 else top).append(rendered)
+        return top[::-1]
+
+    def render(self, format: C.ChapterFormat) -> str | tuple[str, ...]:
+        '''Chapter metadata for every chapter, rendered on first use'''
+        if format in self._rendered:
+            return self._rendered[format]
+
+        rows = zip(itertools.count(), self._titles, self._output_offsets, self._durations)
+        match format:
+            case C.ChapterFormat.FFMPEG:
+                rendered = '\n'.join(C.FFMPEG_CHAPTER_FMT.format(start=start,
+                                                                 end=start + duration,
+                                                                 title=ffm_escape(title))
+                                     for _, title, start, duration in rows)
+            case C.ChapterFormat.MATROSKA:
+                rendered = '\n'.join(self.nested(_matroska_atom))
+            case C.ChapterFormat.VORBIS:
+                rendered = tuple(itertools.chain.from_iterable((f'CHAPTER{i:03d}={ms_to_fftime(start)}',
+                                                                f'CHAPTER{i:03d}NAME={title}')
+                                                               for i, title, start, _ in rows))
             case other:
                 return None
 
+        self._rendered[format] = rendered
+        return rendered
+
+def _matroska_atom(chapter: Chapter, end: int, atoms: list[str]) -> str:
+    return C.MATROSKA_CHAPTER_ATOM_FMT.format(uid=chapter.index+1,
+                                              start=ms_to_fftime(chapter.output_offset),
+                                              end=ms_to_fftime(end),
+                                              title=html.escape(chapter.title),
+                                              atoms=''.join(f'\n{a}' for a in atoms))
+
 class Book:
-    def __init__(self, aaxc_path: str, output_directory: str) -> None:
+    def __init__(self, aaxc_path: str, output_directory: str, listing: frozenset[str] = None) -> None:
         (location, filename) = os.path.split(aaxc_path)
         (filename, ext) = os.path.splitext(filename)
 
@@ -58,6 +150,10 @@ class Book:
 
         self.aaxc_path = aaxc_path
         '''path to the input aaxc file'''
+        self.input_file = aaxc_path
+        '''aaxc file the decoder reads, a local copy of aaxc_path while the book's input is staged'''
+        self.content_format = content_reference['content_format']
+        '''audible content format, e.g. "AAX_44_128"'''
         self.input_sample_rate = 22050 if sr == '22' else 44100 if sr == '44' else None
         '''aaxc sample rate'''
         self.input_bit_rate = int(br)
@@ -77,10 +173,15 @@ class Book:
         self.input_base_filename = f"{location}/{filename.replace(filename_suffix, '')}"
         '''common filename prefix between aaxc, voucher, chapters, and cover files'''
 
-        pic = glob(f'{self.input_base_filename}_(*).jpg')
+        # a library scan passes the directory listing it already has, saving a listing per book
+        if listing is None:
+            listing = os.listdir(location or '.')
+        pic = find_cover(os.path.basename(self.input_base_filename), listing)
 
-        self.cover_file = pic[-1] if pic else None
-        '''cover jpg file associated with this aaxc, if any'''
+        self.cover_file = f'{location}/{pic}' if pic else None
+        '''cover jpg file embedded in the output(s), the original until the cover stage swaps in the resized one'''
+        self.full_cover_file = self.cover_file
+        '''cover jpg file copied next to the output(s) as cover.jpg'''
         self.metadata = {'asin': self.asin}
         '''dict containing metadata tags for the output file(s), only contains 'asin' until metadata import'''
 
@@ -93,9 +194,11 @@ class Book:
         self.output_directory = None
         '''full destination output directory, only valid after metadata import'''
         self.chapters = self._load_chapters()
-        '''a tuple containing Chapter() entries'''
+        '''ChapterTable of the book's chapters'''
+        self.loudness = None
+        '''Loudness measured while transcoding, or recorded in the manifest when retagging'''
 
-    def _load_chapters(self):
+    def _load_chapters(self) -> ChapterTable:
         with open(f'{self.input_base_filename}-chapters.json','r') as cf:
             chapters_json = json.load(cf)['content_metadata']['chapter_info']
 
@@ -104,37 +207,86 @@ class Book:
         self.input_duration     = int(chapters_json['runtime_length_ms'])
         self.output_duration    = self.input_duration - self.input_start_offset - self.input_end_offset
 
-        # for chapters mapping source to output:
-        # -first chapter must be offset by start offset
+        # chapters are clipped to the part of the input that is transcoded:
+        # -chapters starting within the intro, i.e. the first one and nested chapters at its start, start after it
+        # -chapters ending within the outro, i.e. the last one, end before it
         # for chapters referencing output file:
-        # -first chapter must start at 0
-        # -all other chapters must be offset by start offset
-        # both:
-        # -first chapter duration must be shortened by start offset
-        # -last chapter duration must be shortened by end trim
-        def flatten(node: dict, prefix: str = '', chapter_list: list[Chapter] = []):
-            #FIXME: matroska supports this natively
+        # -all chapters must be offset by start offset
+        start, end = self.input_start_offset, self.input_duration - self.input_end_offset
+        titles, durations, input_offsets, output_offsets, parents = [], [], [], [], []
+
+        def flatten(node: dict, prefix: str = '', parent: int = None):
             #Handles recursively traversing the chapter tree when each book has it's own chapter heading. Produces
             # output like "Book 2: Chapter 3" instead of having multiple "Chapter 3" in a single file if use_combined_chapter_names
             # is True. Multi-book files don't always have nested or even per-book chapters.
             for item in node:
-                index = int(len(chapter_list))
+                index = len(titles)
                 title = f"{prefix}{clean_text(item['title'])}"
                 offset = int(item['start_offset_ms'])
-                duration = int(item['length_ms'])
-                if index == 0:
-                    duration -= self.input_start_offset
-                    chapter_list.append(Chapter(index, title, duration, self.input_start_offset, 0))
-                else:
-                    chapter_list.append(Chapter(index, title, duration, offset, offset - self.input_start_offset))
+                clipped = min(max(offset, start), end)
+                titles.append(title)
+                durations.append(max(min(offset + int(item['length_ms']), end) - clipped, 0))
+                input_offsets.append(clipped)
+                output_offsets.append(clipped - start)
+                parents.append(parent)
                 if 'chapters' in item:
-                    flatten(item['chapters'], f'{title}: ' if self._use_combined_chapter_names else '', chapter_list)
-            return chapter_list
+                    flatten(item['chapters'], f'{title}: ' if self._use_combined_chapter_names else '', index)
 
-        chapter_list = flatten(chapters_json['chapters'])
-        chapter_list[-1].duration -= self.input_end_offset
+        flatten(chapters_json['chapters'])
 
-        return tuple(chapter_list)
+        return ChapterTable(titles, durations, input_offsets, output_offsets, parents)
+
+    def segments(self, n: int, limit: int = None) -> tuple[Segment, ...]:
+        '''Split the book along chapter boundaries into at most n segments of roughly equal duration, or only its first
+        limit milliseconds. Each cut is moved to the Opus packet boundary nearest to the chapter boundary that the
+        whole book encoded at once would have, so that the joined segments keep their packets in place and end up
+        exactly as long as the book.'''
+        rate = OPUS_SAMPLE_RATE // 1000
+        total = min(self.output_duration, limit or self.output_duration) * rate
+        preroll = C.SEGMENT_PREROLL * C.OPUS_FRAME - C.OPUS_PRE_SKIP
+        cuts = [0]
+        for offset in self._chapter_cuts(n):
+            # packet k of the whole book ends k + 1 frames in, less the pre-skip
+            cut = round((offset * rate + C.OPUS_PRE_SKIP) / C.OPUS_FRAME) * C.OPUS_FRAME - C.OPUS_PRE_SKIP
+            # the preroll has to fit in the input and the next segment has to outlast its lead-out
+            if (cut > cuts[-1] and self.input_start_offset * rate + cut >= preroll
+                    and total - cut >= C.SEGMENT_LEAD_OUT * C.OPUS_FRAME):
+                cuts.append(cut)
+        cuts.append(total)
+
+        segments = []
+        for i, (cut, next_cut) in enumerate(itertools.pairwise(cuts)):
+            last = i == len(cuts) - 2
+            start = self.input_start_offset * rate + cut - (preroll if i else 0)
+            end = self.input_start_offset * rate + next_cut + (0 if last else C.SEGMENT_LEAD_OUT * C.OPUS_FRAME)
+            # 20 ms are a whole number of samples at every input rate, so the seek lands on a sample
+            seek = start // C.OPUS_FRAME * C.OPUS_FRAME // rate
+            segments.append(Segment(i,
+                                    (next_cut - cut) // rate,
+                                    seek,
+                                    start - seek * rate,
+                                    end - start,
+                                    preroll + C.OPUS_PRE_SKIP if i else 0,
+                                    None if last else next_cut - cut + (0 if i else C.OPUS_PRE_SKIP)))
+        return tuple(segments)
+
+    def _chapter_cuts(self, n: int) -> list[int]:
+        '''Output offsets of the chapter boundaries splitting the book into at most n spans of roughly equal duration'''
+        n = max(1, min(n, len(self.chapters)))
+        target = self.output_duration / n
+        cuts = []
+        for i in range(len(self.chapters) - 1):
+            c = self.chapters[i]
+            if len(cuts) == n - 1:
+                break
+            # cut at whichever chapter boundary lands closest to this span's share, or when each span still left
+            # needs one of the remaining chapters
+            goal = target * (len(cuts) + 1)
+            end = c.output_offset + c.duration
+            next_end = end + self.chapters[i + 1].duration
+            if next_end - goal > goal - end or len(self.chapters) - i - 1 == n - len(cuts) - 1:
+                cuts.append(end)
+        return cuts
 
     def import_metadata(self, js: dict) -> None:
         # sort mononyms last to work around "lastname, firstname" detection in abs
@@ -169,16 +321,20 @@ class Book:
         tags = C.DELIM_GENRE.join(tags)
         
         self.metadata.update({
-            'language': clean_text(js['language']),
+            'language': clean_text(js.get('language', '')),
             'artist': authors,
             'composer': narrators,
             'genre': genre,
             'tags': tags,
             'date': js['releaseDate'][:10],
             'title': clean_text(js['title']),
-            'description': clean_text(js['summary']),
-            'publisher': clean_text(js['publisherName'])
+            'description': clean_text(js.get('summary', '')),
+            'publisher': clean_text(js.get('publisherName', ''))
         })
+        # not every metadata provider has these
+        for key in ('language', 'description', 'publisher'):
+            if not self.metadata[key]:
+                del self.metadata[key]
 
         conditional_meta = {}
         if 'seriesPrimary' in js and 'position' in js['seriesPrimary']:
@@ -191,3 +347,11 @@ class Book:
         filename_prefix = clean_filename(self.metadata['title'])
         self.output_directory = f'{self.output_base_directory}/{clean_filename(authors)}/{filename_prefix}'
         self.output_filename = f'{self.output_directory}/{filename_prefix}'
+
+    def tags_digest(self) -> str:
+        '''Digest of the metadata, chapters and cover, everything an output is tagged with'''
+        digest = hashlib.sha256(json.dumps(self.metadata, sort_keys=True).encode())
+        digest.update(self.chapters.render(C.ChapterFormat.MATROSKA).encode())
+        if self.cover_file:
+            digest.update(file_sha256(self.cover_file).digest())
+        return digest.hexdigest()
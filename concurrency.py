@@ -0,0 +1,114 @@
+import os
+
+import constants as C
+
+class Sample:
+    '''One observation of the system load, fields are None where the platform doesn't provide them'''
+    __slots__ = ('cpu', 'iowait', 'load', 'available_memory', 'write_backlog')
+
+    def __init__(self, cpu: float = None, iowait: float = None, load: float = None, available_memory: float = None,
+                 write_backlog: int = None) -> None:
+        self.cpu = cpu
+        '''busy fraction of all cpus since the previous sample'''
+        self.iowait = iowait
+        '''fraction of cpu time spent waiting for io since the previous sample'''
+        self.load = load
+        '''1 minute load average per cpu'''
+        self.available_memory = available_memory
+        '''available fraction of memory'''
+        self.write_backlog = write_backlog
+        '''bytes of dirty and writeback pages'''
+
+class ConcurrencyController:
+    '''Sizes the number of concurrent jobs from cpu utilization, load average, available memory and the disk write
+    backlog. Jobs are added one at a time while the cpus have headroom, or doubled while they are mostly idle, and
+    removed one at a time under load or io pressure, or halved when memory runs low. Only the limit changes, running
+    jobs are never stopped.'''
+    def __init__(self, ceiling: int = None, initial: int = C.DEFAULT_THREAD_LIMIT) -> None:
+        self.ceiling = max(1, ceiling or os.cpu_count() or 1)
+        '''hard limit on concurrent jobs'''
+        self.limit = max(1, min(initial, self.ceiling))
+        '''current concurrent job limit'''
+        self._cpus = os.cpu_count() or 1
+        self._stat = self._read_stat()
+        self._settle = 0
+
+    def update(self, saturated: bool) -> str | None:
+        '''Take a sample and adjust limit, returns the reason if it changed. Growing only happens while saturated,
+        i.e. all current slots are busy and books are waiting.'''
+        if self._settle:
+            # let the processes of the last change show up in the next samples before judging it
+            self._settle -= 1
+            self.sample()
+            return None
+
+        s = self.sample()
+        busy = s.cpu if s.cpu is not None else s.load
+        old = self.limit
+        if s.available_memory is not None and s.available_memory < C.CONCURRENCY_MIN_AVAILABLE_MEMORY:
+            self.limit = max(1, self.limit // 2)
+            reason = f'{s.available_memory:.0%} of memory available'
+        elif s.write_backlog is not None and s.write_backlog > C.CONCURRENCY_MAX_WRITE_BACKLOG:
+            self.limit = max(1, self.limit - 1)
+            reason = f'{s.write_backlog / 2**20:.0f}MiB waiting to be written to disk'
+        elif s.iowait is not None and s.iowait > C.CONCURRENCY_MAX_IOWAIT:
+            self.limit = max(1, self.limit - 1)
+            reason = f'{s.iowait:.0%} io wait'
+        elif s.load is not None and s.load > C.CONCURRENCY_MAX_LOAD:
+            self.limit = max(1, self.limit - 1)
+            reason = f'load average {s.load * self._cpus:.1f} on {self._cpus} cpus'
+        elif saturated and busy is not None and busy < C.CONCURRENCY_TARGET_CPU:
+            self.limit = min(self.ceiling, self.limit * 2 if busy < C.CONCURRENCY_TARGET_CPU / 2 else self.limit + 1)
+            reason = f'{busy:.0%} cpu busy'
+        else:
+            return None
+
+        if self.limit == old:
+            return None
+        self._settle = C.CONCURRENCY_SETTLE
+        return reason
+
+    def sample(self) -> Sample:
+        sample = Sample()
+        try:
+            sample.load = os.getloadavg()[0] / self._cpus
+        except OSError:
+            pass
+
+        stat = self._read_stat()
+        if stat and self._stat:
+            delta = [new - old for new, old in zip(stat, self._stat)]
+            total = sum(delta)
+            if total > 0:
+                # user nice system idle iowait irq softirq steal
+                sample.cpu = 1 - (delta[3] + delta[4]) / total
+                sample.iowait = delta[4] / total
+        self._stat = stat
+
+        meminfo = self._read_meminfo()
+        if 'MemAvailable' in meminfo and meminfo.get('MemTotal'):
+            sample.available_memory = meminfo['MemAvailable'] / meminfo['MemTotal']
+        if 'Dirty' in meminfo and 'Writeback' in meminfo:
+            sample.write_backlog = meminfo['Dirty'] + meminfo['Writeback']
+        return sample
+
+    @staticmethod
+    def _read_stat() -> list[int] | None:
+        try:
+            with open('/proc/stat') as f:
+                return [int(v) for v in f.readline().split()[1:9]]
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _read_meminfo() -> dict[str, int]:
+        '''/proc/meminfo fields in bytes, empty where unavailable'''
+        meminfo = {}
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    name, value = line.split(':', 1)
+                    meminfo[name] = int(value.split()[0]) * 1024
+        except (OSError, ValueError):
+            pass
+        return meminfo
@@ -1,9 +1,36 @@
+import os
 from enum import Enum, auto
+from typing import NamedTuple
 
 from util import StrEnum
 
 DEFAULT_THREAD_LIMIT = 4
-'''Default max simultaneous transcode/mux jobs'''
+'''Simultaneous transcode/mux jobs an automatically sized run starts with'''
+
+METADATA_THREAD_LIMIT = 8
+'''Max simultaneous metadata requests, each thread keeps its own connection alive'''
+DISCOVERY_THREAD_LIMIT = 16
+'''Max simultaneous input directory listings and voucher/chapters parses'''
+
+WATCH_SETTLE = 10
+'''Seconds none of a watched book's files may have been modified for before it's converted'''
+WATCH_POLL_INTERVAL = 30
+'''Seconds between rescans of watched input directories where inotify isn't available'''
+
+CONCURRENCY_INTERVAL = 5
+'''Seconds between system load samples when the number of jobs is sized automatically'''
+CONCURRENCY_SETTLE = 1
+'''Samples to skip after changing the number of jobs, so the change shows up in the load before it's judged'''
+CONCURRENCY_TARGET_CPU = 0.9
+'''Busy cpu fraction up to which jobs are added, below half of it the number of jobs is doubled'''
+CONCURRENCY_MAX_LOAD = 1.5
+'''1 minute load average per cpu above which jobs are removed'''
+CONCURRENCY_MAX_IOWAIT = 0.25
+'''Fraction of cpu time waiting for io above which jobs are removed'''
+CONCURRENCY_MIN_AVAILABLE_MEMORY = 0.1
+'''Available memory fraction below which the number of jobs is halved'''
+CONCURRENCY_MAX_WRITE_BACKLOG = 512 * 2**20
+'''Bytes of dirty and writeback pages above which jobs are removed'''
 
 DELIM_NAME = ','
 '''Name-type metadata field delimiter'''
@@ -21,14 +48,103 @@ NAMES_REPLACE = (
 )
 '''(string, replace) pairs to replace within names'''
 
-FF_CMD = ('ffmpeg', '-loglevel', 'error')
+AUDNEXUS_URL = 'https://api.audnex.us'
+'''Default audnexus API base url'''
+METADATA_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'aaxc2opus')
+'''Default on-disk metadata cache directory'''
+METADATA_CACHE_TTL = 7*24
+'''Default metadata cache entry lifetime in hours before revalidation'''
+HTTP_TIMEOUT = 30
+'''Metadata request timeout in seconds'''
+METADATA_FIELDS = ('title', 'authors', 'narrators', 'genres', 'releaseDate', 'summary', 'language', 'publisherName')
+'''audnexus book fields that are tagged, later metadata providers are asked for any that an earlier one supplying
+it lacks'''
+METADATA_REQUIRED = ('title', 'authors', 'narrators', 'genres', 'releaseDate')
+'''audnexus book fields a book can't be tagged without'''
+COVER_CACHE_DIRNAME = 'covers'
+'''Directory within the cache directory holding the resized cover variants'''
+COVER_EMBEDDED_SIZE = 600
+'''Longest side in pixels of the cover embedded in outputs, smaller covers aren't enlarged'''
+COVER_EMBEDDED_QUALITY = 5
+'''ffmpeg jpeg quality of the embedded cover, from 2 (best) to 31 (smallest)'''
+COVER_FULL_SIZE = 2000
+'''Longest side in pixels of the cover.jpg written next to outputs'''
+COVER_FULL_QUALITY = 3
+'''ffmpeg jpeg quality of the cover.jpg written next to outputs'''
+
+MANIFEST_FILENAME = '.aaxc2opus.sqlite'
+'''Default completed job manifest filename within the output directory'''
+
+LEASE_TTL = 120
+'''Seconds without a heartbeat before a work queue lease is considered abandoned'''
+LEASE_HEARTBEAT = 30
+'''Work queue lease heartbeat interval in seconds, also how often deferred books are retried'''
+
+PRIORITY_AGING = 600
+'''Seconds a book waits to gain one priority level under the priority order, so unlisted books aren't starved'''
+
+METRICS_QUANTILES = (0.5, 0.9, 0.99)
+'''Quantiles of the per stage timings in the run summary and prometheus textfile'''
+
+PLAN_MIN_HISTORY = 3
+'''Books converted with the same settings in earlier runs before a plan trusts their realtime factor and output size
+over a calibration encode and the nominal bitrate'''
+PLAN_CALIBRATION_DURATION = 60_000
+'''Milliseconds of audio a plan's calibration encode transcodes of each book in it'''
+PLAN_CONTAINER_OVERHEAD = 0.02
+'''Container size over the nominal opus bitrate a plan assumes without earlier runs'''
+
+STAGE_BUDGET = 4000
+'''Default megabytes the staged copies of upcoming inputs may take in the staging directory'''
+STAGE_DEPTH = 2
+'''Default number of books waiting to start whose inputs are staged ahead'''
+STAGE_CHUNK_SIZE = 8 * 2**20
+'''Bytes read at once when staging an input, large enough that slow storage streams rather than seeks'''
+
+VERIFY_DURATION_TOLERANCE = 40
+'''Milliseconds an output's duration may differ from its book's, for encoder padding a container doesn't trim and
+rounding in its time base. Segmented outputs are joined sample exact and need no more.'''
+VERIFY_CHAPTER_TOLERANCE = 1
+'''Milliseconds a chapter start may differ from its book's, for rounding in the container's time base'''
+
+WEBM_CLUSTER_DURATION = 5000
+'''Native webm muxer cluster length in milliseconds, must stay below 32768'''
+WEBM_RETAG_PADDING = 4096
+'''Bytes of Void the native webm muxer leaves after the tags and cover, so that retagging can usually rewrite them
+in place'''
+
+FF_CMD = ('ffmpeg', '-loglevel', 'error', '-y')
+FF_OPUS_RESAMPLER = 'aresample=48000:resampler=soxr:precision=28'
+'''Resampling filter in front of libopus, which only takes 48kHz and a few lower rates'''
+FF_LOG_CMD = ('ffmpeg', '-loglevel', 'info', '-hide_banner', '-nostats', '-y')
+'''FF_CMD for commands whose info level log is read, e.g. for the loudness summary'''
+FF_LOUDNESS_FILTER = 'ebur128=peak=true:framelog=quiet'
+'''Filter measuring the integrated loudness, loudness range and true peak, logging only a summary at the end'''
+
+R128_REFERENCE = -23
+'''LUFS the R128_TRACK_GAIN Opus tag brings a track to (RFC 7845)'''
+REPLAYGAIN_REFERENCE = -18
+'''LUFS the ReplayGain 2.0 REPLAYGAIN_TRACK_GAIN tag brings a track to'''
+LOUDNESS_TARGET = -18
+'''LUFS that normalizing sets the Opus output gain of ogg outputs to reach'''
+LOUDNESS_PLACEHOLDER = ('AAXC2OPUS_LOUDNESS', '0' * 16)
+'''(key, value) of the comment ogg outputs are encoded with while their loudness is still being measured, which
+leaves room to put the loudness tags in its place without rewriting the file'''
+
+OPUS_FRAME = 960
+'''48 kHz samples of the 20 ms packets both encoders write, segments are cut between packets'''
+OPUS_PRE_SKIP = 312
+'''Pre-skip in 48 kHz samples libopus gives 48 kHz input, its encoder lookahead'''
+SEGMENT_PREROLL = 25
+'''Packets encoded ahead of each later segment's first kept packet and dropped by the join. Well past the 80 ms RFC
+7845 asks for, libopus only settles on the same SILK state as an encoder that has been running for a while after
+about half a second.'''
+SEGMENT_LEAD_OUT = 1
+'''Packets encoded past the end of each earlier segment and dropped by the join, so that its last kept packet is
+encoded with real lookahead'''
 
-TRANSCODE_BUF_SIZE = 0
-'''Python subprocess pipe buffer size for the transcode job'''
 TRANSCODE_CHUNK_SIZE = 16*1024
-'''In-app "pipe buffer" size for transocde'''
-POLLING_INTERVAL = 1/10
-'''General cancel check polling interval in seconds'''
+'''In-app "pipe buffer" size for the relay transfer method'''
 PROGRESS_INTERVAL = 1
 '''Progress printing interval in seconds'''
 
@@ -78,7 +194,7 @@ MATROSKA_CHAPTER_ATOM_FMT = \
       <ChapterTimeEnd>{end}</ChapterTimeEnd>
       <ChapterDisplay>
         <ChapterString>{title}</ChapterString>
-      </ChapterDisplay>
+      </ChapterDisplay>{atoms}
     </ChapterAtom>'''
 
 
@@ -100,11 +216,84 @@ class Quality(StrEnum):
     STEREO = auto()
     '''stereo 64k auto'''
 
+class Profile(NamedTuple):
+    '''Container and quality of one output of a book, a run writes every profile it's given from a single decode'''
+    container: Container
+    quality: Quality
+
+    def __str__(self):
+        return f'{self.container}:{self.quality}'
+
+    @classmethod
+    def parse(cls, value: str) -> 'Profile':
+        '''argparse type for "container:quality"'''
+        container, quality = value.split(':')
+        return cls(Container(container), Quality(quality))
+
+OUTPUT_EXTENSIONS = {Container.MP4: 'm4b', Container.OGG: 'opus', Container.WEBM: 'webm'}
+'''Output file extension of each container'''
+
+STREAM_CONTAINERS = (Container.MP4, Container.WEBM)
+'''Containers whose muxer can read the encoder output from a pipe, webm only with the native muxer since mkvmerge
+needs a seekable input file'''
+
+class Transfer(StrEnum):
+    '''Decoder to encoder PCM transfer method'''
+    PIPE = auto()
+    '''decoder stdout connected directly to encoder stdin, python only supervises. The decoder of several profiles is
+    always relayed, into every encoder.'''
+    RELAY = auto()
+    '''python reads decoder stdout and writes encoder stdin in TRANSCODE_CHUNK_SIZE chunks'''
+
+class Encoder(StrEnum):
+    '''Opus encoding backend'''
+    OPUSENC = auto()
+    '''ffmpeg decrypts and decodes to wav, piped into opusenc which resamples and encodes, with several profiles
+    relayed into an opusenc per profile'''
+    FFMPEG = auto()
+    '''a single ffmpeg decrypts, decodes, resamples with FF_OPUS_RESAMPLER and encodes with libopus, with several
+    profiles an ffmpeg per profile encodes the wav of a shared decoder'''
+
+class LoudnessMode(StrEnum):
+    '''Use of the EBU R128 loudness measured while decoding'''
+    TAG = auto()
+    '''R128 tags in ogg outputs, ReplayGain tags in webm outputs, mp4 outputs can't carry either'''
+    NORMALIZE = auto()
+    '''tag and also set the Opus output gain of ogg outputs, so that every player plays them at LOUDNESS_TARGET'''
+
+class Order(StrEnum):
+    '''Order in which waiting books are started'''
+    LONGEST = auto()
+    '''longest first, shortest overall run time'''
+    SHORTEST = auto()
+    '''shortest first, first results soonest'''
+    PRIORITY = auto()
+    '''listed books first in the order listed, then the rest in the order found, with aging'''
+
 class ChapterFormat(Enum):
     '''Chapter metadata format type'''
     FFMPEG = auto()
     '''ffmpeg ffmetadata chapters: str'''
     MATROSKA = auto()
-    '''mkv/webm XML chapter atoms: str'''
+    '''mkv/webm XML chapter atoms, nested chapters inside their parent's atom: str'''
     VORBIS = auto()
-    '''ogg vorbis comment key=value sets: tuple[str, str]'''
+    '''ogg vorbis comment key=value strings: tuple[str, ...]'''
+
+class Stage(StrEnum):
+    '''Timed processing stage of a book'''
+    METADATA = auto()
+    '''metadata lookup, cpu time is the metadata thread's own'''
+    COVER = auto()
+    '''resize the cover, or find it already resized in the cover cache'''
+    TRANSCODE = auto()
+    '''decode and encode to an intermediate ogg opus file'''
+    REMUX = auto()
+    '''intermediate ogg opus file into the output container'''
+    STREAM = auto()
+    '''decode, encode and mux in one pipeline without an intermediate file'''
+    RETAG = auto()
+    '''rewrite the tags, chapters and cover of an existing output'''
+    LOUDNESS = auto()
+    '''add the loudness measured while transcoding to the tags of the output'''
+    VERIFY = auto()
+    '''check the duration, chapters and tags of an existing output against its book'''
@@ -0,0 +1,35 @@
+import os
+
+import constants as C
+from util import file_sha256
+
+class CoverCache:
+    '''On-disk cache of size and quality bounded jpeg variants of cover images, keyed by the content hash of the
+    original so that a cover is only decoded and resized once however many books or runs use it'''
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        '''cache directory, two jpeg files per cover'''
+
+    def variants(self, cover_file: str) -> tuple[str, str]:
+        '''(embedded, full) variant paths of cover_file, which don't exist until resize writes them'''
+        digest = file_sha256(cover_file).hexdigest()
+        # the bounds are part of the name, so changing them never serves stale variants
+        return (f'{self.directory}/{digest}-{C.COVER_EMBEDDED_SIZE}q{C.COVER_EMBEDDED_QUALITY}.jpg',
+                f'{self.directory}/{digest}-{C.COVER_FULL_SIZE}q{C.COVER_FULL_QUALITY}.jpg')
+
+    def cached(self, variants: tuple[str, str]) -> bool:
+        return all(os.path.exists(v) for v in variants)
+
+    def resize_command(self, cover_file: str, outputs: tuple[str, str]) -> tuple:
+        '''ffmpeg command decoding cover_file once and writing the (embedded, full) variants to outputs'''
+        def scale(size):
+            # fit within size x size, never enlarging
+            return f'scale=w=min(iw\\,{size}):h=min(ih\\,{size}):force_original_aspect_ratio=decrease:flags=lanczos'
+        return (*C.FF_CMD, '-i', cover_file,
+                           '-filter_complex', f'[0:v]split=2[e][f];[e]{scale(C.COVER_EMBEDDED_SIZE)}[eo];'
+                                              f'[f]{scale(C.COVER_FULL_SIZE)}[fo]',
+                           '-map', '[eo]', '-frames:v', '1', '-q:v', str(C.COVER_EMBEDDED_QUALITY),
+                           '-f', 'mjpeg', outputs[0],
+                           '-map', '[fo]', '-frames:v', '1', '-q:v', str(C.COVER_FULL_QUALITY),
+                           '-f', 'mjpeg', outputs[1])
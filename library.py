@@ -0,0 +1,43 @@
+import os
+import re
+
+class InvalidBook(Exception):
+    '''An aaxc file whose companion files are missing or unreadable'''
+    pass
+
+_COVER = re.compile(r'_\((\d*)\)\.jpg')
+
+def list_directory(directory: str) -> tuple[list[str], list[str]]:
+    '''(file names, subdirectory paths) of directory from a single listing'''
+    names, subdirectories = [], []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirectories.append(entry.path)
+            else:
+                names.append(entry.name)
+    return names, subdirectories
+
+def companion_names(aaxc_name: str) -> tuple[str, str]:
+    '''Names of the voucher and chapters files audible-cli writes next to aaxc_name'''
+    stem = os.path.splitext(aaxc_name)[0]
+    # "{base}-{content format}.aaxc" next to "{base}-chapters.json"
+    base = stem.rsplit('-', 1)[0]
+    return f'{stem}.voucher', f'{base}-chapters.json'
+
+def check_companions(aaxc_name: str, names: frozenset[str]) -> None:
+    '''Raise InvalidBook unless the companion files of aaxc_name are in names'''
+    for name in companion_names(aaxc_name):
+        if name not in names:
+            raise InvalidBook(f'missing {name}')
+
+def find_cover(base_name: str, names) -> str | None:
+    '''Name of the largest "{base_name}_(size).jpg" cover in names, if any'''
+    best, best_size = None, -1
+    for name in names:
+        if not name.startswith(base_name):
+            continue
+        match = _COVER.fullmatch(name, len(base_name))
+        if match and int(match[1] or 0) > best_size:
+            best, best_size = name, int(match[1] or 0)
+    return best
@@ -0,0 +1,63 @@
+import math
+import re
+
+import constants as C
+
+_SUMMARY = re.compile(r'Summary:.*?I:\s+(\S+) LUFS.*?LRA:\s+(\S+) LU.*?Peak:\s+(\S+) dBFS', re.DOTALL)
+
+def q78(db: float) -> int:
+    '''dB as a Q7.8 fixed point gain, clamped to what the Opus header and tags can hold'''
+    return max(-32768, min(32767, round(db * 256)))
+
+class Loudness:
+    '''EBU R128 loudness of a book, measured by FF_LOUDNESS_FILTER while decoding'''
+    __slots__ = ('integrated', 'true_peak', 'range', 'output_gain')
+
+    def __init__(self, integrated: float, true_peak: float, range: float = None, output_gain: int = 0) -> None:
+        self.integrated = integrated
+        '''integrated loudness in LUFS'''
+        self.true_peak = true_peak
+        '''true peak in dBTP'''
+        self.range = range
+        '''loudness range in LU, None if the book was measured in segments'''
+        self.output_gain = output_gain
+        '''Q7.8 dB gain set in the Opus header of the output, which players apply before any tag'''
+
+    @classmethod
+    def parse(cls, log: str) -> 'Loudness':
+        '''The measurement in the summary the loudness filter logs at the end of the ffmpeg log, raise ValueError if
+        there is none'''
+        summaries = _SUMMARY.findall(log)
+        if not summaries:
+            raise ValueError('no loudness summary in the log')
+        integrated, range, true_peak = map(float, summaries[-1])
+        return cls(integrated, true_peak, range)
+
+    @classmethod
+    def combine(cls, parts: list['Loudness'], durations: list[int]) -> 'Loudness':
+        '''Loudness of consecutive parts of durations milliseconds. The integrated loudness is the duration weighted
+        mean energy, which ignores that the gating thresholds of the parts differ, and the range can't be combined.'''
+        if len(parts) == 1:
+            return parts[0]
+        energy = sum(10 ** (p.integrated / 10) * d for p, d in zip(parts, durations)) / sum(durations)
+        return cls(10 * math.log10(energy) if energy else -math.inf, max(p.true_peak for p in parts))
+
+    def gain_to(self, lufs: float) -> int:
+        '''Q7.8 gain bringing the book to lufs'''
+        return q78(lufs - self.integrated)
+
+    def tags(self, container: C.Container) -> dict[str, str]:
+        '''Loudness tags for an output in container, relative to the output gain'''
+        match container:
+            case C.Container.OGG:
+                # RFC 7845 tags are in addition to the header gain, and Opus files mustn't carry ReplayGain tags
+                return {'R128_TRACK_GAIN': str(q78(C.R128_REFERENCE - self.integrated) - self.output_gain)}
+            case C.Container.WEBM:
+                gain = C.REPLAYGAIN_REFERENCE - self.integrated - self.output_gain / 256
+                return {'REPLAYGAIN_TRACK_GAIN': f'{gain:.2f} dB',
+                        'REPLAYGAIN_TRACK_PEAK': f'{10 ** ((self.true_peak + self.output_gain / 256) / 20):.6f}'}
+            case _:
+                return {}
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
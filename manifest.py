@@ -0,0 +1,104 @@
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+
+import constants as C
+from book import Book
+from loudness import Loudness
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS {table} (
+                 asin TEXT NOT NULL,
+                 container TEXT NOT NULL,
+                 quality TEXT NOT NULL,
+                 input_path TEXT NOT NULL,
+                 input_size INTEGER NOT NULL,
+                 input_mtime_ns INTEGER NOT NULL,
+                 content_format TEXT NOT NULL,
+                 output_file TEXT NOT NULL,
+                 completed REAL NOT NULL,
+                 tags_digest TEXT,
+                 loudness TEXT,
+                 PRIMARY KEY (input_path, container, quality))'''
+
+_COLUMNS = ('asin', 'container', 'quality', 'input_path', 'input_size', 'input_mtime_ns', 'content_format',
+            'output_file', 'completed', 'tags_digest', 'loudness')
+
+class Manifest:
+    '''Persistent record of completed jobs, used to skip books whose input and settings haven't changed'''
+    def __init__(self, path: str) -> None:
+        self.path = path
+        '''sqlite database file'''
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(_SCHEMA.format(table='jobs'))
+            # manifests from before retagging and loudness measurement
+            columns = {row[1]: row[5] for row in self._db.execute('PRAGMA table_info(jobs)')}
+            for column in ('tags_digest', 'loudness'):
+                if column not in columns:
+                    self._db.execute(f'ALTER TABLE jobs ADD COLUMN {column} TEXT')
+            # manifests from before jobs were keyed by their input, in which inputs of the same asin replaced each
+            # other's jobs. sqlite can't change a primary key in place.
+            if columns['asin']:
+                self._db.execute('ALTER TABLE jobs RENAME TO jobs_by_asin')
+                self._db.execute(_SCHEMA.format(table='jobs'))
+                self._db.execute(f'''INSERT OR REPLACE INTO jobs ({", ".join(_COLUMNS)})
+                                     SELECT {", ".join(_COLUMNS)} FROM jobs_by_asin ORDER BY completed''')
+                self._db.execute('DROP TABLE jobs_by_asin')
+            self._db.execute('DROP INDEX IF EXISTS jobs_input')
+
+    def is_current(self, aaxc_path: str, container: C.Container, quality: C.Quality,
+                   content_format: str = None) -> bool:
+        '''Whether aaxc_path was already converted with these settings and neither it nor the output changed since.
+        The content_format of the input, if known, has to match as well.'''
+        with self._lock:
+            row = self._db.execute('''SELECT input_size, input_mtime_ns, content_format, output_file FROM jobs
+                                      WHERE input_path = ? AND container = ? AND quality = ?''',
+                                   (os.path.abspath(aaxc_path), str(container), str(quality))).fetchone()
+        if not row:
+            return False
+        size, mtime_ns, recorded_format, output_file = row
+        if content_format and content_format != recorded_format:
+            return False
+        try:
+            res = os.stat(aaxc_path)
+        except FileNotFoundError:
+            return False
+        return (res.st_size, res.st_mtime_ns) == (size, mtime_ns) and os.path.exists(output_file)
+
+    def output(self, aaxc_path: str, container: C.Container,
+               quality: C.Quality) -> tuple[str, str | None, Loudness | None] | None:
+        '''(output file, tags digest, loudness) of the last conversion of aaxc_path with these settings, if any'''
+        with self._lock:
+            row = self._db.execute('''SELECT output_file, tags_digest, loudness FROM jobs
+                                      WHERE input_path = ? AND container = ? AND quality = ?''',
+                                   (os.path.abspath(aaxc_path), str(container), str(quality))).fetchone()
+        if not row:
+            return None
+        output_file, tags_digest, loudness = row
+        return output_file, tags_digest, Loudness(**json.loads(loudness)) if loudness else None
+
+    def record(self, book: Book, container: C.Container, quality: C.Quality, output_file: str,
+               tags_digest: str = None) -> None:
+        res = os.stat(book.aaxc_path)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (book.asin, str(container), str(quality), os.path.abspath(book.aaxc_path),
+                              res.st_size, res.st_mtime_ns, book.content_format,
+                              os.path.abspath(output_file), time.time(), tags_digest,
+                              json.dumps(book.loudness.as_dict()) if book.loudness else None))
+
+    def update_tags(self, book: Book, container: C.Container, quality: C.Quality, tags_digest: str) -> None:
+        '''Record that the output of the last conversion of book with these settings was retagged. The input it was
+        converted from stays recorded, nothing is recorded if there was no conversion.'''
+        with self._lock, self._db:
+            self._db.execute('''UPDATE jobs SET tags_digest = ?, loudness = COALESCE(?, loudness)
+                                WHERE input_path = ? AND container = ? AND quality = ?''',
+                             (tags_digest, json.dumps(book.loudness.as_dict()) if book.loudness else None,
+                              os.path.abspath(book.aaxc_path), str(container), str(quality)))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,204 @@
+import csv
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from threading import local
+from urllib.parse import urlsplit
+
+import constants as C
+
+class MetadataUnavailable(Exception):
+    pass
+
+class MetadataProvider(ABC):
+    '''Source of book metadata in the audnexus book json format, possibly with only some of its fields'''
+    fields = C.METADATA_FIELDS
+    '''METADATA_FIELDS it can answer with'''
+
+    @abstractmethod
+    def get(self, asin: str) -> dict:
+        '''Return the metadata of asin, raise MetadataUnavailable if there is none'''
+
+class MetadataCache(MetadataProvider):
+    '''On-disk audnexus book metadata cache keyed by ASIN. Entries younger than the ttl are used as-is, older
+    entries are revalidated with ETag/Last-Modified and still used if the API can't be reached.'''
+    def __init__(self, directory=C.METADATA_CACHE_DIR, base_url=C.AUDNEXUS_URL,
+                 ttl=C.METADATA_CACHE_TTL, offline=False) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        '''cache directory, one json file per ASIN'''
+        self.base_url = base_url.rstrip('/')
+        '''audnexus API base url'''
+        self.ttl = ttl * 3600
+        '''entry lifetime in seconds'''
+        self.offline = offline
+        '''only ever answer from the cache'''
+
+        self._url = urlsplit(self.base_url)
+        self._local = local()
+
+    def _path(self, asin: str) -> str:
+        return f'{self.directory}/{asin}.json'
+
+    def _load(self, asin: str) -> dict | None:
+        try:
+            with open(self._path(asin), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _store(self, asin: str, entry: dict) -> None:
+        # write and rename so concurrent readers never see a partial entry
+        path = self._path(asin)
+        temp = f'{path}.{os.getpid()}.{id(entry)}'
+        with open(temp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(temp, path)
+
+    def _connection(self) -> HTTPConnection:
+        connection = getattr(self._local, 'connection', None)
+        if not connection:
+            cls = HTTPSConnection if self._url.scheme == 'https' else HTTPConnection
+            connection = self._local.connection = cls(self._url.netloc, timeout=C.HTTP_TIMEOUT)
+        return connection
+
+    def _request(self, asin: str, entry: dict | None) -> tuple[int, dict, bytes]:
+        '''GET the book over this thread's keep-alive connection, returns (status, headers, body)'''
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request('GET', f'{self._url.path}/books/{asin}', headers=headers)
+                response = connection.getresponse()
+                return response.status, response.headers, response.read()
+            except (HTTPException, OSError):
+                # the server may have closed an idle connection, retry once on a fresh one
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+    def get(self, asin: str) -> dict:
+        '''Return the audnexus book json for asin'''
+        entry = self._load(asin)
+        if entry and (self.offline or time.time() - entry['fetched'] < self.ttl):
+            return entry['data']
+        if self.offline:
+            raise MetadataUnavailable(f'no cached metadata for {asin} in offline mode')
+
+        try:
+            status, headers, body = self._request(asin, entry)
+        except (HTTPException, OSError):
+            # a stale entry beats no entry when the API is down
+            if not entry:
+                raise
+            return entry['data']
+
+        if status == 200:
+            entry = {
+                'data': json.loads(body),
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified')
+            }
+        elif entry and status >= 500:
+            return entry['data']
+        elif not (entry and status == 304):
+            raise MetadataUnavailable(f'audnexus returned {status} for {asin}')
+
+        entry['fetched'] = time.time()
+        self._store(asin, entry)
+        return entry['data']
+
+class LibraryExport(MetadataProvider):
+    '''An audible-cli "library export" file, json, tsv or csv by extension, indexed by ASIN in memory. Exports have
+    no category types, the first of a book's categories is taken as its genre and the rest as tags.'''
+    def __init__(self, path: str) -> None:
+        self.path = path
+        '''export file'''
+        try:
+            with open(path, newline='', encoding='utf-8') as f:
+                if path.endswith('.json'):
+                    rows = json.load(f)
+                else:
+                    rows = list(csv.DictReader(f, delimiter=',' if path.endswith('.csv') else '\t'))
+        except csv.Error as e:
+            raise ValueError(f'{path}: {e}') from e
+        self._books = {row['asin']: self._convert(row) for row in rows if row.get('asin')}
+        # exports have no language or publisher, and older audible-cli versions fewer columns still
+        self.fields = tuple(f for f in C.METADATA_FIELDS if any(f in book for book in self._books.values()))
+        '''METADATA_FIELDS the export has for any of its books'''
+
+    def __len__(self) -> int:
+        return len(self._books)
+
+    def get(self, asin: str) -> dict:
+        try:
+            return self._books[asin]
+        except KeyError:
+            raise MetadataUnavailable(f'{asin} is not in {self.path}') from None
+
+    @staticmethod
+    def _convert(row: dict) -> dict:
+        '''audnexus book json fields of an export row, empty columns are left out'''
+        def text(key: str) -> str:
+            value = row.get(key)
+            return str(value).strip() if value not in (None, '') else ''
+
+        def names(key: str) -> list[dict]:
+            return [{'name': n.strip()} for n in text(key).split(',') if n.strip()]
+
+        data = {}
+        for key, field in (('title', 'title'),
+                           ('subtitle', 'subtitle'),
+                           ('release_date', 'releaseDate'),
+                           ('extended_product_description', 'summary'),
+                           ('language', 'language'),
+                           ('publisher_name', 'publisherName')):
+            if text(key):
+                data[field] = text(key)
+        for key in ('authors', 'narrators'):
+            if text(key):
+                data[key] = names(key)
+        if text('genres'):
+            data['genres'] = [dict(g, type='tag' if i else 'genre') for i, g in enumerate(names('genres'))]
+        if text('series_title') and text('series_sequence'):
+            data['seriesPrimary'] = {'name': text('series_title'), 'position': text('series_sequence')}
+        return data
+
+class MetadataChain(MetadataProvider):
+    '''Asks providers in order and merges their answers, the first provider to have a field wins. Later providers
+    are only asked while one of the METADATA_REQUIRED fields, or of the fields an earlier provider supplies, is
+    missing, so a book is left without a field none of those supply rather than asking every provider for it.
+    Failures of later providers are ignored as long as the METADATA_REQUIRED fields were found.'''
+    def __init__(self, providers: list[MetadataProvider]) -> None:
+        self.providers = providers
+        '''providers in order of preference'''
+
+    def get(self, asin: str) -> dict:
+        data = {}
+        errors = []
+        covered = set()
+        for provider in self.providers:
+            if all(field in data for field in (*C.METADATA_REQUIRED, *covered)):
+                break
+            covered.update(provider.fields)
+            try:
+                answer = provider.get(asin)
+            except (MetadataUnavailable, HTTPException, OSError) as e:
+                errors.append(e)
+                continue
+            for field, value in answer.items():
+                data.setdefault(field, value)
+
+        missing = [field for field in C.METADATA_REQUIRED if field not in data]
+        if missing:
+            raise MetadataUnavailable(f'no {", ".join(missing)} for {asin}: {"; ".join(map(str, errors))}')
+        return data
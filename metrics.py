@@ -0,0 +1,146 @@
+import json
+import math
+import os
+import resource
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+import constants as C
+from book import Book
+
+def children_cpu_time() -> float:
+    '''User plus system cpu seconds of every child process waited for so far'''
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def quantile(values: list[float], q: float) -> float:
+    '''Nearest rank quantile of sorted values'''
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+class BookMetrics:
+    '''Stage timings and sizes of one book'''
+    def __init__(self, book: Book) -> None:
+        self.book = book
+        self.stages = {}
+        '''Stage -> [wall seconds, cpu seconds]'''
+        self.started = time.time()
+
+    def record(self, status: str, output_files: list[str] = (), **settings) -> dict:
+        '''JSON lines record of the finished book. The realtime factor is the audio duration over the wall time of
+        the transcode and mux stages, there is none for books that were only retagged or verified.'''
+        stages = {str(s): {'wall': round(w, 6), 'cpu': round(c, 6)} for s, (w, c) in self.stages.items()}
+        audio_seconds = self.book.output_duration / 1000 if self.book.output_duration else None
+        work = sum(w for s, (w, _) in self.stages.items() 
+                   if s not in (C.Stage.METADATA, C.Stage.COVER, C.Stage.RETAG, C.Stage.VERIFY))
+        return {'asin': self.book.asin,
+                'input': os.path.abspath(self.book.aaxc_path),
+                'status': status,
+                'started': self.started,
+                'finished': time.time(),
+                **settings,
+                'stages': stages,
+                'bytes_in': _size(self.book.aaxc_path),
+                'bytes_out': sum(_size(f) for f in output_files),
+                'audio_seconds': audio_seconds,
+                'measured_loudness': self.book.loudness.as_dict() if self.book.loudness else None,
+                'realtime_factor': round(audio_seconds / work, 3) if audio_seconds and work and status == 'done' else None}
+
+class Metrics:
+    '''Per stage wall and cpu time of every book. Finished books are appended to a JSON lines file and the Prometheus
+    textfile, if any, is rewritten.
+
+    Child cpu time comes from getrusage(RUSAGE_CHILDREN), which only grows as processes are waited for. It is exact
+    with one thread, with more the processes of other books that exit during a stage are counted towards it too.'''
+    def __init__(self, jsonl_file: str = None, prometheus_file: str = None, **settings) -> None:
+        self.jsonl_file = jsonl_file
+        '''JSON lines output, one record per finished book'''
+        self.prometheus_file = prometheus_file
+        '''Prometheus node exporter textfile output'''
+        self.settings = settings
+        '''run settings included in every record, e.g. threads'''
+        self._lock = Lock()
+        self._books = {}
+        self._records = []
+        self._start_cpu = children_cpu_time()
+
+    @contextmanager
+    def stage(self, book: Book, stage: C.Stage):
+        '''Time the enclosed block as stage of book'''
+        with self._lock:
+            metrics = self._books.setdefault(book, BookMetrics(book))
+        cpu_time = time.thread_time if stage == C.Stage.METADATA else children_cpu_time
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            totals = metrics.stages.setdefault(stage, [0, 0])
+            totals[0] += time.perf_counter() - wall
+            totals[1] += cpu_time() - cpu
+
+    def finish(self, book: Book, status: str, output_files: list[str] = ()) -> None:
+        '''Record book as done, failed or cancelled with the files it was converted to and write the outputs'''
+        with self._lock:
+            metrics = self._books.pop(book, None) or BookMetrics(book)
+            record = metrics.record(status, output_files, **self.settings)
+            self._records.append(record)
+            if self.jsonl_file:
+                with open(self.jsonl_file, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            if self.prometheus_file:
+                self._write_prometheus()
+
+    def summary(self) -> list[str]:
+        '''Lines of per stage wall time quantiles over the finished books'''
+        header = ''.join(f'{f"p{q * 100:g}":>9s}' for q in C.METRICS_QUANTILES)
+        lines = [f'{"stage":10s}{"books":>6s}{header}{"max":>9s}{"cpu":>10s}']
+        for stage in map(str, C.Stage):
+            walls = sorted(r['stages'][stage]['wall'] for r in self._records if stage in r['stages'])
+            if not walls:
+                continue
+            cpu = sum(r['stages'][stage]['cpu'] for r in self._records if stage in r['stages'])
+            quantiles = ''.join(f'{quantile(walls, q):8.2f}s' for q in C.METRICS_QUANTILES)
+            lines.append(f'{stage:10s}{len(walls):6d}{quantiles}{walls[-1]:8.2f}s{cpu:9.2f}s')
+        factors = sorted(r['realtime_factor'] for r in self._records if r['realtime_factor'])
+        if factors:
+            quantiles = ''.join(f'{quantile(factors, q):8.1f}x' for q in C.METRICS_QUANTILES)
+            lines.append(f'{"realtime":10s}{len(factors):6d}{quantiles}{factors[-1]:8.1f}x')
+        lines.append(f'child process cpu time: {children_cpu_time() - self._start_cpu:.2f}s')
+        return lines
+
+    def _write_prometheus(self) -> None:
+        lines = ['# HELP aaxc2opus_books_total Books finished by status.',
+                 '# TYPE aaxc2opus_books_total counter']
+        for status in sorted({r['status'] for r in self._records}):
+            count = sum(1 for r in self._records if r['status'] == status)
+            lines.append(f'aaxc2opus_books_total{{status="{status}"}} {count}')
+
+        for name, key, help in (('aaxc2opus_stage_seconds', 'wall', 'Wall time per book and stage.'),
+                                ('aaxc2opus_stage_cpu_seconds', 'cpu', 'Cpu time per book and stage.')):
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} summary']
+            for stage in map(str, C.Stage):
+                values = sorted(r['stages'][stage][key] for r in self._records if stage in r['stages'])
+                if not values:
+                    continue
+                for q in C.METRICS_QUANTILES:
+                    lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {quantile(values, q)}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {sum(values)}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {len(values)}')
+
+        for name, key, help in (('aaxc2opus_read_bytes_total', 'bytes_in', 'Input bytes of finished books.'),
+                                ('aaxc2opus_written_bytes_total', 'bytes_out', 'Output bytes of finished books.'),
+                                ('aaxc2opus_audio_seconds_total', 'audio_seconds', 'Audio duration of finished books.')):
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} counter',
+                      f'{name} {sum(r[key] or 0 for r in self._records if r["status"] == "done")}']
+
+        # the textfile collector may read at any time, so replace the file in one step
+        temp_file = f'{self.prometheus_file}.{os.getpid()}.tmp'
+        with open(temp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_file, self.prometheus_file)
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
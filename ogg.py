@@ -0,0 +1,336 @@
+import os
+import struct
+import zlib
+from typing import BinaryIO, Iterator
+
+OPUS_SAMPLE_RATE = 48000
+'''Opus granule positions and durations are always in 48 kHz samples'''
+MAX_PAGE_SIZE = 65307
+'''Largest possible Ogg page, header plus 255 segments of 255 bytes'''
+
+_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+_CRC_OFFSET = 22
+
+# the Ogg checksum is zlib's CRC-32 with the bits of each byte and of the result reversed, and no inversions
+_REVERSED_BITS = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+
+class OggError(Exception):
+    pass
+
+class OggPage:
+    '''A single Ogg page, segment table already resolved into packet pieces'''
+    __slots__ = ('header_type', 'granule', 'serial', 'sequence', 'crc', 'offset', 'size', 'pieces')
+
+    def __init__(self, header_type: int, granule: int, serial: int, sequence: int, crc: int,
+                 offset: int, size: int, pieces: list[tuple[bytes, bool]]) -> None:
+        self.header_type = header_type
+        '''0x1 continued packet, 0x2 beginning of stream, 0x4 end of stream'''
+        self.granule = granule
+        '''granule position after the last packet completed on this page, -1 if none completes'''
+        self.serial = serial
+        '''logical bitstream serial number'''
+        self.sequence = sequence
+        '''page sequence number'''
+        self.crc = crc
+        '''page checksum as stored'''
+        self.offset = offset
+        '''byte offset of the page within the stream'''
+        self.size = size
+        '''page size in bytes including the header'''
+        self.pieces = pieces
+        '''(data, completes_packet) for each packet piece on the page'''
+
+def read_pages(stream: BinaryIO) -> Iterator[OggPage]:
+    '''Read Ogg pages from a (possibly unseekable) binary stream until EOF'''
+    offset = 0
+    while True:
+        header = _read_exact(stream, _PAGE_HEADER.size)
+        if not header:
+            return
+        capture, version, header_type, granule, serial, sequence, crc, n_segments = _PAGE_HEADER.unpack(header)
+        if capture != b'OggS' or version != 0:
+            raise OggError(f'lost page sync at byte {offset}')
+        lacing = _read_exact(stream, n_segments)
+        body = _read_exact(stream, sum(lacing))
+
+        pieces = []
+        start = 0
+        length = 0
+        for value in lacing:
+            length += value
+            # a lacing value below 255 ends a packet, 255 on the last segment continues it on the next page
+            if value < 255:
+                pieces.append((body[start:start + length], True))
+                start += length
+                length = 0
+        if length:
+            pieces.append((body[start:start + length], False))
+
+        size = _PAGE_HEADER.size + n_segments + len(body)
+        yield OggPage(header_type, granule, serial, sequence, crc, offset, size, pieces)
+        offset += size
+
+def read_packets(stream: BinaryIO) -> Iterator[tuple[bytes, int, bool]]:
+    '''Reassemble the packets of the first logical stream, yields (packet, page granule, last packet on the page)'''
+    serial = None
+    partial = []
+    for page in read_pages(stream):
+        if serial is None:
+            serial = page.serial
+        elif page.serial != serial:
+            continue
+        completed = [i for i, (_, complete) in enumerate(page.pieces) if complete]
+        for i, (data, complete) in enumerate(page.pieces):
+            partial.append(data)
+            if complete:
+                yield b''.join(partial), page.granule, i == completed[-1]
+                partial = []
+
+def opus_packet_samples(packet: bytes) -> int:
+    '''Duration of an Opus packet in 48 kHz samples, from its TOC byte (RFC 6716 section 3.1)'''
+    if not packet:
+        return 0
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame = (480, 960, 1920, 2880)[config & 3]
+    elif config < 16:
+        frame = (480, 960)[config & 1]
+    else:
+        frame = (120, 240, 480, 960)[config & 3]
+    match toc & 3:
+        case 0:
+            frames = 1
+        case 1 | 2:
+            frames = 2
+        case _:
+            frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame * frames
+
+def parse_opus_head(packet: bytes) -> dict:
+    '''Fields of an OpusHead identification header (RFC 7845 section 5.1)'''
+    if packet[:8] != b'OpusHead':
+        raise OggError('stream is not Ogg Opus')
+    version, channels, pre_skip, input_sample_rate, output_gain = struct.unpack_from('<BBHIh', packet, 8)
+    return {
+        'version': version,
+        'channels': channels,
+        'pre_skip': pre_skip,
+        'input_sample_rate': input_sample_rate,
+        'output_gain': output_gain
+    }
+
+def read_last_page(f: BinaryIO) -> OggPage | None:
+    '''Last complete page with a valid checksum of a seekable stream, found by reading back from the end'''
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    start = max(0, end - MAX_PAGE_SIZE)
+    f.seek(start)
+    data = f.read()
+    offset = data.rfind(b'OggS')
+    while offset >= 0:
+        if offset + _PAGE_HEADER.size <= len(data):
+            _, version, header_type, granule, serial, sequence, crc, n_segments = _PAGE_HEADER.unpack_from(data, offset)
+            body = offset + _PAGE_HEADER.size + n_segments
+            size = body - offset + sum(data[offset + _PAGE_HEADER.size:body])
+            page = data[offset:offset + size]
+            # a capture pattern inside packet data, or a page cut short, doesn't check out
+            if version == 0 and body <= len(data) and len(page) == size and page_crc(page) == crc:
+                return OggPage(header_type, granule, serial, sequence, crc, start + offset, size, [])
+        offset = data.rfind(b'OggS', 0, offset)
+    return None
+
+def parse_opus_tags(packet: bytes) -> list[tuple[str, str]]:
+    '''(key, value) of each user comment of an OpusTags comment header (RFC 7845 section 5.2)'''
+    _, comments, _ = _split_opus_tags(packet)
+    return [(key, value) for key, _, value in (c.decode('utf-8', 'replace').partition('=') for c in comments)]
+
+def _split_opus_tags(packet: bytes) -> tuple[int, list[bytes], int]:
+    '''(end of the vendor string, raw user comments, end of the comment list) of an OpusTags comment header'''
+    if packet[:8] != b'OpusTags':
+        raise OggError('no OpusTags header')
+    try:
+        vendor_length, = struct.unpack_from('<I', packet, 8)
+        vendor_end = offset = 12 + vendor_length
+        count, = struct.unpack_from('<I', packet, offset)
+        offset += 4
+        comments = []
+        for _ in range(count):
+            length, = struct.unpack_from('<I', packet, offset)
+            comments.append(packet[offset + 4:offset + 4 + length])
+            offset += 4 + length
+    except struct.error as e:
+        raise OggError('truncated OpusTags header') from e
+    if offset > len(packet):
+        raise OggError('truncated OpusTags header')
+    return vendor_end, comments, offset
+
+def page_crc(page: bytes) -> int:
+    '''Ogg page checksum, of the page with its checksum field zeroed'''
+    page = bytes(page[:_CRC_OFFSET]) + bytes(len(page[_CRC_OFFSET:_CRC_OFFSET + 4])) + bytes(page[_CRC_OFFSET + 4:])
+    crc = zlib.crc32(page.translate(_REVERSED_BITS), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f'{crc:032b}'[::-1], 2)
+
+def set_output_gain(path: str, gain: int) -> None:
+    '''Set the output gain in the OpusHead of the Ogg Opus file path in place, gain in Q7.8 dB. The OpusHead is
+    alone on the first page, so only that page changes.'''
+    with open(path, 'r+b') as f:
+        page = next(read_pages(f), None)
+        if not page or not page.pieces or page.pieces[0][0][:8] != b'OpusHead':
+            raise OggError(f'{path} is not Ogg Opus')
+        f.seek(0)
+        data = bytearray(_read_exact(f, page.size))
+        head = page.size - len(page.pieces[0][0])
+        struct.pack_into('<h', data, head + 16, gain)
+        struct.pack_into('<I', data, _CRC_OFFSET, page_crc(data))
+        f.seek(0)
+        f.write(data)
+
+def set_opus_tags(path: str, tags: dict[str, str], remove: tuple[str, ...] = ()) -> None:
+    '''Replace the user comments of the Ogg Opus file path keyed like tags, or like remove, with tags in place. The
+    OpusTags header keeps its size, so only its pages change: the comments replaced or removed, and any padding after
+    the comment list, have to make room for the new ones. Raises OggError if they don't.'''
+    with open(path, 'r+b') as f:
+        pages = read_pages(f)
+        first = next(pages, None)
+        if not first or not first.pieces or first.pieces[0][0][:8] != b'OpusHead':
+            raise OggError(f'{path} is not Ogg Opus')
+        # the comment header starts on a page of its own and audio starts on a fresh page after it
+        tag_pages = []
+        for page in pages:
+            tag_pages.append(page)
+            if page.pieces and page.pieces[-1][1]:
+                break
+        packet = b''.join(data for page in tag_pages for data, _ in page.pieces)
+        vendor_end, comments, end = _split_opus_tags(packet)
+        if packet[end:end + 1] and packet[end] & 1:
+            raise OggError(f'{path} has data after its comments that has to be kept')
+
+        keys = {key.upper() for key in (*tags, *remove)}
+        comments = [c for c in comments if c.partition(b'=')[0].decode('utf-8', 'replace').upper() not in keys]
+        comments += (f'{key}={value}'.encode() for key, value in tags.items())
+        rebuilt = packet[:vendor_end] + struct.pack('<I', len(comments))
+        rebuilt += b''.join(struct.pack('<I', len(c)) + c for c in comments)
+        if len(rebuilt) > len(packet):
+            raise OggError(f'no room for {len(rebuilt) - len(packet)} more bytes of comments in {path}')
+        # zero padding, which readers may discard
+        rebuilt += bytes(len(packet) - len(rebuilt))
+
+        offset = 0
+        for page in tag_pages:
+            f.seek(page.offset)
+            data = bytearray(_read_exact(f, page.size))
+            length = sum(len(piece) for piece, _ in page.pieces)
+            data[page.size - length:] = rebuilt[offset:offset + length]
+            offset += length
+            struct.pack_into('<I', data, _CRC_OFFSET, page_crc(data))
+            f.seek(page.offset)
+            f.write(data)
+
+class OggWriter:
+    '''Writes the packets of a single logical stream into Ogg pages. The header packets get pages of their own and
+    audio packets are collected into pages of up to PACKETS_PER_PAGE.'''
+    PACKETS_PER_PAGE = 50
+
+    def __init__(self, stream: BinaryIO, serial: int) -> None:
+        self._stream = stream
+        self._serial = serial
+        self._sequence = 0
+        self._packets = []
+        self._granule = 0
+
+    def write_header(self, packet: bytes) -> None:
+        '''Write a header packet on its own pages, the first one begins the stream'''
+        self._page([packet], 0, 0x02 if self._sequence == 0 else 0)
+
+    def write(self, packet: bytes, granule: int) -> None:
+        '''Add an audio packet, granule being the granule position at its end'''
+        self._packets.append(packet)
+        self._granule = granule
+        if len(self._packets) == self.PACKETS_PER_PAGE:
+            self._page(self._packets, granule, 0)
+            self._packets = []
+
+    def close(self, granule: int) -> None:
+        '''Write the last page, ending the stream at granule'''
+        self._page(self._packets, granule, 0x04)
+
+    def _page(self, packets: list[bytes], granule: int, header_type: int) -> None:
+        lacing = bytearray()
+        for packet in packets:
+            lacing += b'\xff' * (len(packet) // 255) + bytes((len(packet) % 255, ))
+        body = b''.join(packets)
+        # a page holds at most 255 lacing values, longer packets are continued on the next page
+        while len(lacing) > 255:
+            size = sum(lacing[:255])
+            self._write_page(header_type, -1, lacing[:255], body[:size])
+            lacing, body = lacing[255:], body[size:]
+            header_type = 0x01
+        self._write_page(header_type, granule, lacing, body)
+
+    def _write_page(self, header_type: int, granule: int, lacing: bytes, body: bytes) -> None:
+        page = bytearray(_PAGE_HEADER.pack(b'OggS', 0, header_type, granule, self._serial, self._sequence, 0,
+                                           len(lacing)))
+        page += lacing
+        page += body
+        struct.pack_into('<I', page, _CRC_OFFSET, page_crc(page))
+        self._stream.write(page)
+        self._sequence += 1
+
+def join_segments(segments: list[tuple[str, int, int | None]], output: BinaryIO) -> None:
+    '''Join Ogg Opus files into a single stream written to output. Each segment is (file, skip, keep): the 48 kHz
+    samples at the start of its audio, pre-skip included, to drop and the samples after them to keep, None for the
+    rest of the last one. Both have to fall between packets. The headers are taken from the first file and the
+    granule positions of the others continue where the previous one left off, so that the joined stream plays
+    gaplessly, with the pre-skip of the first file and the end trim of the last.'''
+    writer = None
+    pre_skip = None
+    granule = 0
+    for file, skip, keep in segments:
+        with open(file, 'rb') as f:
+            first = next(read_pages(f), None)
+            if not first:
+                raise OggError(f'{file} is empty')
+            f.seek(0)
+            packets = read_packets(f)
+            head = next(packets, (b'', ))[0]
+            tags = next(packets, (b'', ))[0]
+            if tags[:8] != b'OpusTags':
+                raise OggError(f'{file} has no OpusTags header')
+            if writer and parse_opus_head(head)['pre_skip'] != pre_skip:
+                raise OggError(f'{file} has a different pre-skip than the first segment')
+            if writer is None:
+                pre_skip = parse_opus_head(head)['pre_skip']
+                writer = OggWriter(output, first.serial)
+                writer.write_header(head)
+                writer.write_header(tags)
+
+            end = None if keep is None else skip + keep
+            position = 0
+            final = 0
+            for packet, page_granule, _ in packets:
+                samples = opus_packet_samples(packet)
+                if position < skip < position + samples or end is not None and position < end < position + samples:
+                    raise OggError(f'{file} is not cut at a packet boundary')
+                if position >= skip and (end is None or position < end):
+                    granule += samples
+                    writer.write(packet, granule)
+                position += samples
+                final = page_granule
+            if end is not None and position < end:
+                raise OggError(f'{file} ends {end - position} samples short')
+    if writer is None:
+        raise OggError('no segments to join')
+    # the final granule position of the last segment trims the padding of its last packet
+    writer.close(granule - (position - final) if keep is None else granule)
+
+def _read_exact(stream: BinaryIO, size: int) -> bytes:
+    data = stream.read(size)
+    while data and len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    if data and len(data) < size:
+        raise OggError('truncated page')
+    return data
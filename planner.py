@@ -0,0 +1,105 @@
+import json
+import os
+from shutil import disk_usage
+
+from book import Book
+from scheduling import QueuePolicy
+from util import ms_to_fftime
+
+def history(metrics_file: str, **settings) -> list[dict]:
+    '''Records of the books converted with settings in a metrics JSON lines file, oldest first'''
+    records = []
+    try:
+        with open(metrics_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a run killed while appending leaves a partial last line
+                    continue
+                if record.get('status') == 'done' and all(record.get(k) == v for k, v in settings.items()):
+                    records.append(record)
+    except FileNotFoundError:
+        pass
+    return records
+
+def free_space(directory: str) -> int:
+    '''Free bytes on the filesystem directory is or would be created on'''
+    directory = os.path.abspath(directory)
+    while not os.path.exists(directory):
+        directory = os.path.dirname(directory)
+    return disk_usage(directory).free
+
+class Plan:
+    '''Predicted wall time and disk usage of converting books on slots parallel jobs, from the audio seconds
+    transcoded per wall second and output bytes per audio second of a single book. Books take time in proportion to
+    their duration and start in the order the policy would start them. intermediate is the share of the output bytes
+    first written to an intermediate ogg.'''
+    def __init__(self, books: list[Book], policy: QueuePolicy, slots: int, realtime_factor: float, byte_rate: float,
+                 segments: int = 1, intermediate: float = 0) -> None:
+        self.slots = max(1, slots)
+        '''parallel jobs'''
+        self.realtime_factor = realtime_factor
+        '''audio seconds transcoded per wall second of one book'''
+        self.byte_rate = byte_rate
+        '''output bytes per audio second'''
+        self.books = []
+        '''(book, predicted wall seconds from the start of the run to its finish, output bytes, scratch bytes) in
+        predicted completion order'''
+        for book, finish in policy.predict(books, self.slots):
+            audio_bytes = book.output_duration / 1000 * byte_rate
+            # segment files live until they're joined, and intermediate oggs until they're remuxed
+            copies = (len(book.segments(segments)) > 1) + intermediate
+            cover_bytes = _size(book.full_cover_file) if book.full_cover_file else 0
+            self.books.append((book, finish / 1000 / realtime_factor, round(audio_bytes) + cover_bytes,
+                               round(audio_bytes * copies)))
+
+    @property
+    def wall_time(self) -> float:
+        '''Seconds until the last book finishes'''
+        return self.books[-1][1] if self.books else 0
+
+    @property
+    def output_bytes(self) -> int:
+        return sum(b[2] for b in self.books)
+
+    @property
+    def peak_scratch_bytes(self) -> int:
+        '''Upper bound of the scratch space in use at once, that of the largest books running together'''
+        return sum(sorted((b[3] for b in self.books), reverse=True)[:self.slots])
+
+    @property
+    def peak_bytes(self) -> int:
+        '''Upper bound of the disk space the run takes, every output and the peak scratch space'''
+        return self.output_bytes + self.peak_scratch_bytes
+
+    def lines(self, free: int = None) -> list[str]:
+        '''Per book and total predictions, with the free disk space if given'''
+        width = max((len(os.path.basename(b[0].aaxc_path)) for b in self.books), default=0)
+        lines = [f'{"book":{width}s}{"duration":>14s}{"chapters":>10s}{"finish":>14s}{"output":>11s}{"scratch":>11s}']
+        for book, finish, output, scratch in self.books:
+            lines.append(f'{os.path.basename(book.aaxc_path):{width}s}{_hms(book.output_duration / 1000):>14s}'
+                         f'{len(book.chapters):10d}{_hms(finish):>14s}{_bytes(output):>11s}{_bytes(scratch):>11s}')
+        audio = sum(b[0].output_duration for b in self.books) / 1000
+        lines.append(f'{len(self.books)} books, {_hms(audio)} of audio at {self.realtime_factor:.1f}x realtime on '
+                     f'{self.slots} job{"s" if self.slots > 1 else ""}: {_hms(self.wall_time)} wall time, '
+                     f'{_hms(audio / self.realtime_factor)} of transcoding')
+        lines.append(f'disk: {_bytes(self.output_bytes)} output, {_bytes(self.peak_scratch_bytes)} peak scratch, '
+                     f'{_bytes(self.peak_bytes)} peak total' + (f' of {_bytes(free)} free' if free is not None else ''))
+        return lines
+
+def _hms(seconds: float) -> str:
+    return ms_to_fftime(round(seconds * 1000))[:-4]
+
+def _bytes(size: float) -> str:
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1000:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1000
+    return f'{size:.1f} TB'
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
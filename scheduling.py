@@ -0,0 +1,56 @@
+import heapq
+import itertools
+import os
+import time
+
+import constants as C
+from book import Book
+
+class QueuePolicy:
+    '''Orders the books waiting to run, the book with the highest key runs first. A key never changes while its book
+    waits: aging raises a book's priority with the time it has waited, which is the same as lowering it with the time
+    it was enqueued at, since every waiting book ages at the same rate.'''
+    def __init__(self, order: C.Order = C.Order.LONGEST, priorities: list[str] = (),
+                 aging: float = C.PRIORITY_AGING) -> None:
+        self.order = order
+        '''book ordering'''
+        unique = list(dict.fromkeys(priorities))
+        self.priorities = {p: len(unique) - i for i, p in enumerate(unique)}
+        '''ASIN, aaxc path or file name -> priority level, the first one given has the highest'''
+        self.aging = aging
+        '''seconds of waiting worth one priority level'''
+        self._sequence = itertools.count()
+
+    def level(self, book: Book) -> int:
+        '''Priority level of book, 0 unless it was listed'''
+        for name in (book.asin, os.path.abspath(book.aaxc_path), os.path.basename(book.aaxc_path)):
+            if name in self.priorities:
+                return self.priorities[name]
+        return 0
+
+    def key(self, book: Book, enqueued: float = None) -> tuple:
+        '''Sort key of book enqueued at time.monotonic() value enqueued, ties run in the order books were enqueued'''
+        sequence = -next(self._sequence)
+        match self.order:
+            case C.Order.LONGEST:
+                return (book.input_duration, sequence)
+            case C.Order.SHORTEST:
+                return (-book.input_duration, sequence)
+            case C.Order.PRIORITY:
+                if enqueued is None:
+                    enqueued = time.monotonic()
+                return (self.level(book) * self.aging - enqueued, sequence)
+
+    def predict(self, books: list[Book], slots: int, keys: dict[Book, tuple] = None) -> list[tuple[Book, int]]:
+        '''(book, estimated finish) in predicted completion order when books start at once on slots parallel jobs,
+        keys are computed now unless given. Transcode time is taken to be proportional to the audio duration, so
+        finishes are in audio milliseconds.'''
+        keys = keys or {book: self.key(book) for book in books}
+        free = [0] * max(1, slots)
+        finished = []
+        for book in sorted(books, key=keys.__getitem__, reverse=True):
+            finish = heapq.heappop(free) + book.output_duration
+            heapq.heappush(free, finish)
+            finished.append((book, finish))
+        finished.sort(key=lambda f: f[1])
+        return finished
@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+from threading import Lock
+
+import constants as C
+
+class StagingCancelled(Exception):
+    pass
+
+class Stager:
+    '''Local copies of the inputs of upcoming books in a scratch directory, read one at a time from start to end so
+    that slow or networked storage serves a single sequential stream instead of seeking between the books being
+    decoded. At most depth books waiting to start are staged, within a budget of bytes in the scratch directory.'''
+    def __init__(self, directory: str, budget: int, depth: int) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='aaxc2opus-stage-', dir=directory)
+        '''scratch directory of this run, removed by close'''
+        self.budget = budget
+        '''bytes the staged copies may take at once'''
+        self.depth = depth
+        '''books waiting to start that are staged ahead'''
+        self._staged = {}
+        '''aaxc path -> staged copy'''
+        self._sizes = {}
+        '''aaxc path -> bytes reserved for its copy, staged, being staged or about to be'''
+        self._pending = {}
+        '''aaxc path -> its copy, for books next reserved a copy for that hasn't started yet'''
+        self._unstageable = set()
+        self._evicted = set()
+        '''books evicted while their copy was in progress'''
+        self._n_copies = 0
+        self._cancelled = False
+        self._lock = Lock()
+
+    def path(self, aaxc: str) -> str | None:
+        '''Staged copy of aaxc, None if there is none'''
+        with self._lock:
+            return self._staged.get(aaxc)
+
+    def next(self, upcoming: list[str]) -> str | None:
+        '''The first of the depth next books in upcoming that isn't staged yet, None if there's none or it doesn't fit
+        the budget until others are evicted. Books larger than the whole budget are never staged. The budget of the
+        book returned is reserved right away, pass it to stage to copy it.'''
+        with self._lock:
+            reserved = sum(self._sizes.values())
+            for aaxc in upcoming[:self.depth]:
+                if aaxc in self._sizes or aaxc in self._unstageable:
+                    continue
+                try:
+                    size = os.path.getsize(aaxc)
+                except OSError:
+                    self._unstageable.add(aaxc)
+                    continue
+                if size > self.budget:
+                    self._unstageable.add(aaxc)
+                    continue
+                # later books only get staged in order, skipping ahead to a smaller one would break the sequence
+                if reserved + size > self.budget:
+                    return None
+                self._sizes[aaxc] = size
+                self._n_copies += 1
+                # inputs of different directories may share a name
+                self._pending[aaxc] = f'{self.directory}/{self._n_copies}-{os.path.basename(aaxc)}'
+                return aaxc
+            return None
+
+    def stage(self, aaxc: str) -> str | None:
+        '''Copy aaxc, as returned by next, into the scratch directory and return the copy, None if aaxc was evicted in
+        the meantime. Blocks for the whole copy, raises StagingCancelled if the stager is cancelled and OSError if the
+        copy fails, after which aaxc is never staged again.'''
+        with self._lock:
+            staged = self._pending.pop(aaxc, None)
+            if not staged:
+                # evicted before the copy started
+                return None
+        partial = f'{staged}.part'
+        try:
+            with open(aaxc, 'rb') as source, open(partial, 'wb') as destination:
+                # let the kernel read ahead as far as it can
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                while chunk := source.read(C.STAGE_CHUNK_SIZE):
+                    if self._cancelled:
+                        raise StagingCancelled()
+                    destination.write(chunk)
+            os.replace(partial, staged)
+        except BaseException:
+            with self._lock:
+                self._sizes.pop(aaxc, None)
+                self._evicted.discard(aaxc)
+                self._unstageable.add(aaxc)
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        with self._lock:
+            if aaxc not in self._evicted:
+                self._staged[aaxc] = staged
+                return staged
+            self._evicted.remove(aaxc)
+            del self._sizes[aaxc]
+        os.remove(staged)
+        return None
+
+    def evict(self, aaxc: str) -> None:
+        '''Remove the staged copy of aaxc, if any'''
+        with self._lock:
+            staged = self._staged.pop(aaxc, None)
+            if staged or self._pending.pop(aaxc, None):
+                del self._sizes[aaxc]
+            elif aaxc in self._sizes:
+                # the copy removes itself once it's done
+                self._evicted.add(aaxc)
+        if staged:
+            os.remove(staged)
+
+    def cancel(self) -> None:
+        '''Stop a copy in progress, safe to call from another thread'''
+        self._cancelled = True
+
+    def close(self) -> None:
+        '''Remove the scratch directory and every staged copy'''
+        with self._lock:
+            self._staged.clear()
+            self._sizes.clear()
+            self._pending.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -1,4 +1,5 @@
 import argparse
+import hashlib
 import re
 from enum import Enum
 
@@ -25,6 +26,23 @@ def ms_to_fftime(milliseconds=0):
     (h, m) = divmod(m, 60)
     return f'{h:02}:{m:02}:{s:02}.{ms:03d}'
 
+def file_sha256(path: str):
+    '''sha256 hash object of the content of path, read in chunks'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(2**16):
+            digest.update(chunk)
+    return digest
+
+def int_or_auto(value: str) -> int | None:
+    '''argparse type for a positive integer or "auto", which is returned as None'''
+    if value == 'auto':
+        return None
+    number = int(value)
+    if number < 1:
+        raise ValueError(value)
+    return number
+
 class StrEnum(Enum):
     def __str__(self):
         return self.value
@@ -0,0 +1,289 @@
+import itertools
+import os
+import re
+import struct
+from typing import BinaryIO
+
+import constants as C
+from book import Book
+from ogg import OPUS_SAMPLE_RATE, OggError, parse_opus_head, parse_opus_tags, read_last_page, read_packets
+from util import ms_to_fftime
+from webm import (CHAP_STRING, CHAPTER_ATOM, CHAPTER_DISPLAY, CHAPTER_TIME_START, CHAPTERS, CLUSTER, CUE_CLUSTER_POSITION,
+                  CUE_POINT, CUE_TIME, CUE_TRACK_POSITIONS, CUES, DURATION, EBML, EDITION_ENTRY, INFO, SEEK_HEAD,
+                  SEEK_ID, SEEK_POSITION, SEGMENT, SIMPLE_TAG, TAG, TAG_NAME, TAG_STRING, TAGS, TIMESTAMP_SCALE,
+                  WebMError, children, read_element_header, read_vint)
+
+class VerifyError(Exception):
+    '''An output that doesn't match its book'''
+    pass
+
+# opusenc writes the NAME keys of the chapter extension, ffmpeg TITLE keys for its own chapters
+_VORBIS_CHAPTER = re.compile(r'CHAPTER(\d+)(NAME|TITLE)?', re.IGNORECASE)
+
+MP4_CHAPTER_LIMIT = 255
+'''Chapters the Nero chpl box can hold, ffmpeg leaves the rest out of it'''
+_MP4_TAGS = {b'\xa9nam': 'title',
+             b'\xa9ART': 'artist',
+             b'\xa9wrt': 'composer',
+             b'\xa9day': 'date',
+             b'\xa9gen': 'genre',
+             b'desc': 'description'}
+'''iTunes metadata atom -> tag, the only tags ffmpeg writes to mp4'''
+
+class OutputInfo:
+    '''What an output's container structures say about it'''
+    __slots__ = ('duration', 'chapters', 'tags', 'problems')
+
+    def __init__(self) -> None:
+        self.duration = None
+        '''duration in milliseconds, None if the container doesn't give one'''
+        self.chapters = []
+        '''(start in milliseconds, title) of every chapter in flattened pre-order'''
+        self.tags = {}
+        '''tag -> value, tags whose container treats names case-insensitively are lowercased'''
+        self.problems = []
+        '''structural problems found while reading, e.g. a truncated file'''
+
+def probe(path: str, container: C.Container) -> OutputInfo:
+    '''Read the duration, chapters and tags of the output path from its headers and index, without decoding'''
+    info = OutputInfo()
+    with open(path, 'rb') as f:
+        try:
+            match container:
+                case C.Container.OGG:
+                    _probe_ogg(f, info)
+                case C.Container.WEBM:
+                    _probe_webm(f, info)
+                case C.Container.MP4:
+                    _probe_mp4(f, info)
+        except (OggError, WebMError, struct.error, ValueError) as e:
+            info.problems.append(f'unreadable {container}: {e}')
+    return info
+
+def check(book: Book, info: OutputInfo, container: C.Container) -> list[str]:
+    '''Differences between book and the probed info of its output in container'''
+    problems = list(info.problems)
+    if info.duration is None:
+        problems.append('no duration')
+    elif abs(info.duration - book.output_duration) > C.VERIFY_DURATION_TOLERANCE:
+        problems.append(f'duration {ms_to_fftime(round(info.duration))} instead of {ms_to_fftime(book.output_duration)}')
+
+    expected = [(c.output_offset, c.title) for c in book.chapters]
+    if container == C.Container.MP4:
+        expected = [(start, _truncate(title, 255)) for start, title in expected[:MP4_CHAPTER_LIMIT]]
+    if len(info.chapters) != len(expected):
+        problems.append(f'{len(info.chapters)} chapters instead of {len(expected)}')
+    else:
+        for i, ((start, title), (expected_start, expected_title)) in enumerate(zip(info.chapters, expected)):
+            if abs(start - expected_start) > C.VERIFY_CHAPTER_TOLERANCE or title != expected_title:
+                problems.append(f'chapter {i + 1} is "{title}" at {ms_to_fftime(round(start))} instead of '
+                                f'"{expected_title}" at {ms_to_fftime(expected_start)}')
+                break
+
+    tags = book.metadata.items()
+    if container == C.Container.MP4:
+        tags = [(k, v) for k, v in tags if k in _MP4_TAGS.values()]
+    elif container == C.Container.OGG:
+        tags = [(k.lower(), v) for k, v in tags]
+    missing = [k for k, _ in tags if k not in info.tags]
+    different = [k for k, v in tags if k in info.tags and info.tags[k] != str(v)]
+    if missing:
+        problems.append(f'missing tags {", ".join(missing)}')
+    if different:
+        problems.append(f'outdated tags {", ".join(different)}')
+    return problems
+
+def _truncate(text: str, size: int) -> str:
+    '''text cut to at most size bytes of utf-8, as a byte limited format stores it'''
+    return text.encode('utf-8')[:size].decode('utf-8', 'replace')
+
+def _probe_ogg(f: BinaryIO, info: OutputInfo) -> None:
+    # the headers are the first two packets, the duration is the granule position of the last page
+    packets = read_packets(f)
+    headers = [packet for packet, *_ in itertools.islice(packets, 2)]
+    if len(headers) < 2:
+        raise OggError('missing Opus headers')
+    head = parse_opus_head(headers[0])
+    comments = parse_opus_tags(headers[1])
+
+    chapters = {}
+    for key, value in comments:
+        if match := _VORBIS_CHAPTER.fullmatch(key):
+            chapter = chapters.setdefault(int(match[1]), [None, ''])
+            if match[2]:
+                chapter[1] = value
+            else:
+                chapter[0] = _fftime_to_ms(value)
+        else:
+            info.tags[key.lower()] = value
+    info.chapters = [tuple(chapters[i]) for i in sorted(chapters)]
+
+    last = read_last_page(f)
+    if not last:
+        info.problems.append('no complete last page')
+        return
+    if not last.header_type & 0x4:
+        info.problems.append('no end of stream page, truncated')
+    info.duration = (last.granule - head['pre_skip']) * 1000 / OPUS_SAMPLE_RATE
+
+def _fftime_to_ms(fftime: str) -> float:
+    h, m, s = fftime.split(':')
+    return (int(h) * 3600 + int(m) * 60 + float(s)) * 1000
+
+def _probe_webm(f: BinaryIO, info: OutputInfo) -> None:
+    size = os.fstat(f.fileno()).st_size
+    header = read_element_header(f)
+    if not header or header[0] != EBML:
+        raise WebMError('not an EBML file')
+    f.seek(header[1], os.SEEK_CUR)
+    header = read_element_header(f)
+    if not header or header[0] != SEGMENT:
+        raise WebMError('no segment')
+    segment_start = f.tell()
+    segment_end = segment_start + header[1]
+    if segment_end > size:
+        info.problems.append(f'segment ends {segment_end - size} bytes past the end of the file, truncated')
+
+    # the seek head says where everything else is, so that the clusters don't have to be walked
+    elements = {}
+    wanted = (INFO, CHAPTERS, TAGS, CUES)
+    header = read_element_header(f)
+    if header and header[0] == SEEK_HEAD:
+        for _, seek in children(f.read(header[1])):
+            fields = dict(children(seek))
+            element_id = read_vint(fields[SEEK_ID], 0, keep_marker=True)[0]
+            if element_id in wanted and element_id not in elements:
+                f.seek(segment_start + int.from_bytes(fields[SEEK_POSITION], 'big'))
+                header = read_element_header(f)
+                if header and header[0] == element_id:
+                    elements[element_id] = f.read(header[1])
+    if INFO not in elements or CUES not in elements:
+        # no usable seek head, walk the top level elements
+        f.seek(segment_start)
+        while f.tell() < min(segment_end, size) and (header := read_element_header(f)):
+            if header[0] in wanted and header[0] not in elements:
+                elements[header[0]] = f.read(header[1])
+            else:
+                f.seek(header[1], os.SEEK_CUR)
+
+    if INFO not in elements:
+        raise WebMError('no segment info')
+    fields = dict(children(elements[INFO]))
+    scale = int.from_bytes(fields.get(TIMESTAMP_SCALE, b''), 'big') or 1_000_000
+    if DURATION in fields:
+        duration, = struct.unpack('>d' if len(fields[DURATION]) == 8 else '>f', fields[DURATION])
+        info.duration = duration * scale / 1_000_000
+
+    # the cues are written last, their final cluster must be complete
+    if CUES not in elements:
+        info.problems.append('no cues, truncated')
+    else:
+        cue_points = [dict(children(payload)) for element_id, payload in children(elements[CUES]) if element_id == CUE_POINT]
+        last = cue_points[-1] if cue_points else None
+        positions = dict(children(last.get(CUE_TRACK_POSITIONS, b''))) if last else {}
+        if CUE_CLUSTER_POSITION not in positions:
+            info.problems.append('empty cues')
+        else:
+            cluster = segment_start + int.from_bytes(positions[CUE_CLUSTER_POSITION], 'big')
+            f.seek(cluster)
+            header = read_element_header(f) if cluster < size else None
+            if not header or header[0] != CLUSTER:
+                info.problems.append('last cue points to no cluster')
+            elif f.tell() + header[1] > size:
+                info.problems.append('last cluster cut short, truncated')
+            elif info.duration is not None and int.from_bytes(last[CUE_TIME], 'big') * scale / 1_000_000 > info.duration:
+                info.problems.append('last cue beyond the duration')
+
+    def atoms(payload: bytes):
+        for element_id, atom in children(payload):
+            if element_id != CHAPTER_ATOM:
+                continue
+            fields = dict(children(atom))
+            display = dict(children(fields.get(CHAPTER_DISPLAY, b'')))
+            info.chapters.append((int.from_bytes(fields.get(CHAPTER_TIME_START, b''), 'big') / 1_000_000,
+                                  display.get(CHAP_STRING, b'').decode('utf-8', 'replace')))
+            atoms(atom)
+    for element_id, edition in children(elements.get(CHAPTERS, b'')):
+        if element_id == EDITION_ENTRY:
+            atoms(edition)
+            # only the default, first, edition is played
+            break
+
+    for element_id, tag in children(elements.get(TAGS, b'')):
+        if element_id != TAG:
+            continue
+        for child_id, simple in children(tag):
+            if child_id == SIMPLE_TAG:
+                fields = dict(children(simple))
+                name = fields.get(TAG_NAME, b'').decode('utf-8', 'replace')
+                info.tags.setdefault(name, fields.get(TAG_STRING, b'').decode('utf-8', 'replace'))
+
+def _mp4_boxes(f: BinaryIO, end: int):
+    '''(type, payload start, payload size) of the boxes from the file position up to end, leaving the position after
+    each box before getting the next one. A box reaching past end is returned with the size it claims.'''
+    position = f.tell()
+    while position + 8 <= end:
+        f.seek(position)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size, = struct.unpack('>Q', f.read(8))
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header:
+            raise ValueError(f'invalid {box_type!r} box size')
+        yield box_type, position + header, size - header
+        position += size
+        f.seek(position)
+
+def _probe_mp4(f: BinaryIO, info: OutputInfo) -> None:
+    size = os.fstat(f.fileno()).st_size
+    moov = None
+    for box_type, start, length in _mp4_boxes(f, size):
+        if start + length > size:
+            info.problems.append(f'{box_type.decode("latin-1")} box ends {start + length - size} bytes past the end of the file, truncated')
+        elif box_type == b'moov':
+            moov = (start, length)
+    if not moov:
+        raise ValueError('no moov box')
+
+    # only the small boxes are read, the sample tables in the tracks can run to megabytes
+    f.seek(moov[0])
+    for box_type, start, length in _mp4_boxes(f, sum(moov)):
+        if box_type == b'mvhd':
+            data = f.read(length)
+            if data[0] == 1:
+                timescale, duration = struct.unpack_from('>IQ', data, 20)
+            else:
+                timescale, duration = struct.unpack_from('>II', data, 12)
+            info.duration = duration * 1000 / timescale if timescale else None
+        elif box_type == b'udta':
+            for udta_type, udta_start, udta_length in _mp4_boxes(f, start + length):
+                if udta_type == b'chpl':
+                    _read_chpl(f.read(udta_length), info)
+                elif udta_type == b'meta':
+                    # a full box, the children follow the version and flags
+                    f.seek(udta_start + 4)
+                    for meta_type, meta_start, meta_length in _mp4_boxes(f, udta_start + udta_length):
+                        if meta_type == b'ilst':
+                            _read_ilst(f, meta_start + meta_length, info)
+
+def _read_chpl(data: bytes, info: OutputInfo) -> None:
+    # version and flags, 4 reserved bytes, count, then 100ns start, title length and title of each chapter
+    offset = 9
+    for _ in range(data[8]):
+        start, length = struct.unpack_from('>QB', data, offset)
+        offset += 9
+        info.chapters.append((start / 10_000, data[offset:offset + length].decode('utf-8', 'replace')))
+        offset += length
+
+def _read_ilst(f: BinaryIO, end: int, info: OutputInfo) -> None:
+    for item_type, item_start, item_length in _mp4_boxes(f, end):
+        if item_type not in _MP4_TAGS:
+            continue
+        for data_type, _, data_length in _mp4_boxes(f, item_start + item_length):
+            if data_type == b'data':
+                # type and locale precede the value
+                info.tags[_MP4_TAGS[item_type]] = f.read(data_length)[8:].decode('utf-8', 'replace')
+                break
@@ -0,0 +1,111 @@
+import asyncio
+import ctypes
+import os
+import struct
+import time
+
+import constants as C
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+_EVENT = struct.Struct('iIII')
+
+class Watcher:
+    '''Reports which files of a set of directories changed. Uses inotify where the platform has it, otherwise every
+    directory is reported as changed as a whole every WATCH_POLL_INTERVAL seconds.'''
+    def __init__(self) -> None:
+        self._directories = {}
+        self._changed = {}
+        '''directory -> names of the files that changed in it, None if anything in it may have'''
+        self._event = asyncio.Event()
+        self._next_poll = time.monotonic() + C.WATCH_POLL_INTERVAL
+        self._libc = None
+        self._fd = None
+        try:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+            self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            pass
+        if self._fd is not None and self._fd < 0:
+            self._fd = None
+        if self._fd is not None:
+            asyncio.get_running_loop().add_reader(self._fd, self._read)
+
+    @property
+    def method(self) -> str:
+        return 'inotify' if self._fd is not None else f'polling every {C.WATCH_POLL_INTERVAL}s'
+
+    def add(self, directory: str) -> None:
+        '''Watch directory, if it isn't already'''
+        if directory in self._directories.values():
+            return
+        if self._fd is None:
+            self._directories[directory] = directory
+            return
+        # books are complete once written and closed, or moved in whole, new subdirectories show up as created
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory),
+                                          IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR)
+        if wd < 0:
+            # most likely out of watches, polling still sees everything
+            self._fallback()
+            self._directories[directory] = directory
+        else:
+            self._directories[wd] = directory
+
+    async def wait(self, timeout: float = None) -> dict[str, set[str] | None]:
+        '''Directories that changed since the last call, mapped to the names of the files that changed in them or
+        None if anything in them may have, waiting up to timeout seconds for one to'''
+        if self._fd is None:
+            delay = self._next_poll - time.monotonic()
+            if timeout is not None and timeout < delay:
+                await asyncio.sleep(max(0, timeout))
+                return {}
+            await asyncio.sleep(max(0, delay))
+            self._next_poll = time.monotonic() + C.WATCH_POLL_INTERVAL
+            return dict.fromkeys(self._directories.values())
+
+        if not self._changed:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        changed, self._changed = self._changed, {}
+        self._event.clear()
+        return changed
+
+    def close(self) -> None:
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self) -> None:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0'))
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, anything may have changed
+                self._changed.update(dict.fromkeys(self._directories.values()))
+            elif wd in self._directories:
+                directory = self._directories[wd]
+                if self._changed.get(directory, set()) is not None:
+                    self._changed.setdefault(directory, set()).add(name)
+        if self._changed:
+            self._event.set()
+
+    def _fallback(self) -> None:
+        '''Switch to polling, reporting everything as changed now in case events were missed'''
+        directories = set(self._directories.values())
+        self.close()
+        self._directories = {d: d for d in directories}
+        self._next_poll = time.monotonic()
@@ -0,0 +1,456 @@
+import os
+import struct
+from typing import BinaryIO
+
+import constants as C
+from book import Chapter, ChapterTable
+from ogg import OPUS_SAMPLE_RATE, OggError, opus_packet_samples, parse_opus_head, read_packets
+
+# matroska element ids
+EBML = 0x1A45DFA3
+EBML_VERSION = 0x4286
+EBML_READ_VERSION = 0x42F7
+EBML_MAX_ID_LENGTH = 0x42F2
+EBML_MAX_SIZE_LENGTH = 0x42F3
+DOC_TYPE = 0x4282
+DOC_TYPE_VERSION = 0x4287
+DOC_TYPE_READ_VERSION = 0x4285
+VOID = 0xEC
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+INFO = 0x1549A966
+TIMESTAMP_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TITLE = 0x7BA9
+MUXING_APP = 0x4D80
+WRITING_APP = 0x5741
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_UID = 0x73C5
+TRACK_TYPE = 0x83
+FLAG_LACING = 0x9C
+CODEC_ID = 0x86
+CODEC_PRIVATE = 0x63A2
+CODEC_DELAY = 0x56AA
+SEEK_PRE_ROLL = 0x56BB
+AUDIO = 0xE1
+SAMPLING_FREQUENCY = 0xB5
+CHANNELS = 0x9F
+CLUSTER = 0x1F43B675
+TIMESTAMP = 0xE7
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+DISCARD_PADDING = 0x75A2
+CUES = 0x1C53BB6B
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_TRACK = 0xF7
+CUE_CLUSTER_POSITION = 0xF1
+CHAPTERS = 0x1043A770
+EDITION_ENTRY = 0x45B9
+EDITION_UID = 0x45BC
+CHAPTER_ATOM = 0xB6
+CHAPTER_UID = 0x73C4
+CHAPTER_TIME_START = 0x91
+CHAPTER_TIME_END = 0x92
+CHAPTER_DISPLAY = 0x80
+CHAP_STRING = 0x85
+TAGS = 0x1254C367
+TAG = 0x7373
+TARGETS = 0x63C0
+SIMPLE_TAG = 0x67C8
+TAG_NAME = 0x45A3
+TAG_STRING = 0x4487
+ATTACHMENTS = 0x1941A469
+ATTACHED_FILE = 0x61A7
+FILE_NAME = 0x466E
+FILE_MIME_TYPE = 0x4660
+FILE_DATA = 0x465C
+FILE_UID = 0x46AE
+
+class WebMError(Exception):
+    '''A webm file whose layout rewrite_tags() can't handle'''
+    pass
+
+SEEK_HEAD_SIZE = 160
+'''Bytes reserved at the start of the segment for the seek head, which is written last'''
+SEEK_PRE_ROLL_NS = 80_000_000
+'''Opus decoder convergence time recommended by RFC 7845'''
+COPY_CHUNK_SIZE = 1 << 20
+'''Read size when rewrite_tags() copies the clusters into a rewritten file'''
+
+def ebml_id(element_id: int) -> bytes:
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+def ebml_size(size: int, length: int = 0) -> bytes:
+    '''Variable length size, in the shortest form or exactly length bytes'''
+    if not length:
+        length = 1
+        while size >= (1 << (7 * length)) - 1:
+            length += 1
+    return (size | (1 << (7 * length))).to_bytes(length, 'big')
+
+def element(element_id: int, payload: bytes) -> bytes:
+    return ebml_id(element_id) + ebml_size(len(payload)) + payload
+
+def master(element_id: int, *children: bytes) -> bytes:
+    return element(element_id, b''.join(children))
+
+def uint(element_id: int, value: int, length: int = 0) -> bytes:
+    return element(element_id, value.to_bytes(length or max(1, (value.bit_length() + 7) // 8), 'big'))
+
+def sint(element_id: int, value: int) -> bytes:
+    return element(element_id, value.to_bytes(max(1, (value.bit_length() + 8) // 8), 'big', signed=True))
+
+def float64(element_id: int, value: float) -> bytes:
+    return element(element_id, struct.pack('>d', value))
+
+def string(element_id: int, value: str) -> bytes:
+    return element(element_id, value.encode('utf-8'))
+
+def void(size: int) -> bytes:
+    '''Void element spanning exactly size bytes, size must be at least 2'''
+    length = 1 if size - 2 < 127 else 8
+    return ebml_id(VOID) + ebml_size(size - 1 - length, length) + bytes(size - 1 - length)
+
+def read_vint(data: bytes, offset: int, keep_marker=False) -> tuple[int, int]:
+    '''(value, length) of the variable length integer at offset, element ids keep their length marker'''
+    if offset >= len(data) or not data[offset]:
+        raise WebMError(f'invalid variable length integer at {offset}')
+    length = 9 - data[offset].bit_length()
+    value = int.from_bytes(data[offset:offset + length], 'big')
+    return (value if keep_marker else value & ((1 << (7 * length)) - 1)), length
+
+def read_element_header(f: BinaryIO) -> tuple[int, int, int] | None:
+    '''(element id, payload size, header length) of the element at the file position, None at EOF. The position is
+    left at the payload.'''
+    data = f.read(12)
+    if not data:
+        return None
+    element_id, id_length = read_vint(data, 0, keep_marker=True)
+    size, size_length = read_vint(data, id_length)
+    if size == (1 << (7 * size_length)) - 1:
+        raise WebMError('unknown size elements are not supported')
+    f.seek(id_length + size_length - len(data), os.SEEK_CUR)
+    return element_id, size, id_length + size_length
+
+def children(data: bytes):
+    '''(element id, payload) of the elements in a master element's payload'''
+    offset = 0
+    while offset < len(data):
+        element_id, id_length = read_vint(data, offset, keep_marker=True)
+        size, size_length = read_vint(data, offset + id_length)
+        start = offset + id_length + size_length
+        yield element_id, data[start:start + size]
+        offset = start + size
+
+def chapter_atoms(chapters: ChapterTable) -> list[bytes]:
+    '''Nested ChapterAtom elements, a parent's time range covers all of its children'''
+    def atom(c: Chapter, end: int, nested: list[bytes]) -> bytes:
+        return master(CHAPTER_ATOM,
+                      uint(CHAPTER_UID, c.index + 1),
+                      uint(CHAPTER_TIME_START, c.output_offset * 1_000_000),
+                      uint(CHAPTER_TIME_END, end * 1_000_000),
+                      master(CHAPTER_DISPLAY, string(CHAP_STRING, c.title)),
+                      *nested)
+
+    return chapters.nested(atom)
+
+def ebml_header() -> bytes:
+    return master(EBML,
+                  uint(EBML_VERSION, 1),
+                  uint(EBML_READ_VERSION, 1),
+                  uint(EBML_MAX_ID_LENGTH, 4),
+                  uint(EBML_MAX_SIZE_LENGTH, 8),
+                  string(DOC_TYPE, 'webm'),
+                  uint(DOC_TYPE_VERSION, 4),
+                  uint(DOC_TYPE_READ_VERSION, 2))
+
+def info_element(metadata: dict, duration: float = 0) -> bytes:
+    '''Segment Info, the duration comes last so that it can be patched in place'''
+    return master(INFO,
+                  uint(TIMESTAMP_SCALE, 1_000_000),
+                  string(MUXING_APP, 'aaxc2opus'),
+                  string(WRITING_APP, 'aaxc2opus'),
+                  *((string(TITLE, metadata['title']), ) if 'title' in metadata else ()),
+                  float64(DURATION, duration))
+
+def metadata_elements(metadata: dict, chapters: ChapterTable, cover_file: str = None) -> list[tuple[int, bytes]]:
+    '''(element id, element) of the Chapters, Tags and cover Attachments top level elements'''
+    elements = []
+    if chapters:
+        elements.append((CHAPTERS, master(CHAPTERS, master(EDITION_ENTRY,
+                                                           uint(EDITION_UID, 1),
+                                                           *chapter_atoms(chapters)))))
+
+    tags = (master(SIMPLE_TAG, string(TAG_NAME, k), string(TAG_STRING, str(v))) for k, v in metadata.items())
+    elements.append((TAGS, master(TAGS, master(TAG, master(TARGETS), *tags))))
+
+    if cover_file:
+        with open(cover_file, 'rb') as cover:
+            elements.append((ATTACHMENTS, master(ATTACHMENTS, master(ATTACHED_FILE,
+                                                                     string(FILE_NAME, 'cover.jpg'),
+                                                                     string(FILE_MIME_TYPE, 'image/jpeg'),
+                                                                     element(FILE_DATA, cover.read()),
+                                                                     uint(FILE_UID, 1)))))
+    return elements
+
+def seek_head(seeks: dict[int, int], size: int) -> bytes:
+    '''SeekHead of top level element id -> segment relative position, padded with a Void to size bytes'''
+    data = master(SEEK_HEAD, *(master(SEEK,
+                                      element(SEEK_ID, ebml_id(element_id)),
+                                      uint(SEEK_POSITION, position, 8))
+                               for element_id, position in seeks.items()))
+    return data + void(size - len(data)) if len(data) < size else data
+
+class WebMMuxer:
+    '''Streaming Ogg Opus to WebM muxer. Packets are copied into clusters as they arrive, only the cue list grows
+    with the duration, one entry per cluster. The output must be a seekable file, the seek head, duration and
+    segment size are filled in at the end.'''
+    def __init__(self, output_file: str, metadata: dict, chapters: ChapterTable, cover_file: str = None) -> None:
+        self.output_file = output_file
+        '''output webm path'''
+        self.metadata = metadata
+        '''global SimpleTags'''
+        self.chapters = chapters
+        '''chapters, nested as in the table'''
+        self.cover_file = cover_file
+        '''jpeg attached as cover.jpg, if any'''
+
+    def mux(self, stream: BinaryIO) -> None:
+        packets = read_packets(stream)
+        try:
+            head_packet, _, _ = next(packets)
+            next(packets) # OpusTags, replaced by the matroska tags
+        except StopIteration:
+            raise OggError('stream ended before the opus headers')
+        head = parse_opus_head(head_packet)
+
+        with open(self.output_file, 'wb') as f:
+            f.write(ebml_header())
+            f.write(ebml_id(SEGMENT))
+            segment_size_offset = f.tell()
+            f.write(ebml_size(0, 8))
+            segment_start = f.tell()
+            f.write(void(SEEK_HEAD_SIZE))
+
+            seeks = {}
+            def top_level(element_id: int, data: bytes) -> int:
+                seeks[element_id] = f.tell() - segment_start
+                f.write(data)
+                return seeks[element_id]
+
+            # duration is patched in once the last packet is known
+            info = info_element(self.metadata)
+            duration_offset = segment_start + top_level(INFO, info) + len(info) - 8
+
+            top_level(TRACKS, master(TRACKS, master(TRACK_ENTRY,
+                uint(TRACK_NUMBER, 1),
+                uint(TRACK_UID, 1),
+                uint(TRACK_TYPE, 2),
+                uint(FLAG_LACING, 0),
+                string(CODEC_ID, 'A_OPUS'),
+                element(CODEC_PRIVATE, head_packet),
+                uint(CODEC_DELAY, head['pre_skip'] * 1_000_000_000 // OPUS_SAMPLE_RATE),
+                uint(SEEK_PRE_ROLL, SEEK_PRE_ROLL_NS),
+                master(AUDIO,
+                       float64(SAMPLING_FREQUENCY, float(OPUS_SAMPLE_RATE)),
+                       uint(CHANNELS, head['channels'])))))
+
+            for element_id, data in metadata_elements(self.metadata, self.chapters, self.cover_file):
+                top_level(element_id, data)
+            # room for rewrite_tags() to rewrite the metadata in place
+            f.write(void(C.WEBM_RETAG_PADDING))
+
+            cues, samples, granule = self._write_clusters(f, segment_start, packets)
+            top_level(CUES, master(CUES, *(master(CUE_POINT,
+                                                  uint(CUE_TIME, time),
+                                                  master(CUE_TRACK_POSITIONS,
+                                                         uint(CUE_TRACK, 1),
+                                                         uint(CUE_CLUSTER_POSITION, position)))
+                                           for time, position in cues)))
+            segment_end = f.tell()
+
+            duration = max(0, min(samples, granule) - head['pre_skip']) * 1000 / OPUS_SAMPLE_RATE
+            f.seek(duration_offset)
+            f.write(struct.pack('>d', duration))
+
+            f.seek(segment_start)
+            f.write(seek_head(seeks, SEEK_HEAD_SIZE))
+
+            f.seek(segment_size_offset)
+            f.write(ebml_size(segment_end - segment_start, 8))
+
+    def _write_clusters(self, f: BinaryIO, segment_start: int, packets) -> tuple[list[tuple[int, int]], int, int]:
+        '''Write audio packets as clusters, returns (cue points, total samples, final granule position). The last
+        packet goes into a BlockGroup carrying the end trim as DiscardPadding.'''
+        cues = []
+        cluster = bytearray()
+        cluster_time = 0
+        samples = 0
+        granule = 0
+        pending = None
+
+        def flush():
+            if cluster:
+                cues.append((cluster_time, f.tell() - segment_start))
+                timestamp = uint(TIMESTAMP, cluster_time)
+                f.write(ebml_id(CLUSTER) + ebml_size(len(timestamp) + len(cluster)) + timestamp)
+                f.write(cluster)
+                cluster.clear()
+
+        for packet, page_granule, last_on_page in packets:
+            if last_on_page:
+                granule = page_granule
+            if pending is not None:
+                time = pending[1]
+                if time - cluster_time >= C.WEBM_CLUSTER_DURATION:
+                    flush()
+                    cluster_time = time
+                cluster += element(SIMPLE_BLOCK, struct.pack('>BhB', 0x81, time - cluster_time, 0x80) + pending[0])
+            pending = (packet, samples * 1000 // OPUS_SAMPLE_RATE)
+            samples += opus_packet_samples(packet)
+
+        if pending is not None:
+            packet, time = pending
+            if time - cluster_time >= C.WEBM_CLUSTER_DURATION:
+                flush()
+                cluster_time = time
+            block = element(BLOCK, struct.pack('>BhB', 0x81, time - cluster_time, 0) + packet)
+            trim = max(0, samples - granule)
+            padding = (sint(DISCARD_PADDING, trim * 1_000_000_000 // OPUS_SAMPLE_RATE), ) if trim else ()
+            cluster += master(BLOCK_GROUP, block, *padding)
+        flush()
+
+        return cues, samples, granule
+
+def rewrite_tags(path: str, metadata: dict, chapters: ChapterTable, cover_file: str = None) -> bool:
+    '''Replace the title, chapters, tags and cover of a webm written by WebMMuxer, returns whether it was done in
+    place. The header is rewritten in place when it fits in the space of the old one and its padding, otherwise the
+    file is rewritten with the clusters copied unchanged and the cues moved along with them.'''
+    with open(path, 'r+b') as f:
+        header = read_element_header(f)
+        if not header or header[0] != EBML:
+            raise WebMError('not an EBML file')
+        f.seek(header[1], os.SEEK_CUR)
+        segment_offset = f.tell()
+        header = read_element_header(f)
+        if not header or header[0] != SEGMENT:
+            raise WebMError('no segment')
+        segment_start = f.tell()
+
+        # the metadata is everything between the seek head and the first cluster
+        elements = {}
+        while True:
+            offset = f.tell()
+            header = read_element_header(f)
+            if not header:
+                raise WebMError('no clusters')
+            element_id, size, _ = header
+            if element_id == CLUSTER:
+                break
+            if element_id not in (SEEK_HEAD, VOID, INFO, TRACKS, CHAPTERS, TAGS, ATTACHMENTS):
+                raise WebMError(f'unexpected top level element {element_id:X}')
+            if element_id != VOID:
+                elements[element_id] = (offset, f.read(size))
+            else:
+                f.seek(size, os.SEEK_CUR)
+        clusters_start = offset
+        if elements.get(SEEK_HEAD, (None, ))[0] != segment_start or INFO not in elements or TRACKS not in elements:
+            raise WebMError('missing seek head, info or tracks')
+
+        seeks = {}
+        for _, seek in children(elements[SEEK_HEAD][1]):
+            fields = dict(children(seek))
+            seeks[read_vint(fields[SEEK_ID], 0, keep_marker=True)[0]] = int.from_bytes(fields[SEEK_POSITION], 'big')
+        if CUES not in seeks or segment_start + seeks[CUES] < clusters_start:
+            raise WebMError('cues missing or ahead of the clusters')
+        if any(segment_start + p >= clusters_start for i, p in seeks.items() if i != CUES):
+            raise WebMError('metadata after the clusters, not written by the built-in muxer')
+
+        duration = dict(children(elements[INFO][1])).get(DURATION)
+        duration = struct.unpack('>d' if len(duration) == 8 else '>f', duration)[0] if duration else 0
+        tracks = element(TRACKS, elements[TRACKS][1])
+
+        region_start = min(offset for element_id, (offset, _) in elements.items() if element_id != SEEK_HEAD)
+        region = [(INFO, info_element(metadata, duration)),
+                  (TRACKS, tracks),
+                  *metadata_elements(metadata, chapters, cover_file)]
+        new_seeks = {}
+        position = region_start - segment_start
+        for element_id, data in region:
+            new_seeks[element_id] = position
+            position += len(data)
+        region = b''.join(data for _, data in region)
+        space = clusters_start - region_start
+        seek_head_space = region_start - segment_start
+
+        if len(region) == space or len(region) + 2 <= space:
+            new_seeks[CUES] = seeks[CUES]
+            f.seek(region_start)
+            f.write(region)
+            if len(region) < space:
+                f.write(void(space - len(region)))
+            f.seek(segment_start)
+            f.write(seek_head(new_seeks, seek_head_space))
+            return True
+
+        f.seek(segment_start + seeks[CUES])
+        cues_id, cues_size, cues_header = read_element_header(f)
+        cues = f.read(cues_size)
+        cues_end = f.tell()
+        f.seek(0, os.SEEK_END)
+        file_end = f.tell()
+
+        temp_file = f'{path}.retag'
+        with open(temp_file, 'wb') as out:
+            f.seek(0)
+            out.write(f.read(segment_offset))
+            out.write(ebml_id(SEGMENT))
+            out.write(ebml_size(0, 8))
+            new_segment_start = out.tell()
+            out.write(void(SEEK_HEAD_SIZE))
+            for element_id in new_seeks:
+                new_seeks[element_id] += SEEK_HEAD_SIZE - seek_head_space
+            out.write(region)
+            out.write(void(C.WEBM_RETAG_PADDING))
+
+            # cluster positions are relative to the segment, they all move by the same amount
+            shift = (out.tell() - new_segment_start) - (clusters_start - segment_start)
+            _copy(f, out, clusters_start, segment_start + seeks[CUES])
+            new_seeks[CUES] = out.tell() - new_segment_start
+            out.write(master(CUES, *(_shift_cue_point(payload, shift) for _, payload in children(cues))))
+            _copy(f, out, cues_end, file_end)
+            segment_end = out.tell()
+
+            out.seek(new_segment_start)
+            out.write(seek_head(new_seeks, SEEK_HEAD_SIZE))
+            out.seek(new_segment_start - 8)
+            out.write(ebml_size(segment_end - new_segment_start, 8))
+    os.replace(temp_file, path)
+    return False
+
+def _shift_cue_point(cue_point: bytes, shift: int) -> bytes:
+    fields = []
+    for element_id, payload in children(cue_point):
+        if element_id == CUE_TRACK_POSITIONS:
+            payload = b''.join(uint(CUE_CLUSTER_POSITION, int.from_bytes(p, 'big') + shift)
+                               if i == CUE_CLUSTER_POSITION else element(i, p) for i, p in children(payload))
+        fields.append(element(element_id, payload))
+    return master(CUE_POINT, *fields)
+
+def _copy(source: BinaryIO, destination: BinaryIO, start: int, end: int) -> None:
+    source.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = source.read(min(remaining, COPY_CHUNK_SIZE))
+        if not data:
+            raise WebMError('file ended early')
+        destination.write(data)
+        remaining -= len(data)
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import socket
+import time
+import uuid
+
+import constants as C
+from book import Book
+
+class Lease:
+    '''A claim on one book within a WorkQueue'''
+    def __init__(self, path: str, token: str) -> None:
+        self.path = path
+        '''lease file path'''
+        self.token = token
+        '''unique token written into the lease file by its owner'''
+
+    def held(self) -> bool:
+        '''Whether the lease file still carries this lease's token'''
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)['token'] == self.token
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def refresh(self) -> bool:
+        '''Heartbeat, push the expiry back. Returns False if the lease was lost to another worker or the queue
+        directory can't be reached.'''
+        if not self.held():
+            return False
+        try:
+            os.utime(self.path)
+        except OSError:
+            # reclaimed between the check and the update, or e.g. a stale NFS handle
+            return False
+        return True
+
+class WorkQueue:
+    '''Shared directory of lease files through which several aaxc2opus processes, on one or more hosts, divide a
+    common set of inputs. A book is claimed by atomically creating its lease file, kept by refreshing the file's
+    mtime, and marked done with a second file. Leases that aren't refreshed within the ttl are reclaimed. Both files
+    are per input file and profiles, workers with other profiles or a changed input convert the book again.'''
+    def __init__(self, directory: str, profiles: list[C.Profile], ttl=C.LEASE_TTL) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        '''shared queue directory'''
+        self.profiles = ','.join(sorted(str(p) for p in profiles))
+        '''profiles books are converted to, in the order every worker writes them'''
+        self.ttl = ttl
+        '''seconds without a heartbeat before a lease expires'''
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        '''identifies this process in lease files'''
+
+    def _key(self, book: Book) -> str:
+        # mount points differ between hosts, the file name, size and mtime don't. They also keep inputs of the same
+        # name in different directories apart, unless they're copies of the same file.
+        try:
+            res = os.stat(book.aaxc_path)
+            stat = [res.st_size, res.st_mtime_ns]
+        except OSError:
+            # a vanished input fails to convert on its own
+            stat = None
+        identity = json.dumps([book.asin, book.content_format, stat, self.profiles])
+        digest = hashlib.sha1(identity.encode()).hexdigest()[:16]
+        return f'{os.path.splitext(os.path.basename(book.aaxc_path))[0]}.{digest}'
+
+    def _lease_path(self, book: Book) -> str:
+        return f'{self.directory}/{self._key(book)}.lease'
+
+    def _done_path(self, book: Book) -> str:
+        return f'{self.directory}/{self._key(book)}.done'
+
+    def is_done(self, book: Book) -> bool:
+        return os.path.exists(self._done_path(book))
+
+    def claim(self, book: Book) -> Lease | None:
+        '''Try to claim book, returns None if it's done or another live worker holds it'''
+        if self.is_done(book):
+            return None
+
+        path = self._lease_path(book)
+        for _ in range(2):
+            token = uuid.uuid4().hex
+            try:
+                # O_EXCL creation is the atomic step, also on NFSv3 and later
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                if not self._reclaim(path):
+                    return None
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'token': token, 'worker': self.worker, 'claimed': time.time()}, f)
+            return Lease(path, token)
+        return None
+
+    def _reclaim(self, path: str) -> bool:
+        '''Remove an expired lease, returns whether a new claim may be attempted'''
+        try:
+            if time.time() - os.stat(path).st_mtime < self.ttl:
+                return False
+            # only one of several competing workers wins the rename
+            stale = f'{path}.{uuid.uuid4().hex}'
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return True
+        # the owner may have sent a heartbeat between the stat and the rename, give it back
+        if time.time() - os.stat(stale).st_mtime < self.ttl:
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        return True
+
+    def release(self, book: Book, lease: Lease, done: bool) -> None:
+        '''Give up lease, marking book as done for every worker if it completed'''
+        # the lease names the input as it was claimed, which the marker has to match even if it changed since
+        if done:
+            with open(f'{os.path.splitext(lease.path)[0]}.done', 'w') as f:
+                json.dump({'worker': self.worker, 'completed': time.time()}, f)
+        if lease.held():
+            os.remove(lease.path)